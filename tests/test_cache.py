@@ -0,0 +1,128 @@
+import shutil
+import tempfile
+import unittest
+
+import torch
+
+from tiktorch.cache import ResultCache, CapacityCache, CompiledModelCache, SampleStore
+
+
+class ResultCacheTest(unittest.TestCase):
+    def test_key(self):
+        tensor = torch.rand(1, 32, 32)
+        self.assertEqual(ResultCache.key(tensor, 0), ResultCache.key(tensor.clone(), 0))
+        # A new model version or different data makes a new key
+        self.assertNotEqual(ResultCache.key(tensor, 0), ResultCache.key(tensor, 1))
+        self.assertNotEqual(ResultCache.key(tensor, 0), ResultCache.key(tensor + 1, 0))
+        self.assertNotEqual(ResultCache.key(tensor, 0), ResultCache.key(tensor.view(32, 32), 0))
+
+    def test_lru_eviction(self):
+        # Room for two 1 kB tensors
+        cache = ResultCache(max_bytes=2048)
+        for key in 'abc':
+            cache.put(key, torch.zeros(256))
+            # Keep 'a' fresh
+            cache.get('a')
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.nbytes, 2048)
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        # Too big to cache at all
+        cache.put('d', torch.zeros(1024))
+        self.assertIsNone(cache.get('d'))
+
+
+class CapacityCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_persistence(self):
+        key = CapacityCache.key(model='a', state='b', device='cpu', mode='inference')
+        self.assertIsNone(CapacityCache(self.directory).get(key))
+        CapacityCache(self.directory).put(key, [3, 4], device='cpu')
+        # Survives a restart
+        self.assertEqual(CapacityCache(self.directory).get(key), [3, 4])
+        self.assertNotEqual(key, CapacityCache.key(model='a', state='b', device='cpu',
+                                                   mode='train'))
+
+    def test_receptive_field(self):
+        self.assertIsNone(CapacityCache(self.directory).get_receptive_field('a'))
+        CapacityCache(self.directory).put_receptive_field('a', [4, 4], [2, 2])
+        self.assertEqual(CapacityCache(self.directory).get_receptive_field('a'), ([4, 4], [2, 2]))
+        self.assertIsNone(CapacityCache(self.directory).get_receptive_field('b'))
+
+    def test_state_hash(self):
+        model = torch.nn.Conv2d(1, 1, 1)
+        state_hash = CapacityCache.state_hash(model)
+        self.assertEqual(state_hash, CapacityCache.state_hash(model))
+        with torch.no_grad():
+            model.weight.add_(1)
+        self.assertNotEqual(state_hash, CapacityCache.state_hash(model))
+
+
+class CompiledModelCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_compile_and_reload(self):
+        model = torch.nn.Sequential(torch.nn.Conv2d(1, 4, 3, padding=1), torch.nn.ReLU(),
+                                    torch.nn.Conv2d(4, 1, 1))
+        state_hash = CapacityCache.state_hash(model)
+        input_tensor = torch.rand(1, 1, 32, 32)
+        cache = CompiledModelCache(self.directory)
+        self.assertIsNone(cache.get(model, state_hash, input_tensor.shape, 'cpu', compile=False))
+        module = cache.get(model, state_hash, input_tensor.shape, 'cpu')
+        with torch.no_grad():
+            expected = model(input_tensor)
+            self.assertTrue(torch.allclose(module(input_tensor), expected, atol=1e-6))
+            # After a restart, it's loaded from disk
+            module = CompiledModelCache(self.directory).get(None, state_hash, input_tensor.shape,
+                                                            'cpu', compile=False)
+            self.assertTrue(torch.allclose(module(input_tensor), expected, atol=1e-6))
+        # Other weights, other module
+        self.assertIsNone(cache.get(model, 'other', input_tensor.shape, 'cpu', compile=False))
+
+    def test_uncompilable(self):
+        class Model(torch.nn.Module):
+            def forward(self, x):
+                raise RuntimeError("Nope")
+        cache = CompiledModelCache(self.directory)
+        self.assertIsNone(cache.get(Model(), 'state', (1, 1, 8, 8), 'cpu'))
+
+
+class SampleStoreTest(unittest.TestCase):
+    def test_dedup(self):
+        store = SampleStore(max_samples=2)
+        data = torch.rand(1, 32, 32)
+        labels = torch.zeros(1, 32, 32)
+        self.assertTrue(store.add(data, labels))
+        # Same sample again, even if it's a different tensor
+        self.assertFalse(store.add(data.clone(), labels.clone()))
+        self.assertEqual(len(store), 1)
+        # Edited labels replace the entry
+        new_labels = labels.clone()
+        new_labels[0, 0, 0] = 1.
+        self.assertTrue(store.add(data.clone(), new_labels))
+        self.assertEqual(len(store), 1)
+        self.assertTrue(torch.equal(store.next_sample()[1], new_labels))
+
+    def test_eviction(self):
+        store = SampleStore(max_samples=2)
+        samples = [(torch.full((1, 4, 4), float(idx)), torch.zeros(1, 4, 4)) for idx in range(3)]
+        store.add(*samples[0])
+        store.add(*samples[1])
+        # Going through the store in turns; what was used longest ago goes first
+        self.assertTrue(torch.equal(store.next_sample()[0], samples[0][0]))
+        store.add(*samples[2])
+        self.assertEqual(len(store), 2)
+        self.assertEqual([store.next_sample()[0][0, 0, 0].item() for _ in range(2)], [0., 2.])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,313 @@
+import asyncio
+import os
+import shutil
+import socket
+import tempfile
+import time
+import threading as thr
+import unittest
+from unittest import mock
+
+import h5py
+import numpy as np
+import torch
+
+from tiktorch.client import AsyncTikTorchClient, TikTorchClient
+from tiktorch.tio import TikRef
+from tiktorch.server import TikTorchServer
+
+CONFIG = {'input_shape': [1, 64, 64],
+          'dynamic_input_shape': '(32 * (nH + 1), 32 * (nW + 1))'}
+
+
+class ServerTestCase(unittest.TestCase):
+    """Runs a server (with a 1x1 convolution as model) in a thread for the clients to talk to."""
+    def setUp(self):
+        for cls in (TikTorchServer, AsyncTikTorchClient):
+            patcher = mock.patch.object(cls, 'read_config', lambda self: self)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.directory = tempfile.mkdtemp()
+        self.endpoint = self.make_endpoint()
+        self.server = TikTorchServer(endpoint=self.endpoint, device='cpu')
+        self.server._config = dict(CONFIG)
+        self.server._set_handler(torch.nn.Conv2d(1, 1, 1))
+        self.server_thread = thr.Thread(target=self.server.listen)
+        self.server_thread.start()
+
+    def tearDown(self):
+        self.server_thread.join(timeout=10)
+        shutil.rmtree(self.directory)
+
+    def make_endpoint(self):
+        return f"ipc://{os.path.join(self.directory, 'tiktorch.ipc')}"
+
+    def make_client(self, transport, **kwargs):
+        client = TikTorchClient(self.directory, endpoint=self.endpoint, transport=transport,
+                                **kwargs)
+        client.async_client._config = dict(CONFIG)
+        return client
+
+
+class ClientServerTest(ServerTestCase):
+    def _test_forward(self, transport):
+        client = self.make_client(transport)
+        inputs = [[np.random.uniform(size=(64, 64)).astype('float32') for _ in range(2)]
+                  for _ in range(4)]
+        # Several requests in flight at once
+        futures = [client.forward_async(_inputs) for _inputs in inputs]
+        for _inputs, future in zip(inputs, futures):
+            expected = self.server.model(torch.from_numpy(np.stack(_inputs)[:, None]))
+            np.testing.assert_allclose(future.result(), expected.detach().numpy(), rtol=1e-5)
+        self.assertFalse(client.training_process_is_running())
+        self.assertIsNone(client.training_stats())
+        client.shutdown()
+
+    def test_forward_zmq(self):
+        self._test_forward('zmq')
+
+    def test_forward_shm(self):
+        self._test_forward('shm')
+
+    def test_load_in_compute_thread(self):
+        handler, self.server._handler = self.server._handler, None
+        loaded_by = []
+        def load_model():
+            loaded_by.append(thr.current_thread())
+            self.server._handler = handler
+            return self.server
+        with mock.patch.object(self.server, 'load_model', load_model):
+            client = self.make_client('zmq')
+            # Training commands don't load the model
+            self.assertFalse(client.training_process_is_running())
+            self.assertIsNone(client.training_stats())
+            client.pause()
+            self.assertEqual(loaded_by, [])
+            # Forward requests do, once, in the compute thread
+            for _ in range(2):
+                client.forward([np.zeros((64, 64), dtype='float32')])
+            self.assertEqual(loaded_by, [self.server._worker])
+            client.shutdown()
+
+    def test_bad_build_directory(self):
+        self.server._build_directory = None
+        empty_directory = os.path.join(self.directory, 'empty')
+        os.makedirs(empty_directory)
+        def read_config(server):
+            if not os.path.exists(os.path.join(server.build_directory, 'tiktorch_config.yml')):
+                raise FileNotFoundError(f"No config in {server.build_directory}.")
+            return server
+        open(os.path.join(self.directory, 'tiktorch_config.yml'), 'w').close()
+        with mock.patch.object(TikTorchServer, 'read_config', read_config):
+            with self.assertRaises(RuntimeError):
+                TikTorchClient(empty_directory, endpoint=self.endpoint, transport='zmq')
+            # The failed client doesn't get to decide which model the server serves
+            client = self.make_client('zmq')
+        self.assertEqual(self.server.build_directory, self.directory)
+        client.shutdown()
+
+    def test_forward_encoded(self):
+        client = self.make_client('zmq', compression='zlib', output_dtype='float16')
+        # uint8 inputs go over the wire as is
+        inputs = [np.random.randint(0, 256, size=(64, 64)).astype('uint8') for _ in range(2)]
+        output = client.forward(inputs)
+        expected = self.server.model(torch.from_numpy(np.stack(inputs)[:, None]).float())
+        self.assertEqual(output.dtype, np.float32)
+        np.testing.assert_allclose(output, expected.detach().numpy(), rtol=1e-3, atol=1e-2)
+        client.shutdown()
+
+    def test_forward_stream(self):
+        client = self.make_client('shm')
+        inputs = [np.random.uniform(size=(64, 96)).astype('float32')]
+        expected = client.forward(inputs)
+        output = np.zeros_like(expected)
+        num_tiles = 0
+        for slices, tile in client.forward_stream(inputs, tile_shape=[32, 64]):
+            output[(slice(None), slice(None)) + slices] = tile
+            num_tiles += 1
+        self.assertEqual(num_tiles, 4)
+        np.testing.assert_allclose(output, expected, rtol=1e-5)
+        client.shutdown()
+
+    def test_forward_stream_backlog(self):
+        client = self.make_client('shm')
+        inputs = [np.random.uniform(size=(128, 128)).astype('float32')]
+        expected = client.forward(inputs)
+        # 16 tiles, four times as many as the server's ring holds, all sent before the client
+        # reads the second one
+        num_tiles = 16
+        process_tensor = self.server.handler.process_tensor
+        all_sent = thr.Event()
+        calls = []
+        def counting_process_tensor(tensor):
+            calls.append(tensor.shape)
+            if len(calls) == num_tiles:
+                all_sent.set()
+            return process_tensor(tensor)
+        self.server.handler.process_tensor = counting_process_tensor
+        output = np.zeros_like(expected)
+        def on_tile(slices, tile):
+            if not all_sent.is_set():
+                # Hold up the client until the server is through
+                all_sent.wait(timeout=10)
+                time.sleep(0.2)
+            output[(slice(None), slice(None)) + slices] = tile
+        client.forward_stream_async(inputs, on_tile, tile_shape=[32, 32]).result()
+        self.assertEqual(len(calls), num_tiles)
+        np.testing.assert_allclose(output, expected, rtol=1e-5)
+        client.shutdown()
+
+    def test_async_client(self):
+        async def run():
+            client = AsyncTikTorchClient(self.directory, endpoint=self.endpoint, transport='shm')
+            client._config = dict(CONFIG)
+            async with client:
+                inputs = [[np.random.uniform(size=(64, 64)).astype('float32')] for _ in range(4)]
+                # Cancelling one request leaves the others alone
+                tasks = [asyncio.ensure_future(client.forward(_inputs)) for _inputs in inputs]
+                tasks[1].cancel()
+                outputs = await asyncio.gather(*tasks, return_exceptions=True)
+                self.assertIsInstance(outputs[1], asyncio.CancelledError)
+                for _inputs, output in zip(inputs[::2], outputs[::2]):
+                    expected = self.server.model(torch.from_numpy(np.stack(_inputs)[:, None]))
+                    np.testing.assert_allclose(output, expected.detach().numpy(), rtol=1e-5)
+                tiles = [tile async for tile in client.forward_stream(inputs[0])]
+                self.assertEqual(len(tiles), 4)
+                self.assertFalse(await client.training_process_is_running())
+        asyncio.run(run())
+
+    def test_cancel_and_priority(self):
+        client = self.make_client('shm')
+        process_tensor = self.server.handler.process_tensor
+        widths = []
+        def slow_process_tensor(tensor):
+            widths.append(tensor.shape[-1])
+            time.sleep(0.01)
+            return process_tensor(tensor)
+        self.server.handler.process_tensor = slow_process_tensor
+        tiles = []
+        def on_tile(slices, tile):
+            tiles.append(slices)
+            future.cancel()
+        # 64 tiles, but we stop after the first one
+        future = client.forward_stream_async([np.zeros((256, 256), dtype='float32')], on_tile,
+                                             tile_shape=[32, 32])
+        # Queued up behind the stream; the one with the higher priority goes first
+        bulk = client.forward_async([np.zeros((96, 96), dtype='float32')], priority=-1)
+        interactive = client.forward_async([np.zeros((64, 64), dtype='float32')])
+        self.assertEqual(bulk.result().shape, (1, 1, 96, 96))
+        self.assertEqual(interactive.result().shape, (1, 1, 64, 64))
+        self.assertTrue(future.cancelled())
+        self.assertLess(len(tiles), 64)
+        self.assertEqual(widths[-2:], [64, 96])
+        client.shutdown()
+
+    def test_train_upload(self):
+        client = self.make_client('shm')
+        client.async_client.UPLOAD_CHUNK_SIZE = 1000
+        received = []
+        self.server.handler.train = lambda data, labels: received.append((data, labels))
+        data = [np.random.randint(0, 256, size=(1, 64, 64)).astype('uint8') for _ in range(2)]
+        labels = [np.random.randint(0, 2, size=(1, 64, 64)).astype('float32') for _ in range(2)]
+        progress = []
+        upload = client.train(data, labels, callback=lambda _upload:
+                              progress.append(_upload.progress))
+        # Doesn't wait for the upload, and forward requests get through in the mean time
+        self.assertEqual(client.forward([np.zeros((64, 64), dtype='float32')]).shape,
+                         (1, 1, 64, 64))
+        self.assertEqual(upload.result()['id'], 'TRAIN.RECEIVED')
+        self.assertEqual(progress, sorted(progress))
+        self.assertEqual(progress[-1], 1.)
+        self.assertEqual(client.pending_upload_bytes, 0)
+        (received_data, received_labels), = received
+        for expected, tensor in zip(data + labels, received_data + received_labels):
+            self.assertEqual(tensor.dtype, torch.float32)
+            np.testing.assert_array_equal(tensor.numpy(), expected)
+        client.shutdown()
+
+    def test_bad_requests(self):
+        client = self.make_client('shm')
+        chunk = {'id': 'TRAIN.CHUNK', 'upload': 0, 'len': 1, 'field': 'data', 'index': 0,
+                 'shape': [4], 'dtype': 'uint8', 'offset': 0}
+        for bad in [{'field': 'weights'}, {'index': 3}, {'offset': 2}, {'shape': [2]}]:
+            with self.assertRaises(RuntimeError):
+                client.submit(dict(chunk, **bad),
+                              {'handles': [torch.zeros(4, dtype=torch.uint8)]}).result()
+        with self.assertRaises(RuntimeError):
+            client.forward_reference(TikRef(os.path.join(self.directory, 'nope.npy')))
+        with self.assertRaises(RuntimeError):
+            client.set_hparams(['not', 'a', 'dict'])
+        # The server is still there for everyone
+        self.assertEqual(client.forward([np.zeros((64, 64), dtype='float32')]).shape,
+                         (1, 1, 64, 64))
+        client.shutdown()
+
+    def test_forward_reference(self):
+        client = self.make_client('zmq')
+        volume = np.random.uniform(size=(4, 96, 96)).astype('float32')
+        npy_path = os.path.join(self.directory, 'volume.npy')
+        np.save(npy_path, volume)
+        h5_path = os.path.join(self.directory, 'volume.h5')
+        with h5py.File(h5_path, 'w') as f:
+            f.create_dataset('raw', data=volume)
+        roi = [1, slice(0, 64), (32, 96)]
+        expected = client.forward([volume[1, :64, 32:]])
+        for reference in [TikRef(npy_path, roi), TikRef(h5_path, roi, dataset='raw')]:
+            np.testing.assert_allclose(client.forward_reference(reference), expected, rtol=1e-5)
+        client.shutdown()
+
+    def test_multiple_clients(self):
+        clients = [self.make_client('zmq') for _ in range(2)]
+        futures = [client.forward_async([np.ones((64, 64), dtype='float32')])
+                   for client in clients for _ in range(3)]
+        self.assertTrue(all(future.result().shape == (1, 1, 64, 64) for future in futures))
+        # One client leaving doesn't take the server down
+        clients[0].shutdown()
+        self.assertEqual(clients[1].forward([np.ones((64, 64), dtype='float32')]).shape,
+                         (1, 1, 64, 64))
+        clients[1].shutdown()
+
+
+class TcpRoundTripTest(ServerTestCase):
+    def make_endpoint(self):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        return f'tcp://127.0.0.1:{port}'
+
+    def _test_round_trip(self, transport):
+        clients = [self.make_client(transport) for _ in range(2)]
+        for client in clients:
+            self.assertEqual(client.async_client._transport.name, transport)
+        process_tensor = self.server.handler.process_tensor
+        def slow_process_tensor(tensor):
+            time.sleep(0.01)
+            return process_tensor(tensor)
+        self.server.handler.process_tensor = slow_process_tensor
+        # 64 blocks, so still running (or waiting) when it's cancelled
+        doomed = clients[0].forward_async([np.zeros((256, 256), dtype='float32')])
+        inputs = [[np.random.uniform(size=(64, 64)).astype('float32') for _ in range(2)]
+                  for _ in range(3)]
+        # Both clients have requests in flight at the same time
+        futures = [(_inputs, client.forward_async(_inputs))
+                   for _inputs in inputs for client in clients]
+        doomed.cancel()
+        for _inputs, future in futures:
+            expected = self.server.model(torch.from_numpy(np.stack(_inputs)[:, None]))
+            np.testing.assert_allclose(future.result(), expected.detach().numpy(), rtol=1e-5)
+        self.assertTrue(doomed.cancelled())
+        # The session that cancelled carries on
+        self.assertEqual(clients[0].forward([np.ones((64, 64), dtype='float32')]).shape,
+                         (1, 1, 64, 64))
+        for client in clients:
+            client.shutdown()
+
+    def test_round_trip_zmq(self):
+        self._test_round_trip('zmq')
+
+    def test_round_trip_shm(self):
+        self._test_round_trip('shm')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,9 @@
 import os
+import shutil
+import tempfile
+import time
 import unittest
+from unittest import mock
 import h5py
 import logging
 from importlib import util as imputils
@@ -7,6 +11,7 @@ import torch
 import torch.nn as nn
 from tiktorch.device_handler import ModelHandler
 from tiktorch.blockinator import Blockinator
+from tiktorch.cache import ResultCache, CapacityCache, CompiledModelCache
 import os
 os.environ['CUDA_VISIBLE_DEVICES'] = '0'
 
@@ -111,7 +116,218 @@ class HaloTest(unittest.TestCase):
         halo_in_blocks = self.handler.halo_in_blocks
         print(f"Halo: {halo}")
         print(f"Halo in blocks: {halo_in_blocks}")
+        self.assertEqual(halo, [4, 4])
+        self.assertEqual(self.handler.output_offset, [4, 4])
+        self.assertEqual(halo_in_blocks, [1, 1])
+
+    def test_no_seams(self):
+        # Padded convolutions don't shrink the output, but still need context
+        handler = ModelHandler(model=nn.Sequential(nn.Conv2d(1, 4, 5, padding=2),
+                                                   nn.MaxPool2d(2),
+                                                   nn.Conv2d(4, 1, 3, padding=1),
+                                                   nn.Upsample(scale_factor=2)),
+                               channels=1,
+                               device_names='cpu',
+                               dynamic_shape_code='(16 * (nH + 1), 16 * (nW + 1))')
+        self.assertEqual(handler.output_offset, [0, 0])
+        self.assertGreater(min(handler.halo), 2)
+        input_tensor = torch.rand(1, 1, 96, 80)
+        expected = handler.forward(input_tensor)
+        # Too big to process at once, so it goes block by block
+        process_tensor = handler.process_tensor
+        def blockwise_process_tensor(tensor):
+            if tensor.shape[-1] > 48:
+                raise RuntimeError
+            return process_tensor(tensor)
+        handler.process_tensor = blockwise_process_tensor
+        self.assertTrue(torch.allclose(handler.forward(input_tensor), expected, atol=1e-6))
+
+
+class ForwardTilesTest(unittest.TestCase):
+    def test_tiles_cover_output(self):
+        handler = ModelHandler(model=nn.Conv2d(1, 1, 1),
+                               channels=1,
+                               device_names='cpu',
+                               dynamic_shape_code='(32 * (nH + 1), 32 * (nW + 1))')
+        input_tensor = torch.rand(1, 1, 96, 64)
+        output = torch.zeros(1, 1, 96, 64)
+        tiles = list(handler.forward_tiles(input_tensor, tile_shape=[64, 64]))
+        self.assertEqual([slices for slices, _ in tiles],
+                         [(slice(0, 64), slice(0, 64)), (slice(64, 96), slice(0, 64))])
+        for slices, tile in tiles:
+            output[(slice(None), slice(None)) + slices] = tile
+        self.assertTrue(torch.allclose(output, handler.forward(input_tensor)))
+
+
+class ResultCacheTest(unittest.TestCase):
+    def test_forward_hits_cache(self):
+        handler = ModelHandler(model=nn.Conv2d(1, 1, 1),
+                               channels=1,
+                               device_names='cpu',
+                               dynamic_shape_code='(32 * (nH + 1), 32 * (nW + 1))')
+        handler.result_cache = ResultCache(max_bytes=2 ** 20)
+        processed = []
+        process_tensor = handler.process_tensor
+        handler.process_tensor = lambda tensor: processed.append(len(tensor)) or \
+            process_tensor(tensor)
+        known, new = torch.rand(2, 1, 1, 32, 32)
+        handler.forward(known)
+        # Only the new sample gets processed, and then neither
+        output = handler.forward(torch.cat([new, known]))
+        self.assertTrue(torch.equal(handler.forward(torch.cat([known, new])), output.flip(0)))
+        self.assertEqual(processed, [1, 1])
+        expected = handler._forward(torch.cat([new, known]))
+        self.assertTrue(torch.allclose(output, expected))
+
+class CapacityCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.state_dict = nn.Conv2d(1, 1, 3, padding=1).state_dict()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_handler(self):
+        model = nn.Conv2d(1, 1, 3, padding=1)
+        model.load_state_dict(self.state_dict)
+        handler = ModelHandler(model=model,
+                               channels=1,
+                               device_names='cpu',
+                               dynamic_shape_code='(32 * (nH + 1), 32 * (nW + 1))')
+        handler.capacity_cache = CapacityCache(self.directory)
+        trial_runs = []
+        try_running_on_blocksize = handler._try_running_on_blocksize
+        handler._try_running_on_blocksize = lambda *block_size, **kwargs: \
+            trial_runs.append(block_size) or try_running_on_blocksize(*block_size, **kwargs)
+        return handler, trial_runs
+
+    def test_dry_run_skipped(self):
+        handler, trial_runs = self.make_handler()
+        shape = handler.binary_dry_run([128, 128])
+        self.assertGreater(len(trial_runs), 0)
+        # A restarted server with the same model and weights doesn't probe the device again
+        handler, trial_runs = self.make_handler()
+        self.assertEqual(handler.binary_dry_run([128, 128]), shape)
+        self.assertEqual(trial_runs, [])
+        # ... but training mode or new weights do
+        handler.binary_dry_run([128, 128], train_flag=True)
+        self.assertGreater(len(trial_runs), 0)
+        handler, trial_runs = self.make_handler()
+        with torch.no_grad():
+            handler.model.weight.add_(1)
+        handler.binary_dry_run([128, 128])
+        self.assertGreater(len(trial_runs), 0)
+
+    def test_tuned_tile(self):
+        handler, _ = self.make_handler()
+        handler.binary_dry_run([128, 128])
+        batch_size, tile_blocks = handler.tile_batch_size(), handler.tile_blocks()
+        self.assertLessEqual(max(tile_blocks), 2)
+        # Stored along with the capacity
+        handler, _ = self.make_handler()
+        handler.tune_tile = lambda *args, **kwargs: self.fail("Tuned again")
+        handler.binary_dry_run([128, 128])
+        self.assertEqual((handler.tile_batch_size(), handler.tile_blocks()),
+                         (batch_size, tile_blocks))
+        # Batches of tiles come out the same as one at a time
+        input_tensor = torch.rand(2, 1, 192, 160)
+        expected = handler.forward(input_tensor)
+        handler._tuned_tiles[0] = (3, [1, 1])
+        process_tensor = handler.process_tensor
+        batch_sizes = []
+        def blockwise_process_tensor(tensor):
+            if tensor.shape[-1] > 96:
+                raise RuntimeError
+            batch_sizes.append(len(tensor))
+            return process_tensor(tensor)
+        handler.process_tensor = blockwise_process_tensor
+        self.assertTrue(torch.allclose(handler.forward(input_tensor), expected, atol=1e-6))
+        self.assertEqual(max(batch_sizes), 6)
+
+
+class MemoryEstimateTest(unittest.TestCase):
+    def test_single_trial_run(self):
+        handler = ModelHandler(model=nn.Conv2d(1, 1, 3, padding=1),
+                               channels=1,
+                               device_names='cpu',
+                               dynamic_shape_code='(32 * (nH + 1), 32 * (nW + 1))')
+        trial_runs = []
+        trial_run_successful = handler._trial_run_successful
+        handler._trial_run_successful = lambda *shape, **kwargs: \
+            trial_runs.append(shape) or trial_run_successful(*shape, **kwargs)
+        self.assertEqual(handler.binary_dry_run([128, 128]), [128, 128])
+        # Only the predicted capacity is confirmed
+        self.assertEqual(trial_runs, [(1, 128, 128)])
+        # Predictions that don't hold fall back to trial runs
+        handler._memory_models[0].predict = lambda *args, **kwargs: 0
+        handler._trial_run_successful = lambda *shape, **kwargs: \
+            trial_runs.append(shape) or max(shape[1:]) <= 64
+        self.assertLessEqual(max(handler.binary_dry_run([128, 128])), 64)
+        self.assertIsNone(handler._memory_models[0])
+
+
+class MultiDeviceTest(unittest.TestCase):
+    def test_tiles_on_all_devices(self):
+        handler = ModelHandler(model=nn.Conv2d(1, 2, 3, padding=1),
+                               channels=1,
+                               device_names=['cpu', 'cpu'],
+                               dynamic_shape_code='(16 * (nH + 1), 16 * (nW + 1))')
+        input_tensor = torch.rand(1, 1, 128, 128)
+        expected = handler.forward(input_tensor)
+        self.assertEqual(expected.shape, (1, 2, 96, 96))
+        process_tensor = handler.process_tensor
+        tiles_per_device = [0, 0]
+        def blockwise_process_tensor(tensor, device_id=0):
+            if tensor.shape[-1] > 48:
+                raise RuntimeError
+            # The first device is slow, so the second one steals its tiles
+            time.sleep(0.02 if device_id == 0 else 0)
+            tiles_per_device[device_id] += 1
+            return process_tensor(tensor, device_id=device_id)
+        handler.process_tensor = blockwise_process_tensor
+        self.assertTrue(torch.allclose(handler.forward(input_tensor), expected, atol=1e-6))
+        self.assertEqual(sum(tiles_per_device), 36)
+        self.assertGreater(tiles_per_device[1], tiles_per_device[0])
+        # Replicas follow the weights
+        with torch.no_grad():
+            handler.model.weight.add_(1)
+        handler._model_version += 1
+        self.assertTrue(torch.equal(handler.replica(1).weight, handler.model.weight))
+
+
+class CompiledModelTest(unittest.TestCase):
+    def test_frequent_shapes_compiled(self):
+        directory = tempfile.mkdtemp()
+        try:
+            handler = ModelHandler(model=nn.Conv2d(1, 1, 3, padding=1),
+                                   channels=1,
+                                   device_names='cpu',
+                                   dynamic_shape_code='(32 * (nH + 1), 32 * (nW + 1))')
+            handler.compiled_models = CompiledModelCache(directory)
+            input_tensor = torch.rand(1, 1, 32, 32)
+            expected = handler.model(input_tensor).detach()
+            for num_compiled in [0, 1, 1]:
+                self.assertTrue(torch.allclose(handler.process_tensor(input_tensor), expected,
+                                               atol=1e-6))
+                self.assertEqual(len(handler.compiled_models), num_compiled)
+            # New weights, new module
+            with torch.no_grad():
+                handler.model.weight.add_(1)
+            handler._model_version += 1
+            self.assertTrue(torch.allclose(handler.process_tensor(input_tensor),
+                                           handler.model(input_tensor), atol=1e-6))
+            # Nothing is hashed or compiled while training changes the weights
+            with mock.patch.object(ModelHandler, 'weights_settled', new_callable=mock.PropertyMock,
+                                   return_value=False), \
+                    mock.patch.object(handler.compiled_models, 'get') as get:
+                handler._model_version += 1
+                for _ in range(ModelHandler.COMPILE_AFTER):
+                    self.assertTrue(torch.allclose(handler.process_tensor(input_tensor),
+                                                   handler.model(input_tensor), atol=1e-6))
+                get.assert_not_called()
+        finally:
+            shutil.rmtree(directory)
+
 
-        
 if __name__ == '__main__':
     unittest.main()
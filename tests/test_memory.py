@@ -0,0 +1,57 @@
+import unittest
+
+import torch
+import torch.nn as nn
+
+from tiktorch.memory import ActivationMemoryModel
+from tiktorch.utils import DynamicShape
+
+
+class ActivationMemoryModelTest(unittest.TestCase):
+    def test_predict(self):
+        model = nn.Sequential(nn.Conv2d(1, 8, 3), nn.ReLU(), nn.Conv2d(8, 1, 3))
+        dynamic_shape = DynamicShape('(32 * (nH + 1), 32 * (nW + 1))')
+        memory_model = ActivationMemoryModel.calibrate(model, 1, dynamic_shape, 'cpu')
+        # Extrapolated well beyond the calibration shapes
+        input_bytes = 4 * 128 * 192
+        hidden_bytes = 4 * 8 * 126 * 190
+        # The ReLU's input and output are the peak
+        self.assertEqual(memory_model.predict([3, 5]), input_bytes + 2 * hidden_bytes)
+        parameter_bytes = 4 * sum(p.numel() for p in model.parameters())
+        self.assertEqual(memory_model.predict([3, 5], train=True),
+                         input_bytes + parameter_bytes + 2 * hidden_bytes + 4 * 124 * 188)
+
+    def test_skip_connection(self):
+        class SkipNet(nn.Module):
+            def __init__(self):
+                super().__init__()
+                self.encode = nn.Conv2d(1, 8, 3, padding=1)
+                self.pool = nn.MaxPool2d(2)
+                self.up = nn.Upsample(scale_factor=2)
+                self.decode = nn.Conv2d(16, 1, 3, padding=1)
+
+            def forward(self, x):
+                skip = self.encode(x)
+                x = self.up(self.pool(skip))
+                return self.decode(torch.cat([skip, x], dim=1))
+
+        dynamic_shape = DynamicShape('(32 * (nH + 1), 32 * (nW + 1))')
+        memory_model = ActivationMemoryModel.calibrate(SkipNet(), 1, dynamic_shape, 'cpu')
+        pixels = 128 * 192
+        # The encoder output is still around when the decoder runs, along with the upsampled
+        # features, their concatenation and the output
+        self.assertEqual(memory_model.predict([3, 5]), 4 * pixels * (1 + 8 + 8 + 16 + 1))
+
+    def test_non_spatial_outputs(self):
+        model = nn.Sequential(nn.Conv3d(1, 2, 1), nn.Flatten())
+        dynamic_shape = DynamicShape('(8 * (nD + 1), 8 * (nH + 1), 8 * (nW + 1))')
+        memory_model = ActivationMemoryModel.calibrate(model, 1, dynamic_shape, 'cpu')
+        # Input, conv output and flattened output all grow with the input volume
+        volume_increase = 16 ** 3 - 8 ** 3
+        self.assertEqual(memory_model.predict([1, 1, 1], train=True) -
+                         memory_model.predict([0, 0, 0], train=True),
+                         4 * (1 + 2 + 2) * volume_increase)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import unittest
+from unittest import mock
+
+import torch
+import torch.nn as nn
+
+from tiktorch.device_handler import ModelHandler
+from tiktorch.precision import INFERENCE_MODES, prepare_inference_mode, relative_error
+
+
+class InferenceModeTest(unittest.TestCase):
+    def setUp(self):
+        self.model = nn.Sequential(nn.Conv2d(1, 8, 3, padding=1), nn.ReLU(),
+                                   nn.Conv2d(8, 1, 3, padding=1))
+        self.sample = torch.rand(1, 1, 64, 64)
+        with torch.no_grad():
+            self.expected = self.model(self.sample)
+
+    def test_modes(self):
+        for mode in INFERENCE_MODES:
+            run = prepare_inference_mode(mode, self.model, self.sample)
+            self.assertIsNotNone(run, mode)
+            with torch.no_grad():
+                output = run(torch.cat([self.sample, self.sample]))
+            self.assertEqual(output.dtype, torch.float32)
+            self.assertLess(relative_error(output[:1], self.expected), 0.05, mode)
+
+    def test_model_untouched(self):
+        weight = self.model[0].weight
+        for mode in INFERENCE_MODES:
+            prepare_inference_mode(mode, self.model, self.sample)
+            self.assertIs(self.model[0].weight, weight)
+            self.assertTrue(weight.is_contiguous())
+
+    def test_accuracy_check(self):
+        with mock.patch.dict('tiktorch.precision.TOLERANCES', {'int8': 0.}):
+            self.assertIsNone(prepare_inference_mode('int8', self.model, self.sample))
+
+    def test_handler(self):
+        handler = ModelHandler(model=self.model,
+                               channels=1,
+                               device_names='cpu',
+                               dynamic_shape_code='(32 * (nH + 1), 32 * (nW + 1))')
+        handler.inference_mode = 'bfloat16'
+        with torch.no_grad():
+            output = handler.process_tensor(self.sample)
+        self.assertEqual(output.dtype, torch.float32)
+        self.assertLess(relative_error(output, self.expected), 0.02)
+        self.assertIsNotNone(handler._mode_runners[0][1])
+        # While training publishes new weights, tiles run in float32 instead of recalibrating
+        with mock.patch.object(ModelHandler, 'weights_settled', new_callable=mock.PropertyMock,
+                               return_value=False):
+            with torch.no_grad():
+                handler.model[0].bias.add_(1)
+                handler._model_version += 1
+                output = handler.process_tensor(self.sample)
+                self.assertTrue(torch.equal(output, handler.model(self.sample)))
+        self.assertEqual(handler._mode_runners[0][0], handler.model_version - 1)
+        # and the mode comes back once the weights are settled
+        with torch.no_grad():
+            handler.process_tensor(self.sample)
+        self.assertEqual(handler._mode_runners[0][0], handler.model_version)
+        with self.assertRaises(ValueError):
+            handler.inference_mode = 'float8'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import unittest
+
+from tiktorch.scheduler import Job, RequestScheduler
+
+
+class RequestSchedulerTest(unittest.TestCase):
+    def test_round_robin(self):
+        scheduler = RequestScheduler()
+        for rid in range(3):
+            scheduler.put(b'a', Job(('a', rid), None))
+        scheduler.put(b'b', Job(('b', 0), None))
+        scheduler.put(b'b', Job(('b', 1), None))
+        order = [scheduler.get()[1].rid for _ in range(5)]
+        # Client b doesn't have to wait for all of a's jobs, and each client is served in order
+        self.assertEqual(order, [('a', 0), ('b', 0), ('a', 1), ('b', 1), ('a', 2)])
+
+    def test_drop_and_close(self):
+        scheduler = RequestScheduler()
+        job_a, job_b = Job('a', None), Job('b', None)
+        scheduler.put(b'a', job_a)
+        scheduler.put(b'b', job_b)
+        self.assertEqual(scheduler.drop(b'a'), [job_a])
+        scheduler.close()
+        # Closing still hands out what's left
+        self.assertEqual(scheduler.get(), (b'b', job_b))
+        self.assertIsNone(scheduler.get())
+
+    def test_collect(self):
+        scheduler = RequestScheduler()
+        job = Job(0, None, batch_key='64x64', batch_size=2)
+        scheduler.put(b'a', Job(1, None, batch_key='64x64', batch_size=2))
+        scheduler.put(b'a', Job(2, None, batch_key='32x32', batch_size=2))
+        scheduler.put(b'b', Job(3, None, batch_key='64x64', batch_size=2))
+        scheduler.put(b'b', Job(4, None, batch_key='64x64', batch_size=2))
+        # Only jobs with a matching key are collected, up to the maximum number of samples
+        collected = scheduler.collect(job.batch_key, max_batch_size=4, max_delay=0.01)
+        self.assertEqual([(client, job.rid) for client, job in collected], [(b'a', 1), (b'b', 3)])
+        self.assertEqual(len(scheduler), 2)
+
+    def test_priority(self):
+        scheduler = RequestScheduler()
+        scheduler.put(b'a', Job(0, None, priority=0))
+        scheduler.put(b'a', Job(1, None, priority=1))
+        scheduler.put(b'b', Job(2, None, priority=1))
+        self.assertEqual([scheduler.get()[1].rid for _ in range(3)], [1, 2, 0])
+
+    def test_cancel(self):
+        scheduler = RequestScheduler()
+        scheduler.put(b'a', Job(0, None))
+        scheduler.put(b'a', Job(1, None))
+        client, running = scheduler.get()
+        # Pending jobs are taken out, running ones are flagged
+        self.assertEqual(scheduler.cancel(b'a', 1).rid, 1)
+        self.assertIsNone(scheduler.cancel(b'a', 0))
+        self.assertTrue(running.cancelled.is_set())
+        self.assertEqual(len(scheduler), 0)
+        scheduler.done(client, running)
+        self.assertIsNone(scheduler.cancel(b'a', 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
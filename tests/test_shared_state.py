@@ -0,0 +1,48 @@
+import unittest
+
+import torch
+import torch.nn as nn
+
+from tiktorch.shared_state import SharedState, bind_state
+
+
+class SharedStateTest(unittest.TestCase):
+    def setUp(self):
+        self.trained = nn.Sequential(nn.Conv2d(1, 2, 3), nn.BatchNorm2d(2))
+        self.model = nn.Sequential(nn.Conv2d(1, 2, 3), nn.BatchNorm2d(2))
+        self.shared_state = SharedState(self.trained.state_dict())
+
+    def test_claim(self):
+        # Nothing newer than the initial state
+        self.assertIsNone(self.shared_state.claim(0))
+        self.shared_state.publish(self.trained.state_dict(), 3)
+        version, state = self.shared_state.claim(0)
+        self.assertEqual(version, 3)
+        self.assertIsNone(self.shared_state.claim(3))
+        bind_state(self.model, state)
+        # No copies: the model runs on the shared tensors
+        for key, value in self.model.state_dict().items():
+            self.assertEqual(value.data_ptr(), state[key].data_ptr())
+        input_tensor = torch.rand(1, 1, 8, 8)
+        self.trained.eval()
+        self.model.eval()
+        torch.testing.assert_close(self.model(input_tensor), self.trained(input_tensor))
+
+    def test_writer_leaves_claimed_copy_alone(self):
+        self.shared_state.publish(self.trained.state_dict(), 1)
+        version, state = self.shared_state.claim(0)
+        bind_state(self.model, state)
+        weight = self.model[0].weight.clone()
+        # Publishing (more than once, without claims in between) only goes to the other copy
+        for version in (2, 3):
+            with torch.no_grad():
+                self.trained[0].weight.add_(1.)
+            self.shared_state.publish(self.trained.state_dict(), version)
+        self.assertTrue(torch.equal(self.model[0].weight, weight))
+        version, state = self.shared_state.claim(1)
+        self.assertEqual(version, 3)
+        self.assertTrue(torch.equal(state['0.weight'], self.trained[0].weight))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,14 @@
 import numpy as np
 import logging
+import os
+import shutil
+import tempfile
 import unittest
 
 from tiktorch.wrapper import TikTorch
+from tiktorch.device_handler import ModelHandler
+import tiktorch.utils as utils
+import torch
 import torch.nn as nn
 import time
 
@@ -57,5 +63,117 @@ class TestTrainy(unittest.TestCase):
         self.tiktorch.handler.stop_training()
 
 
+MODEL_FILE = """
+import torch.nn as nn
+
+class Model(nn.Sequential):
+    def __init__(self):
+        super().__init__(nn.Conv2d(1, 4, 3, padding=1), nn.ReLU(), nn.Conv2d(4, 1, 1))
+"""
+
+
+class Unaugmented(object):
+    # Skips the augmentations, only to not wait on them
+    def __call__(self, data, labels):
+        return data, labels, torch.ones_like(labels)
+
+
+class StateSyncTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        model_file_name = os.path.join(self.directory, 'model.py')
+        with open(model_file_name, 'w') as f:
+            f.write(MODEL_FILE)
+        model = utils.define_patched_model(model_file_name, 'Model', {})
+        self.handler = ModelHandler(model=model, channels=1, device_names='cpu',
+                                    dynamic_shape_code='(32 * (nH + 1), 32 * (nW + 1))')
+        self.handler.trainer._augmentor = Unaugmented()
+        self.handler.trainer.max_state_staleness = 0.1
+
+    def tearDown(self):
+        self.handler.stop_training()
+        shutil.rmtree(self.directory)
+
+    def train(self):
+        data = [torch.rand(1, 32, 32) for _ in range(2)]
+        labels = [torch.randint(0, 2, (1, 32, 32)).float() for _ in range(2)]
+        self.handler.train(data, labels)
+
+    def wait_for_update(self, timeout=30):
+        start = time.time()
+        while time.time() - start < timeout:
+            if self.handler.trainer.update_handler_model_state():
+                return True
+            time.sleep(0.05)
+        return False
+
+    def test_versions(self):
+        trainer = self.handler.trainer
+        # Nothing published yet, and that doesn't hold anyone up
+        trainer.ensure_ignited()
+        start = time.time()
+        self.assertFalse(trainer.update_handler_model_state())
+        self.assertLess(time.time() - start, 0.5)
+        self.train()
+        self.assertTrue(self.wait_for_update())
+        version = trainer.state_version
+        self.assertGreater(version, 0)
+        # Published weights are what the training process had, not a view on them
+        weights = [p.clone() for p in self.handler.model.parameters()]
+        time.sleep(0.2)
+        self.assertTrue(all(torch.equal(p, w)
+                            for p, w in zip(self.handler.model.parameters(), weights)))
+        # Newer versions keep coming while training goes on
+        self.assertTrue(self.wait_for_update())
+        self.assertGreater(trainer.state_version, version)
+
+    @unittest.skipUnless(os.path.exists('/proc/self/stat'), "Needs /proc.")
+    def test_idle(self):
+        trainer = self.handler.trainer
+        trainer.ensure_ignited()
+        def cpu_seconds():
+            with open(f'/proc/{trainer._training_process.pid}/stat') as f:
+                utime, stime = f.read().rsplit(')', 1)[1].split()[11:13]
+            return (int(utime) + int(stime)) / os.sysconf('SC_CLK_TCK')
+        # With nothing to do (once it's set up), the training process sleeps instead of polling
+        time.sleep(3)
+        start = cpu_seconds()
+        time.sleep(1)
+        self.assertLess(cpu_seconds() - start, 0.05)
+        # ... but doesn't take long to wake up
+        self.train()
+        self.assertTrue(self.wait_for_update(timeout=5))
+        start = time.time()
+        self.handler.stop_training()
+        self.assertLess(time.time() - start, 5)
+        self.assertFalse(self.handler.training_process_is_alive())
+
+    def test_stats(self):
+        trainer = self.handler.trainer
+        self.assertIsNone(trainer.training_stats())
+        self.train()
+        self.assertTrue(self.wait_for_update())
+        trainer.pause()
+        time.sleep(1.5)
+        stats = trainer.training_stats()
+        self.assertGreater(stats['iteration'], 0)
+        self.assertEqual(set(stats['update_norms']),
+                         {name for name, _ in self.handler.model.named_parameters()})
+        self.assertTrue(any(norm > 0 for norm in stats['update_norms'].values()))
+        # Paused, so everything was published and nothing moved since
+        self.assertEqual(stats['published_version'], stats['iteration'])
+        self.assertTrue(all(drift == 0 for drift in stats['drift'].values()))
+
+    def test_pause(self):
+        trainer = self.handler.trainer
+        self.train()
+        self.assertTrue(self.wait_for_update())
+        trainer.pause()
+        # The last iterations before the pause get published too, and then nothing
+        time.sleep(1.5)
+        trainer.update_handler_model_state()
+        self.assertFalse(self.wait_for_update(timeout=1.5))
+
+
 if __name__ == '__main__':
     unittest.main()
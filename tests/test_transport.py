@@ -0,0 +1,93 @@
+import unittest
+import tempfile
+import shutil
+
+import numpy as np
+import torch
+
+from tiktorch.transport import FrameTransport, SharedMemoryRing, shm_probe, shm_probe_visible, \
+    encode_output, decode_output
+
+
+class SharedMemoryRingTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.writer = SharedMemoryRing(num_slots=2, directory=self.directory)
+        self.reader = SharedMemoryRing(directory=self.directory)
+
+    def tearDown(self):
+        self.reader.close()
+        self.writer.close()
+        shutil.rmtree(self.directory)
+
+    def test_roundtrip(self):
+        tensor = torch.rand(2, 1, 32, 32)
+        handle = self.writer.put(tensor)
+        received = self.reader.get(handle)
+        self.assertEqual(received.dtype, torch.float32)
+        self.assertTrue(torch.equal(received, tensor))
+
+    def test_native_dtype(self):
+        tensor = torch.from_numpy(np.random.randint(0, 255, size=(1, 64, 64)).astype('uint8'))
+        received = self.reader.get(self.writer.put(tensor), copy=True)
+        self.assertEqual(received.dtype, torch.uint8)
+        self.assertTrue(torch.equal(received, tensor))
+
+    def test_slot_reuse_and_growth(self):
+        handle = self.writer.put(torch.rand(8))
+        self.writer.release(handle)
+        # A larger tensor reuses (and grows) the released slot
+        tensor = torch.rand(128, 128)
+        big_handle = self.writer.put(tensor)
+        self.assertEqual(big_handle['path'], handle['path'])
+        self.assertTrue(torch.equal(self.reader.get(big_handle), tensor))
+        # Slots in use are not handed out twice
+        other_handle = self.writer.put(torch.rand(8))
+        self.assertNotEqual(other_handle['path'], big_handle['path'])
+
+    def test_probe(self):
+        probe = shm_probe(self.directory)
+        self.assertTrue(shm_probe_visible(probe))
+        self.assertFalse(shm_probe_visible(probe + '-nope'))
+
+
+class FrameTransportTest(unittest.TestCase):
+    def test_roundtrip(self):
+        transport = FrameTransport()
+        frames = []
+        tensors = [torch.rand(1, 1, 16, 16), torch.arange(10, dtype=torch.int64)]
+        handles = [transport.describe(tensor, frames) for tensor in tensors]
+        self.assertEqual(len(frames), 2)
+        # Frames go over the wire as raw buffers
+        frames = [bytes(frame) for frame in frames]
+        for handle, tensor in zip(handles, tensors):
+            received = transport.recv(handle, frames)
+            self.assertEqual(received.dtype, tensor.dtype)
+            self.assertTrue(torch.equal(received, tensor))
+
+    def test_compression(self):
+        transport = FrameTransport(compression='zlib')
+        frames = []
+        tensors = [torch.zeros(1, 64, 64, dtype=torch.uint8), torch.rand(4)]
+        handles = [transport.describe(tensor, frames) for tensor in tensors]
+        # Small frames aren't compressed
+        self.assertEqual(handles[0]['compression'], 'zlib')
+        self.assertNotIn('compression', handles[1])
+        self.assertLess(len(bytes(frames[0])), 64 * 64)
+        for handle, tensor in zip(handles, tensors):
+            self.assertTrue(torch.equal(transport.recv(handle, frames), tensor))
+
+
+class OutputEncodingTest(unittest.TestCase):
+    def test_encodings(self):
+        tensor = torch.rand(2, 1, 32, 32)
+        for dtype, atol in [('float32', 0), ('float16', 1e-3), ('uint8', 1 / 255)]:
+            encoded, encoding = encode_output(tensor, dtype)
+            self.assertEqual(encoded.dtype, getattr(torch, dtype))
+            decoded = decode_output(encoded, encoding)
+            self.assertEqual(decoded.dtype, torch.float32)
+            np.testing.assert_allclose(decoded.numpy(), tensor.numpy(), atol=atol)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+
+import torch
+import torch.nn as nn
+
+from tiktorch.device_handler import ModelHandler
+from tiktorch.workers import CPUWorkerPool, autotune_cpu_workers, available_cores
+
+
+class CPUWorkerPoolTest(unittest.TestCase):
+    def test_process_tensor(self):
+        model = nn.Conv2d(1, 1, 3)
+        pool = CPUWorkerPool(model, num_workers=2, threads_per_worker=1,
+                             cores=[available_cores()[0]] * 2)
+        try:
+            input_tensor = torch.rand(1, 1, 32, 32)
+            for worker_id in range(2):
+                self.assertTrue(torch.allclose(pool.process_tensor(input_tensor, worker_id),
+                                               model(input_tensor), atol=1e-6))
+            # New weights reach the workers
+            with torch.no_grad():
+                model.weight.add_(1)
+            pool.update_state(model.state_dict())
+            self.assertTrue(torch.allclose(pool.process_tensor(input_tensor, 1),
+                                           model(input_tensor), atol=1e-6))
+            # Errors in the workers come back as such
+            with self.assertRaises(RuntimeError):
+                pool.process_tensor(torch.rand(1, 2, 32, 32))
+        finally:
+            pool.close()
+
+    def test_dead_worker(self):
+        pool = CPUWorkerPool(nn.Conv2d(1, 1, 3), num_workers=1, threads_per_worker=1,
+                             cores=[available_cores()[0]])
+        try:
+            pool._processes[0].terminate()
+            pool._processes[0].join()
+            with self.assertRaises(CPUWorkerPool.WorkerDied):
+                pool.process_tensor(torch.rand(1, 1, 32, 32))
+        finally:
+            pool.close()
+
+    def test_autotune(self):
+        num_workers, threads_per_worker = autotune_cpu_workers(nn.Conv2d(1, 1, 3),
+                                                               [1, 1, 32, 32], cores=[0, 1])
+        self.assertIn((num_workers, threads_per_worker), [(2, 1), (1, 2)])
+
+    def test_handler(self):
+        handler = ModelHandler(model=nn.Conv2d(1, 1, 3, padding=1),
+                               channels=1,
+                               device_names='cpu',
+                               dynamic_shape_code='(16 * (nH + 1), 16 * (nW + 1))')
+        input_tensor = torch.rand(1, 1, 96, 96)
+        expected = handler.forward(input_tensor)
+        # Workers only run float32
+        handler.inference_mode = 'bfloat16'
+        with self.assertRaises(ValueError):
+            handler.start_cpu_workers(2, 1, cores=[available_cores()[0]] * 2)
+        handler.inference_mode = 'float32'
+        handler.start_cpu_workers(2, 1, cores=[available_cores()[0]] * 2)
+        try:
+            self.assertEqual(handler.num_parallel_jobs, 2)
+            self.assertTrue(torch.allclose(handler.forward(input_tensor), expected, atol=1e-6))
+            # Without its workers, the handler runs the model itself, whichever worker died
+            # (and even if the other one's tiles are still on their way)
+            for worker_id in (0, 1):
+                handler.start_cpu_workers(2, 1, cores=[available_cores()[0]] * 2)
+                handler._cpu_workers._processes[worker_id].terminate()
+                self.assertTrue(torch.allclose(handler.forward(input_tensor + worker_id),
+                                               handler.model(input_tensor + worker_id),
+                                               atol=1e-6))
+                self.assertEqual(handler.num_parallel_jobs, 1)
+            # Tiles still addressed to a worker after the pool is gone
+            self.assertTrue(torch.allclose(handler.process_tensor(input_tensor, device_id=1),
+                                           handler.model(input_tensor), atol=1e-6))
+        finally:
+            handler.stop_cpu_workers()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,6 +4,9 @@ import torch.nn.functional as thf
 from tiktorch.utils import DynamicShape
 from contextlib import contextmanager
 from functools import reduce
+from itertools import product
+from collections import deque
+import threading as thr
 import logging
 
 logger = logging.getLogger('Blockinator')
@@ -71,6 +74,10 @@ class slicey(object):
 
 
 class Blockinator(object):
+
+    class Cancelled(Exception):
+        pass
+
     def __init__(self, data, base_shape, num_channel_axes=0,
                  pad_fn=(lambda tensor, padding: tensor)):
         """
@@ -181,39 +188,162 @@ class Blockinator(object):
     def __getitem__(self, item):
         return self.fetch(item)
 
-    def process(self):
-        # try to process the whole thing at once
+    def process(self, cancelled=None):
+        """
+        Parameters
+        ----------
+        cancelled: callable
+            Checked before every block; if it returns True, processing stops with
+            `Blockinator.Cancelled`.
+        """
+        def check_cancelled():
+            if cancelled is not None and cancelled():
+                raise Blockinator.Cancelled
+        check_cancelled()
+        num_devices = max(getattr(self.processor, 'num_parallel_jobs', 1), 1)
+        # try to process the whole thing at once (if there's only one device to do it on anyway)
         # model = self.processor.model
         device = self.processor.device
-        try:
-            logger.info(f"Processing on {device}")
-            logger.info(f"Data shape is: {self.data.shape}")
-            with torch.no_grad():
-                output_tensor = self.processor.process_tensor(self.data).cpu()
-            return self.processor.crop_halo(output_tensor)
-        except:
-            RuntimeError("Tensor could not be processed at once. Processing blockwise....")
+        if num_devices == 1:
+            try:
+                logger.info(f"Processing on {device}")
+                logger.info(f"Data shape is: {self.data.shape}")
+                with torch.no_grad():
+                    output_tensor = self.processor.process_tensor(self.data).cpu()
+                return self.processor.crop_halo(output_tensor)
+            except:
+                RuntimeError("Tensor could not be processed at once. Processing blockwise....")
+
+        # if it does not work, process it tile by tile, on all devices the processor has
+        if hasattr(self.processor, 'tile_blocks'):
+            # Every device must be able to take every tile
+            tile_blocks = [min(_blocks) for _blocks in
+                           zip(*[self.processor.tile_blocks(device_id)
+                                 for device_id in range(num_devices)])]
+        else:
+            tile_blocks = 1
+        if hasattr(self.processor, 'tile_batch_size'):
+            batch_sizes = [self.processor.tile_batch_size(device_id)
+                           for device_id in range(num_devices)]
+        else:
+            batch_sizes = [1] * num_devices
+        output = {}
+        lock = thr.Lock()
+
+        def process_tiles(tiles, device_id):
+            # Tiles of the same shape go through as one batch; the ones at the far edges can be
+            # smaller, those go on their own.
+            batches = {}
+            for block_slices, slices in tiles:
+                input_tensor = self[block_slices]
+                batches.setdefault(tuple(input_tensor.shape), []).append((slices, input_tensor))
+            for batch in batches.values():
+                with torch.no_grad():
+                    input_tensor = torch.cat([_input_tensor for _, _input_tensor in batch])
+                    if num_devices == 1:
+                        out = self.processor.process_tensor(input_tensor)
+                    else:
+                        out = self.processor.process_tensor(input_tensor, device_id=device_id)
+                out = self.processor.crop_halo(out.cpu(), self.num_channel_axes)
+                with lock:
+                    if 'tensor' not in output:
+                        output['tensor'] = out.new_empty(
+                            (len(self.data),) + tuple(out.shape[1:self.num_channel_axes]) +
+                            self.output_spatial_shape)
+                # Tiles don't overlap, so no need to hold the lock while writing
+                for (slices, _), tile_out in zip(batch, out.split(len(self.data))):
+                    output['tensor'][(slice(None),) * self.num_channel_axes + slices] = tile_out
+
+        self._process_tiles(list(self._tile_slices(tile_blocks)), process_tiles, batch_sizes,
+                            check_cancelled)
+        return output['tensor']
 
-        # if it does not work, process it blockwise
+    @property
+    def output_spatial_shape(self):
+        halo = self.processor.halo_in_blocks
+        return tuple((_num_blocks - 2 * _halo) * _size
+                     for _num_blocks, _halo, _size in zip(self.num_blocks, halo, self.block_shape))
+
+    def _tile_slices(self, tile_blocks):
+        # Yields the tiles as (slices in blocks, slices in the output)
         halo = self.processor.halo_in_blocks
-        output_tensor = torch.empty_like(self.data).cpu()
-        
-        for i in range(halo[0], self.num_blocks[0] - halo[0]):
-            for j in range(halo[1], self.num_blocks[1] - halo[1]):
-                if len(self.num_blocks) == 3:
-                    for k in range(halo[2], self.num_blocks[2] - halo[2]):
-                        with torch.no_grad():
-                            out = self.processor.process_tensor(self[i, j, k]).cpu()
-                        out = self.processor.crop_halo(out, self.num_channel_axes)
-                        output_tensor[[slice(None)] * self.num_channel_axes +
-                                      [sl for sl in self.get_slice(i, j, k)]] = out
+        if isinstance(tile_blocks, int):
+            tile_blocks = [tile_blocks] * len(self.num_blocks)
+        ranges = [range(_halo, _num_blocks - _halo, _tile_blocks)
+                  for _halo, _num_blocks, _tile_blocks in zip(halo, self.num_blocks, tile_blocks)]
+        for starts in product(*ranges):
+            stops = [min(_start + _tile_blocks, _num_blocks - _halo)
+                     for _start, _tile_blocks, _num_blocks, _halo in zip(starts, tile_blocks,
+                                                                          self.num_blocks, halo)]
+            # The output is cropped by the halo (in blocks) on either side
+            yield (tuple(slice(_start, _stop) for _start, _stop in zip(starts, stops)),
+                   tuple(slice((_start - _halo) * _size, (_stop - _halo) * _size)
+                         for _start, _stop, _halo, _size in zip(starts, stops, halo,
+                                                                self.block_shape)))
+
+    @staticmethod
+    def _process_tiles(tiles, process_tiles, batch_sizes, check_cancelled):
+        # Workers take `batch_sizes[worker]` tiles at a time
+        num_workers = len(batch_sizes)
+        if num_workers == 1:
+            for start in range(0, len(tiles), batch_sizes[0]):
+                check_cancelled()
+                process_tiles(tiles[start:start + batch_sizes[0]], 0)
+            return
+        # Every worker starts on its own contiguous share of the tiles, and when it runs out,
+        # steals from the back of whoever has the most left.
+        queues = [deque(tiles[worker * len(tiles) // num_workers:
+                              (worker + 1) * len(tiles) // num_workers])
+                  for worker in range(num_workers)]
+        lock = thr.Lock()
+        failed = thr.Event()
+        errors = []
+
+        def next_tiles(worker):
+            with lock:
+                if queues[worker]:
+                    queue, pop = queues[worker], queues[worker].popleft
                 else:
-                    with torch.no_grad():
-                        out = self.processor.process_tensor(self[i, j]).cpu()
-                        out = self.processor.crop_halo(out, self.num_channel_axes)
-                        output_tensor[[slice(None)] * self.num_channel_axes +
-                                      [sl for sl in self.get_slice(i, j)]] = out
-        return self.processor.crop_output_tensor(output_tensor, self.num_channel_axes)
+                    queue = max(queues, key=len)
+                    pop = queue.pop
+                return [pop() for _ in range(min(batch_sizes[worker], len(queue)))]
+
+        def work(worker):
+            try:
+                while not failed.is_set():
+                    check_cancelled()
+                    tiles = next_tiles(worker)
+                    if not tiles:
+                        return
+                    process_tiles(tiles, worker)
+            except BaseException as e:
+                errors.append(e)
+                failed.set()
+
+        workers = [thr.Thread(target=work, args=(worker,), name=f'Blockinator-{worker}')
+                   for worker in range(num_workers)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if errors:
+            raise errors[0]
+
+    def tiles(self, tile_blocks=None):
+        """
+        Processes the data tile by tile and yields `(slices, output_tile)` as soon as a tile is
+        done, where `slices` (spatial) locate the tile in what `process` would have returned.
+
+        Parameters
+        ----------
+        tile_blocks: int or list
+            Size of a tile in blocks (per spatial axis). Defaults to a single block.
+        """
+        for block_slices, slices in self._tile_slices(1 if tile_blocks is None else tile_blocks):
+            with torch.no_grad():
+                out = self.processor.process_tensor(self[block_slices]).cpu()
+            out = self.processor.crop_halo(out, self.num_channel_axes)
+            yield slices, out
 
     @property
     def processor(self):
@@ -0,0 +1,334 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading as thr
+import warnings
+from collections import OrderedDict
+
+import torch
+import yaml
+
+
+def _content_hash(tensor):
+    array = tensor.detach().cpu().contiguous().numpy()
+    digest = hashlib.blake2b(array, digest_size=16)
+    digest.update(f"{array.shape}{array.dtype}".encode())
+    return digest.hexdigest()
+
+
+class ResultCache(object):
+    """
+    LRU cache for model outputs, bounded by the number of bytes it holds. Outputs are keyed by
+    a hash of the input along with the version of the model state that produced them, so
+    updating the weights invalidates everything without having to clear the cache.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        # Privates
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(tensor, version):
+        return _content_hash(tensor), version
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    def get(self, key):
+        tensor = self._entries.get(key)
+        if tensor is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return tensor
+
+    def put(self, key, tensor):
+        nbytes = self._size_of(tensor)
+        if nbytes > self.max_bytes:
+            # Would evict everything else
+            return self
+        if key in self._entries:
+            self._nbytes -= self._size_of(self._entries.pop(key))
+        self._entries[key] = tensor
+        self._nbytes += nbytes
+        while self._nbytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._nbytes -= self._size_of(evicted)
+        return self
+
+    @staticmethod
+    def _size_of(tensor):
+        return tensor.numel() * tensor.element_size()
+
+    def clear(self):
+        self._entries.clear()
+        self._nbytes = 0
+        return self
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return f"ResultCache({len(self)} entries, {self._nbytes}/{self.max_bytes} bytes, " \
+               f"{self.hits} hits, {self.misses} misses)"
+
+
+class SampleStore(object):
+    """
+    Training samples keyed by a hash of their data, so the same image sent again (say, with
+    edited labels) replaces its entry instead of being compared against all others. Holds at
+    most `max_samples`; the ones that were added (or trained on) longest ago go first.
+    """
+    def __init__(self, max_samples):
+        self.max_samples = max_samples
+        # Privates
+        # (data, labels, labels hash) by data hash, least recently used first
+        self._samples = OrderedDict()
+
+    def add(self, data, labels):
+        """
+        Adds a sample, or updates the labels of the one with the same data.
+        Returns False if the same sample (labels and all) was there already.
+        """
+        key = _content_hash(data)
+        labels_key = _content_hash(labels)
+        known = self._samples.get(key)
+        self._samples[key] = (data, labels, labels_key)
+        self._samples.move_to_end(key)
+        while len(self._samples) > self.max_samples:
+            self._samples.popitem(last=False)
+        return known is None or known[2] != labels_key
+
+    def next_sample(self):
+        """Returns the least recently used `(data, labels)`, which makes it the most recent."""
+        key, (data, labels, _) = next(iter(self._samples.items()))
+        self._samples.move_to_end(key)
+        return data, labels
+
+    def __len__(self):
+        return len(self._samples)
+
+    def __repr__(self):
+        return f"SampleStore({len(self)} of {self.max_samples} samples)"
+
+
+class CompiledModelCache(object):
+    """
+    TorchScript versions of a model, traced and frozen for one input shape and weights each, and
+    saved to disk so they survive restarts. Loaded modules are run through
+    `torch.jit.optimize_for_inference` (the result of which can't always be serialized).
+    """
+    FILE_EXTENSION = '.pt'
+
+    def __init__(self, directory, max_files=64):
+        self.directory = directory
+        self.max_files = max_files
+        # Privates
+        self._modules = {}
+        # Keys that could not be compiled (e.g. data dependent control flow)
+        self._failed = set()
+        self._lock = thr.Lock()
+
+    @staticmethod
+    def key(state_hash, input_shape, device):
+        parts = (state_hash, tuple(input_shape), str(device), torch.__version__)
+        return hashlib.blake2b(repr(parts).encode(), digest_size=16).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + self.FILE_EXTENSION)
+
+    def get(self, model, state_hash, input_shape, device, compile=True):
+        """
+        Returns the compiled module for `model` (with weights hashing to `state_hash`) and
+        inputs of shape `input_shape`, or None if the model can't be compiled. If `compile` is
+        False, only modules that were compiled before are returned.
+        """
+        key = self.key(state_hash, input_shape, device)
+        with self._lock:
+            if key in self._failed:
+                return None
+            module = self._modules.get(key)
+            if module is None and (compile or os.path.exists(self.path(key))):
+                module = self._load_or_compile(key, model, input_shape, device)
+            return module
+
+    def _load_or_compile(self, key, model, input_shape, device):
+        logger = logging.getLogger('CompiledModelCache._load_or_compile')
+        with warnings.catch_warnings():
+            # torch.jit is deprecated in favour of torch.compile, which doesn't serialize.
+            warnings.simplefilter('ignore', FutureWarning)
+            if os.path.exists(self.path(key)):
+                try:
+                    frozen = torch.jit.load(self.path(key), map_location=device)
+                except RuntimeError as e:
+                    logger.warning(f"Could not load {self.path(key)}, recompiling: {e}")
+                    frozen = None
+            else:
+                frozen = None
+            if frozen is None:
+                frozen = self._compile(model, input_shape, device)
+                if frozen is None:
+                    self._failed.add(key)
+                    return None
+                self._save(key, frozen)
+            module = torch.jit.optimize_for_inference(frozen)
+        self._modules[key] = module
+        return module
+
+    @staticmethod
+    def _compile(model, input_shape, device):
+        logger = logging.getLogger('CompiledModelCache._compile')
+        logger.info(f"Compiling model for input shape {list(input_shape)} on {device}.")
+        # Freezing needs eval mode
+        was_training = model.training
+        model.eval()
+        try:
+            with torch.no_grad():
+                return torch.jit.freeze(torch.jit.trace(model, torch.zeros(*input_shape,
+                                                                           device=device)))
+        except Exception as e:
+            logger.warning(f"Could not compile model, running it eagerly: {e}")
+            return None
+        finally:
+            model.train(was_training)
+
+    def _save(self, key, module):
+        logger = logging.getLogger('CompiledModelCache._save')
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            torch.jit.save(module, self.path(key))
+            # Keep the newest max_files around
+            file_names = sorted((os.path.join(self.directory, file_name)
+                                 for file_name in os.listdir(self.directory)
+                                 if file_name.endswith(self.FILE_EXTENSION)),
+                                key=os.path.getmtime)
+            for file_name in file_names[:-self.max_files]:
+                os.remove(file_name)
+        except OSError as e:
+            logger.warning(f"Could not save compiled model to {self.directory}: {e}")
+        return self
+
+    def clear(self):
+        # Only the modules in memory, e.g. when the weights have changed
+        self._modules.clear()
+        return self
+
+    def __len__(self):
+        return len(self._modules)
+
+    def __repr__(self):
+        return f"CompiledModelCache({self.directory}, {len(self)} modules loaded)"
+
+
+class CapacityCache(object):
+    """
+    Dry run results (device capacities in blocks of the dynamic shape) persisted to a YAML
+    file, so that a server restart with the same model, weights, device and torch version
+    doesn't have to probe the device again. Also keeps the receptive field of every model
+    architecture it has seen.
+    """
+    FILE_NAME = 'dry_run_cache.yml'
+
+    def __init__(self, directory=None):
+        self.directory = self.default_directory() if directory is None else directory
+        self.path = os.path.join(self.directory, self.FILE_NAME)
+
+    @staticmethod
+    def default_directory():
+        return os.environ.get('TIKTORCH_CACHE_DIR',
+                              os.path.join(os.path.expanduser('~'), '.cache', 'tiktorch'))
+
+    @staticmethod
+    def model_hash(model):
+        # Models built from a build directory remember which file they came from
+        model_file_name = getattr(model, '_model_file_name', None)
+        if model_file_name is not None and os.path.exists(model_file_name):
+            with open(model_file_name, 'rb') as f:
+                source = f.read()
+            source += repr(getattr(model, '_model_init_kwargs', None)).encode()
+        else:
+            source = repr(model).encode()
+        return hashlib.blake2b(source, digest_size=16).hexdigest()
+
+    @staticmethod
+    def state_hash(model):
+        digest = hashlib.blake2b(digest_size=16)
+        for name, tensor in model.state_dict().items():
+            digest.update(name.encode())
+            digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+        return digest.hexdigest()
+
+    @staticmethod
+    def key(**parts):
+        return hashlib.blake2b(repr(sorted(parts.items())).encode(), digest_size=16).hexdigest()
+
+    def _load(self):
+        logger = logging.getLogger('CapacityCache._load')
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r') as f:
+                entries = yaml.safe_load(f)
+        except (OSError, yaml.YAMLError) as e:
+            logger.warning(f"Ignoring unreadable dry run cache {self.path}: {e}")
+            return {}
+        return entries if isinstance(entries, dict) else {}
+
+    def get_entry(self, key):
+        entry = self._load().get(key)
+        if not isinstance(entry, dict) or not isinstance(entry.get('num_blocks'), list):
+            return None
+        return entry
+
+    def get(self, key):
+        entry = self.get_entry(key)
+        return None if entry is None else entry['num_blocks']
+
+    def put(self, key, num_blocks, **info):
+        return self._write(key, dict(info, num_blocks=[int(n) for n in num_blocks]))
+
+    def update(self, key, **info):
+        """Adds `info` (e.g. the tuned tile) to an existing entry."""
+        entry = self.get_entry(key)
+        if entry is None:
+            return self
+        entry.update(info)
+        return self._write(key, entry)
+
+    def get_receptive_field(self, model_hash):
+        """(halo, output offset) probed before for the model with `model_hash`, or None."""
+        entry = self._load().get(self.key(receptive_field=model_hash))
+        if not isinstance(entry, dict) or not isinstance(entry.get('halo'), list) or \
+                not isinstance(entry.get('output_offset'), list):
+            return None
+        return entry['halo'], entry['output_offset']
+
+    def put_receptive_field(self, model_hash, halo, output_offset):
+        return self._write(self.key(receptive_field=model_hash),
+                           {'halo': [int(h) for h in halo],
+                            'output_offset': [int(o) for o in output_offset]})
+
+    def _write(self, key, entry):
+        logger = logging.getLogger('CapacityCache._write')
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            entries = self._load()
+            entries[key] = entry
+            # Write to a temporary file first, so that a concurrent reader never sees half a file
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                yaml.safe_dump(entries, f, default_flow_style=False)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            # Not being able to cache is no reason to fail the dry run
+            logger.warning(f"Could not write dry run cache {self.path}: {e}")
+        return self
+
+    def __repr__(self):
+        return f"CapacityCache({self.path})"
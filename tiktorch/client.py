@@ -3,15 +3,21 @@ import logging
 import subprocess
 import yaml
 import zmq
+import zmq.asyncio
 import sys
+import queue
+import asyncio
 import threading as thr
 from argparse import Namespace
+from concurrent.futures import Future
+from functools import partial
+from itertools import count
 
 import numpy as np
 import torch
-import torch.distributed as dist
 
-from tiktorch.tio import TikIn
+from tiktorch.tio import TikIn, TikRef
+from tiktorch.transport import make_transport, shm_probe, decode_output
 import tiktorch.utils as utils
 
 logging.basicConfig(level=logging.INFO)
@@ -20,65 +26,164 @@ if torch.cuda.is_available():
     torch.multiprocessing.set_start_method('spawn', force=True)
 
 
-class TikTorchClient(object):
-    RANK = 0
-    SIZE = 2
+class Upload(object):
+    """
+    Training data on its way to the server. `progress` goes from 0 to 1 as the server receives
+    the data, and the upload is done once the server has handed the samples to the trainer.
+    Wait for that with `result()` or, on the client's event loop, `await upload`.
+    The arrays shouldn't be modified until the upload is done.
+    """
+    def __init__(self, upload_id, data, labels, priority, callback=None):
+        self.id = upload_id
+        self.data = [np.ascontiguousarray(_data) for _data in data]
+        self.labels = [np.ascontiguousarray(_label) for _label in labels]
+        self.priority = priority
+        self.total_bytes = sum(array.nbytes for array in self.data + self.labels)
+        # Bytes the server has acknowledged
+        self.sent_bytes = 0
+        self.future = Future()
+        # Privates
+        self._callback = callback
+
+    @property
+    def progress(self):
+        return self.sent_bytes / self.total_bytes if self.total_bytes > 0 else 1.
+
+    def _chunk_received(self, nbytes):
+        self.sent_bytes += nbytes
+        if self._callback is not None:
+            self._callback(self)
+
+    def done(self):
+        return self.future.done()
+
+    def result(self, timeout=None):
+        return self.future.result(timeout)
+
+    def __await__(self):
+        return asyncio.wrap_future(self.future).__await__()
+
+    def __repr__(self):
+        return f"Upload({self.id}, {len(self.data)} samples, {100 * self.progress:.0f}% sent)"
+
+
+class AsyncTikTorchClient(object):
+    """
+    Asyncio client. Requests return awaitables, so any number of them can be in flight
+    (up to `max_in_flight` on the wire) and cancelled without disturbing the others:
+
+        async with AsyncTikTorchClient(build_directory) as client:
+            outputs = await asyncio.gather(*[client.forward(inputs) for inputs in batches])
+
+    Cancelling a request (e.g. the task awaiting it) also cancels it on the server.
+    """
+    # Maximum number of requests in flight
+    MAX_IN_FLIGHT = 8
+    # Default request priorities; the server serves higher ones first. Interactive forward
+    # requests jump ahead of training uploads, and bulk prediction can use a lower priority.
+    FORWARD_PRIORITY = 1
+    TRAIN_PRIORITY = 0
+    # Training data goes up in chunks of (at most) this many bytes, interleaved with other
+    # requests. At most UPLOAD_WINDOW chunks are waiting for the server at any time.
+    UPLOAD_CHUNK_SIZE = 2 ** 20
+    UPLOAD_WINDOW = 4
 
     _START_PROCESS = False
 
-    def __init__(self, build_directory, address='127.0.0.1', port='29500', meta_port='29501', ilp_directory=None):
+    def __init__(self, build_directory, address='127.0.0.1', meta_port='29501',
+                 ilp_directory=None, transport='shm', max_in_flight=None, endpoint=None,
+                 compression=None, output_dtype='float32'):
         self.build_directory = build_directory
         self.addr = address
-        self.port = port
         self.meta_port = meta_port
+        # E.g. ipc:///tmp/tiktorch.ipc for a server on the same host. Overrides address and port.
+        self.endpoint = f'tcp://{address}:{meta_port}' if endpoint is None else endpoint
         self.ilp_directory = ilp_directory
         # Privates
         self._args: list = None
         self._process: subprocess.Popen = None
         self._config = {}
-        self._zmq_context = None
-        self._zmq_socket = None
-        # Locks
-        self._main_lock = thr.Lock()
+        self._zmq_context: zmq.asyncio.Context = None
+        self._zmq_socket: zmq.asyncio.Socket = None
+        self._requested_transport = transport
+        # For remote servers: compress frames ('zlib' or 'lz4') and/or get outputs back in
+        # reduced precision ('float16', or 'uint8' for probabilities). Inputs always go in
+        # their native dtype.
+        self._requested_compression = compression
+        self._requested_output_dtype = output_dtype
+        self._transport = None
+        self._max_in_flight = self.MAX_IN_FLIGHT if max_in_flight is None else max_in_flight
+        # Request book-keeping (only ever touched from the event loop)
+        self._request_ids = count()
+        self._requests = {}
+        self._in_flight: asyncio.BoundedSemaphore = None
+        self._recv_task: asyncio.Task = None
+        # Training data uploads are sent one after the other, in the background
+        self._upload_ids = count()
+        self._uploads: asyncio.Queue = None
+        self._pending_uploads = []
+        self._upload_credits: asyncio.BoundedSemaphore = None
+        self._upload_task: asyncio.Task = None
         # Initialize
         self.read_config()
-        self.init()
 
-    def init(self):
-        logger = logging.getLogger('TikTorchClient.init')
-        os.environ['MASTER_ADDR'] = self.addr
-        os.environ['MASTER_PORT'] = self.port
+    async def init(self):
+        logger = logging.getLogger('AsyncTikTorchClient.init')
         # Build args for the server
         self._args = [
             'python',
             os.path.join(os.path.dirname(os.path.realpath(__file__)), 'server.py'),
             self.build_directory,
-            '--addr', self.addr,
-            '--port', self.port,
-            '--meta_port', self.meta_port
+            '--endpoint', self.endpoint
         ]
         # Start server
         if self._START_PROCESS:
             logger.info("Starting Server...")
             self._process = subprocess.Popen(self._args, stdout=sys.stdout)
-        # Init torch distributed
-        logger.info("Initializing Process Group...")
-        dist.init_process_group(backend='tcp', rank=self.RANK, world_size=self.SIZE)
         # Make server for zmq
         logger.info("Setting up ZMQ Context...")
-        self._zmq_context = zmq.Context()
+        self._zmq_context = zmq.asyncio.Context()
         logger.info("Setting up ZMQ Socket...")
-        self._zmq_socket = self._zmq_context.socket(zmq.PAIR)
-        logger.info("Binding to socket...")
-        self._zmq_socket.bind(f'tcp://{self.addr}:{self.meta_port}')
-        # Send build directory
+        self._zmq_socket = self._zmq_context.socket(zmq.DEALER)
+        logger.info("Connecting to server...")
+        self._zmq_socket.connect(self.endpoint)
+        # Send build directory, and propose a tensor transport. If the server can see our
+        # shared memory probe, we're on the same host and tensors can go through shared memory.
+        probe = shm_probe() if self._requested_transport == 'shm' else None
         logger.info("Sending build directory...")
-        self.meta_send({'id': 'INIT.PATHS',
-                        'build_dir': self.build_directory,
-                        'ilp_dir': self.ilp_directory})
+        await self.meta_send({'id': 'INIT.PATHS',
+                              'build_dir': self.build_directory,
+                              'ilp_dir': self.ilp_directory,
+                              'transport': self._requested_transport,
+                              'shm_probe': probe,
+                              'compression': self._requested_compression,
+                              'output_dtype': self._requested_output_dtype})
         logger.info("Build directory sent.")
+        response, _ = await self.meta_recv()
+        if probe is not None:
+            os.remove(probe)
+        if response['id'] == 'ERROR':
+            raise RuntimeError(f"Server refused connection: {response['message']}")
+        assert response['id'] == 'INIT.TRANSPORT'
+        logger.info(f"Using transport: {response['transport']} "
+                    f"(compression: {response.get('compression')}, "
+                    f"output dtype: {response.get('output_dtype', 'float32')})")
+        self._transport = make_transport(response['transport'],
+                                         compression=response.get('compression'))
+        # Start receiving replies
+        self._in_flight = asyncio.BoundedSemaphore(self._max_in_flight)
+        self._recv_task = asyncio.ensure_future(self._recv_loop())
+        self._uploads = asyncio.Queue()
+        self._upload_credits = asyncio.BoundedSemaphore(self.UPLOAD_WINDOW)
+        self._upload_task = asyncio.ensure_future(self._upload_loop())
         return self
 
+    async def __aenter__(self):
+        return await self.init()
+
+    async def __aexit__(self, *exc_info):
+        await self.shutdown()
+
     def terminate(self):
         self._process.terminate()
         return self
@@ -104,12 +209,119 @@ class TikTorchClient(object):
             assert tag in self._config, f"Tag '{tag}' not found in configuration."
         return self._config.get(tag, default)
 
-    def meta_send(self, info_dict):
-        self._zmq_socket.send_json(info_dict)
+    async def meta_send(self, info_dict, frames=()):
+        await self._zmq_socket.send_multipart([zmq.utils.jsonapi.dumps(info_dict)] +
+                                              list(frames), copy=False)
         return self
 
-    def meta_recv(self):
-        return self._zmq_socket.recv_json()
+    async def meta_recv(self):
+        message, *frames = await self._zmq_socket.recv_multipart(copy=False)
+        return zmq.utils.jsonapi.loads(message.bytes), frames
+
+    async def _recv_loop(self):
+        logger = logging.getLogger('AsyncTikTorchClient._recv_loop')
+        try:
+            while True:
+                await self._handle_reply(*await self.meta_recv())
+        except asyncio.CancelledError:
+            logger.info("Stopped receiving.")
+            raise
+
+    async def _receive_output(self, reply, frames):
+        # We hand the output to the user, so it gets its own (writable) memory
+        output_tensor = decode_output(self._transport.recv(reply['handle'], frames, copy=True),
+                                      reply['handle'].get('encoding'))
+        if self._transport.reuses_buffers:
+            # Let the server know it can reuse the buffers of this reply (and only this one;
+            # more tiles of a stream might be waiting to be read)
+            await self.meta_send({'id': 'ACK', 'ack': reply['ack']})
+        return output_tensor.numpy()
+
+    async def _handle_reply(self, reply, frames):
+        logger = logging.getLogger('AsyncTikTorchClient._handle_reply')
+        request = self._requests.get(reply.get('rid'))
+        if request is None:
+            logger.warning(f"Got a reply ({reply['id']}) to an unknown request: {reply.get('rid')}")
+            return
+        if reply['id'] == 'FORWARD.TILE':
+            # Partial reply to a streaming request; more to come
+            tile = await self._receive_output(reply, frames)
+            if not request.future.done():
+                try:
+                    request.on_tile(tuple(slice(*_slice) for _slice in reply['slices']), tile)
+                except Exception:
+                    logger.exception("Tile callback failed.")
+            return
+        del self._requests[reply['rid']]
+        # The server is done with the tensors we sent along with the request. (We hold on to
+        # them even if the request was cancelled, because the server might still be reading.)
+        for handle in request.handles:
+            self._transport.release(handle)
+        request.semaphore.release()
+        if reply['id'] == 'ERROR':
+            output = RuntimeError(reply['message'])
+        elif reply['id'] == 'CANCELLED':
+            output = asyncio.CancelledError()
+        elif 'handle' in reply:
+            output = await self._receive_output(reply, frames)
+            logger.info(f"Output received (shape = {output.shape}).")
+        else:
+            output = reply
+        if request.future.done():
+            # Cancelled
+            return
+        if isinstance(output, asyncio.CancelledError):
+            request.future.cancel()
+        elif isinstance(output, Exception):
+            request.future.set_exception(output)
+        else:
+            request.future.set_result(output)
+
+    async def submit(self, header, tensors=None, on_tile=None, semaphore=None):
+        """
+        Sends a request to the server. Returns once it's sent (which can take a while if there
+        are too many requests in flight), without waiting for the reply.
+
+        Parameters
+        ----------
+        header: dict
+            Message to send; it's tagged with a request id.
+        tensors: dict
+            Maps header fields to lists of tensors to send along with the request.
+        on_tile: callable
+            For streaming requests: called with `(slices, tile)` for every partial reply.
+        semaphore: asyncio.Semaphore
+            Limits the number of requests in flight; defaults to the one shared by all
+            requests except training data chunks.
+
+        Returns
+        -------
+        asyncio.Future
+        """
+        semaphore = self._in_flight if semaphore is None else semaphore
+        await semaphore.acquire()
+        rid = next(self._request_ids)
+        header = dict(header, rid=rid)
+        request = Namespace(future=asyncio.get_event_loop().create_future(), handles=[],
+                            on_tile=on_tile, semaphore=semaphore)
+        frames = []
+        for field, field_tensors in (tensors or {}).items():
+            header[field] = [self._transport.describe(tensor, frames)
+                             for tensor in field_tensors]
+            request.handles.extend(header[field])
+        self._requests[rid] = request
+        await self.meta_send(header, frames)
+        request.future.add_done_callback(lambda future: self._cancel_on_server(rid, future))
+        return request.future
+
+    def _cancel_on_server(self, rid, future):
+        if future.cancelled() and rid in self._requests:
+            # The reply (or a CANCELLED) will still come in and close the request
+            asyncio.ensure_future(self.meta_send({'id': 'DISPATCH.CANCEL', 'rid': rid}))
+
+    async def request(self, header, tensors=None, on_tile=None):
+        """Sends a request and waits for the reply."""
+        return await (await self.submit(header, tensors, on_tile=on_tile))
 
     def batch_inputs(self, inputs):
         input_shapes = self.get('input_shape', assert_exist=True)
@@ -141,126 +353,381 @@ class TikTorchClient(object):
             raise TypeError("Inputs must be list TikIn objects.")
         return inputs
 
-    def request_dispatch(self, mode):
-        self.meta_send({'id': f'DISPATCH.{mode.upper()}'})
-        response = self.meta_recv()
-        return response['id'] == f'DISPATCHING.{mode.upper()}'
-
-    def forward(self, inputs: list):
-        logger = logging.getLogger('TikTorchClient.forward')
-        logger.info("Waiting for lock...")
-        with self._main_lock:
-            # Send dispatch request and wait for confirmation
-            logger.info("Requesting dispatch...")
-            assert self.request_dispatch('FORWARD')
-            logger.info("Request successful.")
-            # Parse inputs
-            inputs = self.parse_inputs(TikIn(inputs))
-            # Batch inputs
-            batches = self.batch_inputs(inputs)
-            logger.info("Batched inputs.")
-            # Make info dict to send to server
-            info = {'id': 'FORWARD.BATCHSPEC',
-                    'len': len(batches),
-                    'shapes': tuple(batch.shape for batch in batches)}
-            logger.info("Sending BatchSpec.")
-            self.meta_send(info)
-            # Send batch to the server
-            for batch in batches:
-                logger.info("Sending batch.")
-                dist.send(batch, 1)
-            # Receive meta data
-            logger.info("Waiting for OutSpec.")
-            outspec = self.meta_recv()
-            assert outspec['id'] == 'FORWARD.OUTSPEC'
-            logger.info("OutSpec received.")
-            output_tensor = torch.zeros(*outspec['shape'])
-            # Receive it
-            dist.recv(tensor=output_tensor, src=1)
-            logger.info(f"Output received (shape = {tuple(output_tensor.shape)}).")
-        # Convert to np and done
-        return output_tensor.numpy()
+    async def request_dispatch(self, mode):
+        return await self.request({'id': f'DISPATCH.{mode.upper()}'})
+
+    async def forward(self, inputs: list, priority=None):
+        logger = logging.getLogger('AsyncTikTorchClient.forward')
+        # Parse inputs
+        inputs = self.parse_inputs(TikIn(inputs))
+        # Batch inputs
+        batches = self.batch_inputs(inputs)
+        logger.info("Batched inputs.")
+        # Make info dict to send to server
+        info = {'id': 'FORWARD.BATCHSPEC',
+                'len': len(batches),
+                'shapes': tuple(batch.shape for batch in batches),
+                'priority': self.FORWARD_PRIORITY if priority is None else priority}
+        logger.info("Sending BatchSpec.")
+        return await self.request(info, {'handles': batches})
+
+    async def forward_reference(self, references, priority=None):
+        """
+        Like `forward`, but the server reads the samples from files itself.
+
+        Parameters
+        ----------
+        references: TikRef or list of TikRef
+            One per sample; the server must be able to see the files.
+        priority: int
+        """
+        logger = logging.getLogger('AsyncTikTorchClient.forward_reference')
+        if isinstance(references, TikRef):
+            references = [references]
+        info = {'id': 'FORWARD.REFERENCE',
+                'references': [reference.to_dict() for reference in references],
+                'priority': self.FORWARD_PRIORITY if priority is None else priority}
+        logger.info("Sending references.")
+        return await self.request(info)
+
+    async def forward_stream_async(self, inputs: list, callback, tile_shape=None,
+                                   priority=None):
+        """
+        Forwards `inputs` tile by tile. `callback(slices, tile)` is called with every output
+        tile as soon as the server has it, where `slices` locate the tile along the spatial axes
+        of the output (i.e. `output[(..., *slices)] = tile`).
+
+        Parameters
+        ----------
+        inputs: list
+        callback: callable
+        tile_shape: list
+            Spatial shape of the tiles, rounded up to the model's dynamic base shape.
+            Defaults to a single base shape block.
+        priority: int
+            Defaults to `FORWARD_PRIORITY`.
+
+        Returns
+        -------
+        dict
+            The final FORWARD.DONE message, once all tiles are in.
+        """
+        logger = logging.getLogger('AsyncTikTorchClient.forward_stream_async')
+        inputs = self.parse_inputs(TikIn(inputs))
+        batches = self.batch_inputs(inputs)
+        logger.info("Batched inputs.")
+        info = {'id': 'FORWARD.STREAM',
+                'len': len(batches),
+                'shapes': tuple(batch.shape for batch in batches),
+                'tile_shape': None if tile_shape is None else list(tile_shape),
+                'priority': self.FORWARD_PRIORITY if priority is None else priority}
+        logger.info("Sending StreamSpec.")
+        return await self.request(info, {'handles': batches}, on_tile=callback)
+
+    async def forward_stream(self, inputs: list, tile_shape=None, priority=None):
+        """
+        Async generator version of `forward_stream_async`: yields `(slices, tile)` as tiles
+        come in.
+        """
+        tiles = asyncio.Queue()
+        done = asyncio.ensure_future(self.forward_stream_async(inputs, lambda *tile:
+                                                               tiles.put_nowait(tile),
+                                                               tile_shape=tile_shape,
+                                                               priority=priority))
+        # All tiles are in by the time the request is done
+        done.add_done_callback(lambda _: tiles.put_nowait(None))
+        try:
+            while True:
+                tile = await tiles.get()
+                if tile is None:
+                    break
+                yield tile
+            # Raises if the server ran into trouble
+            await done
+        finally:
+            done.cancel()
+
+    def train(self, data, labels, priority=None, callback=None):
+        """
+        Queues training data for upload and returns right away.
+
+        Parameters
+        ----------
+        data: list of numpy.ndarray
+        labels: list of numpy.ndarray
+        priority: int
+            Priority of the training job on the server; defaults to `TRAIN_PRIORITY`.
+        callback: callable
+            Called with the `Upload` whenever the server has received another chunk.
+
+        Returns
+        -------
+        Upload
+        """
+        logger = logging.getLogger('AsyncTikTorchClient.train')
+        utils.assert_(len(data) == len(labels), f"Got {len(data)} data and {len(labels)} "
+                                                f"labels.", ValueError)
+        upload = Upload(next(self._upload_ids), data, labels,
+                        self.TRAIN_PRIORITY if priority is None else priority, callback=callback)
+        self._pending_uploads.append(upload)
+        upload.future.add_done_callback(lambda _: self._pending_uploads.remove(upload))
+        self._uploads.put_nowait(upload)
+        logger.info(f"Queued upload of {len(data)} samples ({upload.total_bytes} bytes); "
+                    f"{self.pending_upload_bytes} bytes waiting to be sent.")
+        return upload
+
+    @property
+    def pending_upload_bytes(self):
+        """Training data that was queued but hasn't reached the server yet."""
+        return sum(upload.total_bytes - upload.sent_bytes for upload in self._pending_uploads)
+
+    async def _upload_loop(self):
+        logger = logging.getLogger('AsyncTikTorchClient._upload_loop')
+        while True:
+            upload = await self._uploads.get()
+            try:
+                reply = await self._upload(upload)
+            except asyncio.CancelledError:
+                upload.future.cancel()
+                raise
+            except Exception as e:
+                logger.exception(f"Upload {upload.id} failed.")
+                upload.future.set_exception(e)
+            else:
+                upload.future.set_result(reply)
+            finally:
+                upload.data = upload.labels = None
+                self._uploads.task_done()
+
+    async def _upload(self, upload):
+        chunk_futures = []
+        for field, arrays in (('data', upload.data), ('labels', upload.labels)):
+            for index, array in enumerate(arrays):
+                flat = array.reshape(-1).view(np.uint8)
+                # Empty arrays still get a (empty) chunk
+                for offset in range(0, max(flat.nbytes, 1), self.UPLOAD_CHUNK_SIZE):
+                    chunk = flat[offset:offset + self.UPLOAD_CHUNK_SIZE]
+                    info = {'id': 'TRAIN.CHUNK',
+                            'upload': upload.id,
+                            'len': len(upload.data),
+                            'field': field,
+                            'index': index,
+                            'shape': list(array.shape),
+                            'dtype': array.dtype.name,
+                            'offset': offset}
+                    # Waits for credit if too many chunks are in flight
+                    future = await self.submit(info, {'handles': [torch.from_numpy(chunk)]},
+                                               semaphore=self._upload_credits)
+                    future.add_done_callback(partial(self._chunk_done, upload, len(chunk)))
+                    chunk_futures.append(future)
+        await asyncio.gather(*chunk_futures)
+        # All there; have the server hand it to the trainer
+        return await self.request({'id': 'TRAIN.COMMIT',
+                                   'upload': upload.id,
+                                   'priority': upload.priority})
+
+    @staticmethod
+    def _chunk_done(upload, nbytes, future):
+        if not future.cancelled() and future.exception() is None:
+            upload._chunk_received(nbytes)
+
+    async def set_hparams(self, hparams: dict):
+        logger = logging.getLogger('AsyncTikTorchClient.set_hparams')
+        # Build info dict
+        info = {'id': 'TRAIN.HYPERPARAMETERS',
+                'parameters': hparams}
+        logger.info("Sending hyperparameters...")
+        await self.request(info)
+        logger.info("Request successful.")
+
+    async def shutdown(self):
+        logger = logging.getLogger('AsyncTikTorchClient.shutdown')
+        if self._pending_uploads:
+            logger.info(f"Waiting for {len(self._pending_uploads)} upload(s) to finish...")
+            await self._uploads.join()
+        self._upload_task.cancel()
+        logger.info("Requesting dispatch...")
+        await self.request_dispatch('SHUTDOWN')
+        logger.info("Request successful.")
+        self._recv_task.cancel()
+        try:
+            await self._recv_task
+        except asyncio.CancelledError:
+            pass
+        self._zmq_socket.close()
+        self._transport.close()
+
+    async def pause(self):
+        logger = logging.getLogger('AsyncTikTorchClient.pause')
+        logger.info("Requesting dispatch...")
+        await self.request_dispatch('PAUSE')
+        logger.info("Request successful.")
+
+    async def resume(self):
+        logger = logging.getLogger('AsyncTikTorchClient.resume')
+        logger.info("Requesting dispatch...")
+        await self.request_dispatch('RESUME')
+        logger.info("Request successful.")
+
+    async def training_process_is_running(self):
+        logger = logging.getLogger('AsyncTikTorchClient.training_process_is_running')
+        logger.info("Requesting dispatch...")
+        # Receive info
+        info = await self.request_dispatch('POLL_TRAIN')
+        return info['is_alive']
+
+    async def training_stats(self):
+        """See `tiktorch.trainy.Trainer.training_stats`."""
+        logger = logging.getLogger('AsyncTikTorchClient.training_stats')
+        logger.info("Requesting dispatch...")
+        info = await self.request_dispatch('TRAINING_STATS')
+        return info['stats']
+
+
+class TikTorchClient(object):
+    """
+    Blocking client. It runs an `AsyncTikTorchClient` (`async_client`) on an event loop in a
+    background thread; the `*_async` methods return `concurrent.futures.Future`s. Cancelling
+    such a future cancels the request on the server.
+    """
+    _START_PROCESS = False
 
-    def train(self, data, labels):
-        logger = logging.getLogger('TikTorchClient.train')
-        logger.info("Waiting for lock...")
-        with self._main_lock:
-            logger.info("Requesting Dispatch")
-            assert self.request_dispatch('TRAIN')
-            logger.info("Request successful.")
-            # Build info dict
-            info = {'id': 'TRAIN.BATCHSPEC',
-                    'len': len(data),
-                    'data.shapes': [tuple(_data.shape) for _data in data],
-                    'labels.shapes': [tuple(_label.shape) for _label in labels]}
-            logger.info("Sending BatchSpec")
-            self.meta_send(info)
-            # Send tensors
-            logger.info("Sending data and labels...")
-            for _data in data:
-                _data_th = torch.from_numpy(_data)
-                dist.send(_data_th, dst=1)
-            for _label in labels:
-                _label_th = torch.from_numpy(_label)
-                dist.send(_label_th, dst=1)
-            logger.info("Data and labels sent.")
+    def __init__(self, build_directory, address='127.0.0.1', meta_port='29501',
+                 ilp_directory=None, transport='shm', max_in_flight=None, endpoint=None,
+                 compression=None, output_dtype='float32'):
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = thr.Thread(target=self._loop.run_forever, daemon=True)
+        self._loop_thread.start()
+        self.async_client = AsyncTikTorchClient(build_directory, address=address,
+                                                meta_port=meta_port,
+                                                ilp_directory=ilp_directory,
+                                                transport=transport,
+                                                max_in_flight=max_in_flight,
+                                                endpoint=endpoint,
+                                                compression=compression,
+                                                output_dtype=output_dtype)
+        self.async_client._START_PROCESS = self._START_PROCESS
+        self._run(self.async_client.init()).result()
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    @property
+    def build_directory(self):
+        return self.async_client.build_directory
+
+    @property
+    def endpoint(self):
+        return self.async_client.endpoint
+
+    def terminate(self):
+        self.async_client.terminate()
+        return self
+
+    def kill(self):
+        self.async_client.kill()
+        return self
+
+    def is_running(self):
+        return self.async_client.is_running()
+
+    def get(self, tag, default=None, assert_exist=False):
+        return self.async_client.get(tag, default=default, assert_exist=assert_exist)
+
+    def submit(self, header, tensors=None, on_tile=None):
+        """
+        Sends a request (see `AsyncTikTorchClient.submit` for the arguments). Unlike that one,
+        the returned `concurrent.futures.Future` resolves to the reply, not to the request
+        being sent.
+        """
+        return self._run(self.async_client.request(header, tensors, on_tile=on_tile))
+
+    def request_dispatch(self, mode):
+        return self._run(self.async_client.request_dispatch(mode))
+
+    def forward_async(self, inputs: list, priority=None):
+        return self._run(self.async_client.forward(inputs, priority=priority))
+
+    def forward(self, inputs: list, priority=None):
+        return self.forward_async(inputs, priority=priority).result()
+
+    def forward_reference_async(self, references, priority=None):
+        return self._run(self.async_client.forward_reference(references, priority=priority))
+
+    def forward_reference(self, references, priority=None):
+        return self.forward_reference_async(references, priority=priority).result()
+
+    def forward_stream_async(self, inputs: list, callback, tile_shape=None, priority=None):
+        """
+        See `AsyncTikTorchClient.forward_stream_async`. `callback` is called from the
+        client's event loop thread.
+        """
+        return self._run(self.async_client.forward_stream_async(inputs, callback,
+                                                                tile_shape=tile_shape,
+                                                                priority=priority))
+
+    def forward_stream(self, inputs: list, tile_shape=None, priority=None):
+        """
+        Generator version of `forward_stream_async`: yields `(slices, tile)` as tiles come in.
+        """
+        tiles = queue.Queue()
+        future = self.forward_stream_async(inputs, lambda *tile: tiles.put(tile),
+                                           tile_shape=tile_shape, priority=priority)
+        # All tiles are in by the time the future is done
+        future.add_done_callback(lambda _: tiles.put(None))
+        while True:
+            tile = tiles.get()
+            if tile is None:
+                break
+            yield tile
+        # Raises if the server ran into trouble
+        future.result()
+
+    def train(self, data, labels, priority=None, callback=None):
+        """
+        See `AsyncTikTorchClient.train`. Returns an `Upload` right away; `callback` is called
+        from the client's event loop thread.
+        """
+        async def start_upload():
+            return self.async_client.train(data, labels, priority=priority, callback=callback)
+        return self._run(start_upload()).result()
+
+    def train_async(self, data, labels, priority=None):
+        return self.train(data, labels, priority=priority).future
+
+    @property
+    def pending_upload_bytes(self):
+        return self.async_client.pending_upload_bytes
 
     def set_hparams(self, hparams: dict):
-        logger = logging.getLogger('TikTorchClient.set_hparams')
-        logger.info("Waiting for Lock...")
-        with self._main_lock:
-            logger.info("Requesting dispatch...")
-            assert self.request_dispatch('HYPERPARAMETERS')
-            logger.info("Request successful.")
-            # Build info dict
-            info = {'id': 'TRAIN.HYPERPARAMETERS',
-                    'parameters': hparams}
-            logger.info("Sending hyperparameters...")
-            self.meta_send(info)
+        self._run(self.async_client.set_hparams(hparams)).result()
 
     def shutdown(self):
-        logger = logging.getLogger('TikTorchClient.shutdown')
-        logger.info("Waiting for lock...")
-        with self._main_lock:
-            logger.info("Requesting dispatch...")
-            assert self.request_dispatch('SHUTDOWN')
-            logger.info("Request successful.")
+        self._run(self.async_client.shutdown()).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop_thread.join()
+        self._loop.close()
 
     def pause(self):
-        logger = logging.getLogger('TikTorchClient.pause')
-        logger.info("Waiting for lock...")
-        with self._main_lock:
-            logger.info("Requesting dispatch...")
-            assert self.request_dispatch('PAUSE')
-            logger.info("Request successful.")
+        self._run(self.async_client.pause()).result()
 
     def resume(self):
-        logger = logging.getLogger('TikTorchClient.resume')
-        logger.info("Waiting for lock...")
-        with self._main_lock:
-            logger.info("Requesting dispatch...")
-            assert self.request_dispatch('RESUME')
-            logger.info("Request successful.")
+        self._run(self.async_client.resume()).result()
 
     def training_process_is_running(self):
-        logger = logging.getLogger("TikTorchClient.training_process_is_running")
-        logger.info("Waiting for lock...")
-        with self._main_lock:
-            logger.info("Requesting dispatch...")
-            assert self.request_dispatch('POLL_TRAIN')
-            # Receive info
-            info = self.meta_recv()
-        return info['is_alive']
+        return self._run(self.async_client.training_process_is_running()).result()
+
+    def training_stats(self):
+        return self._run(self.async_client.training_stats()).result()
 
 
 def debug_client():
-    TikTorchClient.read_config = lambda self: self
+    AsyncTikTorchClient.read_config = lambda self: self
     TikTorchClient._START_PROCESS = False
-    client = TikTorchClient(build_directory='.', address='127.0.0.1', port='29500',
-                            meta_port='29501')
+    client = TikTorchClient(build_directory='.', address='127.0.0.1', meta_port='29501')
     client._model = torch.nn.Conv2d(1, 1, 1)
-    client._config = {'input_shape': [1, 512, 512],
-                      'dynamic_input_shape': '(32 * (nH + 1), 32 * (nW + 1))'}
+    client.async_client._config = {'input_shape': [1, 512, 512],
+                                   'dynamic_input_shape': '(32 * (nH + 1), 32 * (nW + 1))'}
     return client
 
 
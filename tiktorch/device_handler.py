@@ -1,5 +1,6 @@
 from itertools import count
 import logging
+import time
 from copy import deepcopy
 
 import torch
@@ -8,6 +9,10 @@ import numpy as np
 from tiktorch.utils import DynamicShape, assert_, to_list
 from tiktorch.blockinator import Blockinator, th_pad
 from tiktorch.trainy import Trainer
+from tiktorch.cache import CapacityCache
+from tiktorch.memory import ActivationMemoryModel, available_memory
+from tiktorch.workers import CPUWorkerPool, autotune_cpu_workers
+from tiktorch.precision import INFERENCE_MODES, prepare_inference_mode
 # from .dataloader import get_dataloader
 # from .trainer import TikTorchTrainer
 
@@ -42,6 +47,16 @@ class Processor(object):
 
 
 class ModelHandler(Processor):
+    # Fraction of the free device memory the predicted peak may use (the rest is headroom for
+    # the allocator, cudnn workspaces and the like)
+    MEMORY_SAFETY_FRACTION = 0.8
+    # Largest input (in blocks per axis) used to probe the receptive field
+    MAX_HALO_PROBE_BLOCKS = 8
+    # Number of times an input shape has to come up before the model is compiled for it
+    COMPILE_AFTER = 2
+    # Largest number of tiles to try processing as one batch when tuning tiles
+    MAX_TILE_BATCH_SIZE = 4
+
     def __init__(self, *, model, device_names, channels, dynamic_shape_code,
                  training_hyperparams=None, log_directory=None):
         # Privates
@@ -49,11 +64,41 @@ class ModelHandler(Processor):
         self._trainer = None
         self._max_batch_limit = 500
         self._halo = None
+        self._output_offset = None
         self._channels = channels
         self._device_specs = {}
+        # (model copy, model version) by device id, for all but the first device
+        self._replicas = {}
+        # CPUWorkerPool and the model version its replicas have
+        self._cpu_workers = None
+        self._cpu_workers_version = None
+        # How often process_tensor saw each input shape, and (model version, state hash)
+        self._shape_counts = {}
+        self._state_hash = (None, None)
+        # (model version, runner) by device id, for inference modes other than float32
+        self._mode_runners = {}
+        self._inference_mode = 'float32'
+        # (batch size, tile blocks) by device id, from `tune_tiles`
+        self._tuned_tiles = {}
         self.__num_trial_runs_on_device = {}
-        self._parameter_copy = None
+        # ActivationMemoryModel by device id (None if the model can't be estimated)
+        self._memory_models = {}
+        # Bumped whenever the weights change
+        self._model_version = 0
         # Publics
+        # Set to a `tiktorch.cache.ResultCache` to skip inputs that were already processed
+        # by the current weights
+        self.result_cache = None
+        # Set to a `tiktorch.cache.CapacityCache` to skip dry runs that were done before
+        self.capacity_cache = None
+        # Whether dry runs predict memory use from a calibration pass (see
+        # `tiktorch.memory.ActivationMemoryModel`) instead of probing with trial runs
+        self.estimate_memory = True
+        # Set to a `tiktorch.cache.CompiledModelCache` to run frequent input shapes through a
+        # TorchScript version of the model
+        self.compiled_models = None
+        # Whether (inference) dry runs also look for the tile with the best throughput
+        self.tune_tiles = True
         self.device_names = to_list(device_names)
         self.dynamic_shape = DynamicShape(dynamic_shape_code)
         # Set
@@ -84,20 +129,6 @@ class ModelHandler(Processor):
                                 hyperparameters=hyperparameters,
                                 log_directory=log_directory)
 
-    def _evaluate_parameter_diff(self):
-        if self._parameter_copy is None:
-            self._parameter_copy = [deepcopy(p) for p in self.model.parameters()]
-            return 0
-        else:
-            param_now = [deepcopy(p) for p in self.model.parameters()]
-            param_prev = self._parameter_copy
-            self._parameter_copy = param_now
-            # Compute diff
-            with torch.no_grad():
-                diff = sum([torch.norm(p_now - p_prev).item()
-                            for p_now, p_prev in zip(param_now, param_prev)])
-            return diff
-
     @property
     def trainer(self):
         assert self._trainer is not None
@@ -147,6 +178,26 @@ class ModelHandler(Processor):
                     ValueError)
             self._halo = value
 
+    @property
+    def output_offset(self):
+        """
+        Number of pixels (per axis) by which the model output is smaller than its input on
+        either side, e.g. because of unpadded convolutions.
+        """
+        if self._output_offset is None:
+            _, self._output_offset = self._probe_receptive_field()
+        return self._output_offset
+
+    @output_offset.setter
+    def output_offset(self, value):
+        if isinstance(value, int):
+            value = [value] * len(self.dynamic_shape)
+        assert_(len(value) == len(self.dynamic_shape),
+                f"Output offset of a {len(self.dynamic_shape)}-D network cannot "
+                f"be {len(value)}-D.",
+                ValueError)
+        self._output_offset = list(value)
+
     def train(self, data, labels):
         self.trainer.push(data, labels)
         return self
@@ -174,11 +225,30 @@ class ModelHandler(Processor):
     def training_process_is_alive(self):
         return self.trainer.is_alive()
 
+    def training_stats(self):
+        """See `Trainer.training_stats`."""
+        return self.trainer.training_stats()
+
+    @property
+    def model_version(self):
+        return self._model_version
+
+    @property
+    def weights_settled(self):
+        """
+        Whether the weights stay as they are for now, i.e. there's no training process
+        publishing new ones (or it's paused). Work that has to be redone for every new version
+        of the weights waits for this.
+        """
+        return not (self.trainer.is_ignited and not self.trainer.is_paused and
+                    self.trainer.is_alive())
+
     def update_state(self):
         logger = logging.getLogger('ModelHandler.update_state')
         if self.trainer.is_ignited:
             logger.info("Updating state...")
-            self.trainer.update_handler_model_state()
+            if self.trainer.update_handler_model_state():
+                self._model_version += 1
 
     def dump_state(self, filename):
         state_dict = self.model.state_dict()
@@ -195,7 +265,7 @@ class ModelHandler(Processor):
             else:
                 self.__num_trial_runs_on_device[device_id] += 1
             device = self.devices[device_id]
-            self.model.to(device)(torch.zeros(1, *input_shape).to(device))
+            self.replica(device_id)(torch.zeros(1, *input_shape).to(device))
             return True
         except RuntimeError:
             # FIXME Investigate
@@ -219,7 +289,7 @@ class ModelHandler(Processor):
                 self.__num_trial_runs_on_device[device_id] += 1
             with torch.no_grad():
                 device = self.devices[device_id]
-                self.model.to(device)(torch.zeros(1, *input_shape).to(device))
+                self.replica(device_id)(torch.zeros(1, *input_shape).to(device))
             return True
         except RuntimeError:
             # FIXME Investigate
@@ -232,7 +302,32 @@ class ModelHandler(Processor):
                 # Nope
                 return False
 
-    def _try_running_on_blocksize(self, *block_size, device_id, train_flag=False):
+    def _memory_model(self, device_id):
+        logger = logging.getLogger('ModelHandler._memory_model')
+        if not self.estimate_memory:
+            return None
+        if device_id not in self._memory_models:
+            try:
+                self._memory_models[device_id] = \
+                    ActivationMemoryModel.calibrate(self.replica(device_id), self.channels,
+                                                    self.dynamic_shape,
+                                                    self.devices[device_id])
+            except (RuntimeError, AssertionError) as e:
+                logger.warning(f"Could not calibrate memory model on {self.devices[device_id]}, "
+                               f"falling back to trial runs: {e}")
+                self._memory_models[device_id] = None
+        return self._memory_models[device_id]
+
+    def _try_running_on_blocksize(self, *block_size, device_id, train_flag=False, estimate=True):
+        memory_model = self._memory_model(device_id) if estimate else None
+        free = None if memory_model is None else available_memory(self.devices[device_id])
+        if free is not None:
+            budget = free * self.MEMORY_SAFETY_FRACTION
+            predicted = memory_model.predict(block_size, train=train_flag)
+            if not train_flag:
+                # Activations in reduced precision take less memory
+                predicted *= INFERENCE_MODES[self.inference_mode]
+            return predicted <= budget
         if train_flag:
             return self._train_trial_run_successful(self.channels, *self.dynamic_shape(*block_size),
                                                     device_id=device_id)
@@ -330,10 +425,51 @@ class ModelHandler(Processor):
 
         logger.debug(f'Dry run with upper bound: {image_shape}')
             
+        if self.capacity_cache is not None:
+            model_hash = self.capacity_cache.model_hash(self.model)
+            state_hash = self.capacity_cache.state_hash(self.model)
+
         max_shape = []
         for device_id in range(self.num_devices):
-            logger.debug(f'Dry running on device: {self.devices[device_id]}')
-            self._device_specs[device_id] = self._binary_dry_run_on_device(image_shape, device_id, train_flag=train_flag)
+            cache_key = num_blocks = cache_entry = None
+            if self.capacity_cache is not None:
+                cache_info = dict(model=model_hash, state=state_hash,
+                                  device=self._device_name(device_id),
+                                  torch=torch.__version__,
+                                  mode='train' if train_flag else self.inference_mode,
+                                  image_shape=image_shape,
+                                  dynamic_shape=self.dynamic_shape.code)
+                cache_key = self.capacity_cache.key(**cache_info)
+                cache_entry = self.capacity_cache.get_entry(cache_key)
+                num_blocks = None if cache_entry is None else cache_entry['num_blocks']
+            if num_blocks is not None and len(num_blocks) == len(self.dynamic_shape):
+                logger.debug(f'Found capacity of {self.devices[device_id]} in '
+                             f'{self.capacity_cache}: {num_blocks}')
+                self._device_specs[device_id] = \
+                    DeviceMemoryCapacity(num_blocks, self.dynamic_shape, device_id=device_id)
+            else:
+                logger.debug(f'Dry running on device: {self.devices[device_id]}')
+                self._device_specs[device_id] = self._binary_dry_run_on_device(image_shape, device_id, train_flag=train_flag)
+                if self._memory_model(device_id) is not None and not \
+                        self._confirm_capacity(device_id, train_flag=train_flag):
+                    # Estimate was off; do it the hard way
+                    logger.warning(f'Predicted capacity of {self.devices[device_id]} failed, '
+                                   f'falling back to trial runs.')
+                    self._memory_models[device_id] = None
+                    self._device_specs[device_id] = self._binary_dry_run_on_device(image_shape, device_id, train_flag=train_flag)
+                if cache_key is not None:
+                    self.capacity_cache.put(cache_key, self._device_specs[device_id].num_blocks,
+                                            device=cache_info['device'], mode=cache_info['mode'])
+                cache_entry = None
+            if self.tune_tiles and not train_flag:
+                if cache_entry is not None and 'tile_blocks' in cache_entry:
+                    self._tuned_tiles[device_id] = (cache_entry['batch_size'],
+                                                    cache_entry['tile_blocks'])
+                else:
+                    batch_size, tile_blocks = self.tune_tile(device_id)
+                    if cache_key is not None:
+                        self.capacity_cache.update(cache_key, batch_size=batch_size,
+                                                   tile_blocks=tile_blocks)
             max_device_shape = self.dynamic_shape(*self._device_specs[device_id].num_blocks)
             if len(max_shape) == 0:
                 max_shape = max_device_shape
@@ -342,6 +478,18 @@ class ModelHandler(Processor):
         logger.debug(f'Dry run finished. Max shape / upper bound: {max_shape} / {image_shape}')
         return max_shape
 
+    def _confirm_capacity(self, device_id, train_flag=False):
+        # One real run at the predicted capacity
+        return self._try_running_on_blocksize(*self._device_specs[device_id].num_blocks,
+                                              device_id=device_id, train_flag=train_flag,
+                                              estimate=False)
+
+    def _device_name(self, device_id):
+        device = self.devices[device_id]
+        if device.type == 'cuda':
+            return torch.cuda.get_device_name(device)
+        return str(device)
+
     def _binary_dry_run_on_device(self, image_shape, device_id, train_flag=False):
         """
         Parameters
@@ -395,29 +543,125 @@ class ModelHandler(Processor):
 
         return DeviceMemoryCapacity(device_capacity, self.dynamic_shape, device_id=device_id)
            
+    @property
+    def inference_mode(self):
+        """
+        One of `tiktorch.precision.INFERENCE_MODES`. Modes other than float32 are calibrated and
+        checked against float32 on the first tile they see, and again after weight updates once
+        the weights are settled (see `weights_settled`). Until then, tiles run in float32.
+        """
+        return self._inference_mode
+
+    @inference_mode.setter
+    def inference_mode(self, value):
+        assert_(value in INFERENCE_MODES,
+                f"Inference mode must be one of {list(INFERENCE_MODES)}, got {value}.",
+                ValueError)
+        self._inference_mode = value
+        self._mode_runners = {}
+        if self.result_cache is not None:
+            # Outputs came from another mode
+            self.result_cache.clear()
+
     @property
     def num_parallel_jobs(self):
-        return self.num_devices
+        return self.num_devices if self._cpu_workers is None else self._cpu_workers.num_workers
+
+    def start_cpu_workers(self, num_workers=None, threads_per_worker=None, cores=None):
+        """
+        Runs inference in a pool of worker processes (see `tiktorch.workers.CPUWorkerPool`)
+        instead of in this one, with tiles spread over the workers. If `num_workers` and
+        `threads_per_worker` aren't given, they're tuned for the model and tile shape.
+        The workers run the model eagerly in float32, so they don't go with another
+        `inference_mode` or with `compiled_models`.
+        """
+        assert_(all(device.type == 'cpu' for device in self.devices),
+                "CPU workers are for CPU-only handlers.", ValueError)
+        assert_(self.inference_mode == 'float32' and self.compiled_models is None,
+                f"CPU workers run the model in float32 without compiling it, which doesn't go "
+                f"with inference mode {self.inference_mode} or compiled models.", ValueError)
+        self.stop_cpu_workers()
+        if num_workers is None or threads_per_worker is None:
+            tile_shape = [(_blocks + 2 * _halo) * _block_shape
+                          for _blocks, _halo, _block_shape in zip(self.tile_blocks(0),
+                                                                  self.halo_in_blocks,
+                                                                  self.dynamic_shape.base_shape)]
+            num_workers, threads_per_worker = \
+                autotune_cpu_workers(self.model, [1, self.channels] + tile_shape, cores=cores)
+        self._cpu_workers = CPUWorkerPool(self.model, num_workers, threads_per_worker, cores=cores)
+        self._cpu_workers_version = self.model_version
+        return self
+
+    def stop_cpu_workers(self):
+        # Tiles on other threads might be stopping them at the same time
+        cpu_workers, self._cpu_workers = self._cpu_workers, None
+        if cpu_workers is not None:
+            cpu_workers.close()
+        return self
 
     def compute_halo(self, device_id=0, set_=True):
-        device = self.devices[device_id]
-        # Evaluate model on the smallest possible image to keep it quick
-        input_tensor = torch.zeros(1, self.channels, *self.dynamic_shape.base_shape)
-        output_tensor = torch.zeros(1, self.channels, *self.dynamic_shape.base_shape) #self.model.to(device)(input_tensor.to(device))
-        # Assuming NCHW or NCDHW, the first two axes are not relevant for computing halo
-        input_spatial_shape = input_tensor.shape[2:]
-        output_spatial_shape = output_tensor.shape[2:]
-        shape_difference = [_ishape - _oshape
-                            for _ishape, _oshape in zip(input_spatial_shape, output_spatial_shape)]
-        # Support for only symmetric halos for now
-        assert_(all(_shape_diff % 2 == 0 for _shape_diff in shape_difference),
-                "Only symmetric halos are supported.", RuntimeError)
-        # Compute halo
-        halo = [_shape_diff // 2 for _shape_diff in shape_difference]
+        """
+        Computes the halo, i.e. the context (in pixels, per axis) an output pixel depends on,
+        by back-propagating from a single output pixel and measuring how far the gradient
+        spreads in the input.
+        """
+        halo, output_offset = self._probe_receptive_field(device_id)
         if set_:
             self.halo = halo
+            self.output_offset = output_offset
         return halo
 
+    def _probe_receptive_field(self, device_id=0):
+        logger = logging.getLogger('ModelHandler._probe_receptive_field')
+        device = self.devices[device_id]
+        model = self.replica(device_id)
+        # Batchnorm in training mode would spread the gradient over the whole input
+        was_training = model.training
+        model.eval()
+        previous_spatial_shape = None
+        try:
+            for num_blocks in range(self.MAX_HALO_PROBE_BLOCKS + 1):
+                spatial_shape = self.dynamic_shape(*([num_blocks] * len(self.dynamic_shape)))
+                if spatial_shape == previous_spatial_shape:
+                    # Not dynamic, can't get any bigger
+                    break
+                previous_spatial_shape = spatial_shape
+                input_tensor = torch.rand(1, self.channels, *spatial_shape, device=device,
+                                          requires_grad=True)
+                output_tensor = model(input_tensor)
+                # Assuming NCHW or NCDHW, the first two axes are not relevant for computing halo
+                output_spatial_shape = list(output_tensor.shape[2:])
+                shape_difference = [_ishape - _oshape
+                                    for _ishape, _oshape in zip(spatial_shape,
+                                                                output_spatial_shape)]
+                # Support for only symmetric halos for now
+                assert_(all(_shape_diff % 2 == 0 for _shape_diff in shape_difference),
+                        "Only symmetric halos are supported.", RuntimeError)
+                output_offset = [_shape_diff // 2 for _shape_diff in shape_difference]
+                # Pixel in the middle of the output, and where it sits in the input
+                center = [_oshape // 2 for _oshape in output_spatial_shape]
+                output_tensor[(slice(None), slice(None)) + tuple(center)].sum().backward()
+                support = input_tensor.grad.abs().sum(dim=(0, 1)).nonzero()
+                if len(support) == 0:
+                    # Output doesn't depend on the input at all (or not through gradients)
+                    return output_offset, output_offset
+                lower, upper = support.min(dim=0)[0].tolist(), support.max(dim=0)[0].tolist()
+                halo = [max(_center + _offset - _lower, _upper - _center - _offset, _offset)
+                        for _center, _offset, _lower, _upper in zip(center, output_offset,
+                                                                     lower, upper)]
+                if all(_lower > 0 and _upper < _shape - 1
+                       for _lower, _upper, _shape in zip(lower, upper, spatial_shape)):
+                    # The receptive field fits in the input, so we've seen all of it
+                    break
+            else:
+                logger.warning(f"Receptive field is larger than the largest probe "
+                               f"({spatial_shape}); halo {halo} might be too small.")
+        finally:
+            model.train(was_training)
+            model.zero_grad()
+        logger.debug(f"Halo: {halo}, output offset: {output_offset}")
+        return halo, output_offset
+
     def crop_output_tensor(self, tensor, num_channel_axes=2):
         base_shape = self.dynamic_shape.base_shape
         roi_shape = []
@@ -429,34 +673,225 @@ class ModelHandler(Processor):
         return tensor[[slice(None)] * num_channel_axes + roi_shape]
 
     def crop_halo(self, tensor, num_channel_axes=2):
+        # The input was padded by whole halo blocks, of which the model itself already
+        # removed `output_offset`
         base_shape = self.dynamic_shape.base_shape
         roi_shape = []
-        for size, halo, blocks in zip(base_shape, self.halo, self.halo_in_blocks):
-            if halo > 0:
-                roi_shape.append(slice(size*blocks - halo, -(size*blocks - halo)))
+        for size, offset, blocks in zip(base_shape, self.output_offset, self.halo_in_blocks):
+            if size * blocks - offset > 0:
+                roi_shape.append(slice(size*blocks - offset, -(size*blocks - offset)))
             else:
                 roi_shape.append(slice(None))
-        return tensor[[slice(None)] * num_channel_axes + roi_shape]
+        return tensor[tuple([slice(None)] * num_channel_axes + roi_shape)]
 
-    def forward(self, input_tensor):
+    def forward(self, input_tensor, cancelled=None):
         """
         Parameters
         ----------
         input_tensor: torch.Tensor
+        cancelled: callable
+            Checked between blocks; see `Blockinator.process`.
         """
         logger = logging.getLogger('ModelHandler.forward')
         self.update_state()
-        logger.info(f"Params have changed by norm {self._evaluate_parameter_diff()} "
-                    f"since last forward.")
+        if self.result_cache is None:
+            return self._forward(input_tensor, cancelled)
+        # Look up samples one by one, so a batch with some known samples only processes the rest
+        keys = [self.result_cache.key(sample, self.model_version) for sample in input_tensor]
+        outputs = [self.result_cache.get(key) for key in keys]
+        missing = [idx for idx, output in enumerate(outputs) if output is None]
+        logger.info(f"{len(keys) - len(missing)} of {len(keys)} samples found in cache.")
+        if missing:
+            for idx, output in zip(missing, self._forward(input_tensor[missing], cancelled)):
+                # Clone to not keep the whole batch alive
+                outputs[idx] = output.clone()
+                self.result_cache.put(keys[idx], outputs[idx])
+        return torch.stack(outputs)
+
+    def _forward(self, input_tensor, cancelled=None):
         block = Blockinator(input_tensor, self.dynamic_shape.base_shape,
                             num_channel_axes=2, pad_fn=th_pad)
         with block.attach(self):
-            output_tensor = block.process()
+            output_tensor = block.process(cancelled=cancelled)
         return output_tensor
 
-    def to_device(self, obj):
-        return obj.to(self.device)
+    def forward_tiles(self, input_tensor, tile_shape=None):
+        """
+        Like `forward`, but yields `(slices, output_tile)` tile by tile as they're computed.
 
-    def process_tensor(self, tensor):
-        tensor = self.to_device(tensor)
-        return self.model(tensor)
+        Parameters
+        ----------
+        input_tensor: torch.Tensor
+        tile_shape: list
+            Spatial shape of a tile; rounded up to whole dynamic base shape blocks.
+            Defaults to a single block.
+        """
+        self.update_state()
+        if tile_shape is not None:
+            tile_shape = [int(np.ceil(_size / _block_shape))
+                          for _size, _block_shape in zip(tile_shape,
+                                                         self.dynamic_shape.base_shape)]
+        block = Blockinator(input_tensor, self.dynamic_shape.base_shape,
+                            num_channel_axes=2, pad_fn=th_pad)
+        with block.attach(self):
+            yield from block.tiles(tile_shape)
+
+    def replica(self, device_id=0):
+        """
+        Returns the model on device `device_id`. That's `model` itself for the first device,
+        and a copy that follows its weights for the others.
+        """
+        if device_id == 0:
+            return self.model
+        replica, version = self._replicas.get(device_id, (None, None))
+        if replica is None:
+            replica = deepcopy(self.model).to(self.devices[device_id])
+        elif version != self.model_version:
+            replica.load_state_dict(self.model.state_dict())
+        self._replicas[device_id] = (replica, self.model_version)
+        return replica
+
+    def tile_blocks(self, device_id=0):
+        """
+        Number of blocks (per axis) of a tile (without its halo) processed on `device_id`:
+        the one with the best throughput if tiles were tuned, else the largest the dry run
+        allows, else a single block.
+        """
+        # CPU workers share the one device
+        device_id = 0 if self._cpu_workers is not None else device_id
+        if device_id in self._tuned_tiles:
+            return list(self._tuned_tiles[device_id][1])
+        return self._max_tile_blocks(device_id)
+
+    def tile_batch_size(self, device_id=0):
+        """Number of tiles to process on `device_id` at once."""
+        device_id = 0 if self._cpu_workers is not None else device_id
+        return self._tuned_tiles[device_id][0] if device_id in self._tuned_tiles else 1
+
+    def tune_tile(self, device_id=0, num_repeats=2):
+        """
+        Benchmarks tiles (of up to the largest size the dry run allows) and batch sizes on
+        `device_id`, and keeps the combination that gets through the most output voxels (i.e.
+        after cropping the halo) per second.
+
+        Returns
+        -------
+        tuple
+            (batch size, tile blocks)
+        """
+        logger = logging.getLogger('ModelHandler.tune_tile')
+        device = self.devices[device_id]
+        max_blocks = self._max_tile_blocks(device_id)
+        halo = self.halo_in_blocks
+        base_shape = self.dynamic_shape.base_shape
+        # Input volume (in blocks) the dry run says fits at once
+        capacity = np.prod([_blocks + 2 * _halo for _blocks, _halo in zip(max_blocks, halo)])
+        tiles = sorted({tuple(min(2 ** power, _max_blocks) for _max_blocks in max_blocks)
+                        for power in range(max(max_blocks).bit_length() + 1)})
+        best = None
+        for tile in tiles:
+            for batch_size in range(1, self.MAX_TILE_BATCH_SIZE + 1):
+                input_blocks = [_blocks + 2 * _halo for _blocks, _halo in zip(tile, halo)]
+                if batch_size * np.prod(input_blocks) > capacity:
+                    break
+                input_tensor = torch.rand(batch_size, self.channels,
+                                          *[_blocks * _size
+                                            for _blocks, _size in zip(input_blocks, base_shape)])
+                try:
+                    with torch.no_grad():
+                        # Warm up (long enough for the shape to get compiled, if we compile)
+                        for _ in range(self.COMPILE_AFTER):
+                            self.process_tensor(input_tensor, device_id)
+                        self._synchronize(device)
+                        start = time.perf_counter()
+                        for _ in range(num_repeats):
+                            self.process_tensor(input_tensor, device_id)
+                        self._synchronize(device)
+                        elapsed = time.perf_counter() - start
+                except RuntimeError as e:
+                    logger.debug(f"{batch_size} x {list(tile)} failed on {device}: {e}")
+                    break
+                voxels_per_second = num_repeats * batch_size * \
+                    np.prod([_blocks * _size for _blocks, _size in zip(tile, base_shape)]) / elapsed
+                logger.debug(f"{batch_size} x {list(tile)} on {device}: "
+                             f"{voxels_per_second:.3g} voxels/s")
+                if best is None or voxels_per_second > best[0]:
+                    best = (voxels_per_second, batch_size, [int(_blocks) for _blocks in tile])
+        if best is None:
+            return self.tile_batch_size(device_id), self.tile_blocks(device_id)
+        _, batch_size, tile_blocks = best
+        logger.info(f"Best tile on {device}: {batch_size} x {tile_blocks} blocks.")
+        self._tuned_tiles[device_id] = (batch_size, tile_blocks)
+        return batch_size, tile_blocks
+
+    @staticmethod
+    def _synchronize(device):
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+
+    def _max_tile_blocks(self, device_id):
+        device_spec = self._device_specs.get(device_id)
+        if device_spec is None:
+            return [1] * len(self.dynamic_shape)
+        return [max(_size // _block_shape - 2 * _halo, 1)
+                for _size, _block_shape, _halo in zip(device_spec.shape,
+                                                      self.dynamic_shape.base_shape,
+                                                      self.halo_in_blocks)]
+
+    def to_device(self, obj, device_id=0):
+        return obj.to(self.devices[device_id])
+
+    def process_tensor(self, tensor, device_id=0):
+        logger = logging.getLogger('ModelHandler.process_tensor')
+        cpu_workers = self._cpu_workers
+        if cpu_workers is not None:
+            if self._cpu_workers_version != self.model_version:
+                cpu_workers.update_state(self.model.state_dict())
+                self._cpu_workers_version = self.model_version
+            try:
+                return cpu_workers.process_tensor(tensor, worker_id=device_id)
+            except CPUWorkerPool.WorkerDied as e:
+                logger.error(f"{e} Running inference in this process from now on.")
+                self.stop_cpu_workers()
+        if device_id >= self.num_devices:
+            # Tiles meant for a CPU worker (all of which share the one device), now that the
+            # workers are gone; other threads may have stopped them since the tiles were handed out
+            device_id = 0
+        if self.inference_mode != 'float32':
+            output = self._process_in_mode(self.to_device(tensor, device_id), device_id)
+            if output is not None:
+                return output
+        model = self.replica(device_id)
+        if self.compiled_models is not None:
+            compiled_model = self._compiled_model(tuple(tensor.shape), device_id)
+            if compiled_model is not None:
+                model = compiled_model
+        tensor = self.to_device(tensor, device_id)
+        return model(tensor)
+
+    def _process_in_mode(self, tensor, device_id=0):
+        version, run = self._mode_runners.get(device_id, (None, None))
+        if version != self.model_version:
+            if not self.weights_settled:
+                # Not worth recalibrating for every version training publishes
+                return None
+            # (Re)calibrate on this tile
+            run = prepare_inference_mode(self.inference_mode, self.replica(device_id), tensor)
+            self._mode_runners[device_id] = (self.model_version, run)
+        return None if run is None else run(tensor)
+
+    def _compiled_model(self, input_shape, device_id=0):
+        count = self._shape_counts[input_shape] = self._shape_counts.get(input_shape, 0) + 1
+        if not self.weights_settled:
+            # While training, the weights change every `Trainer.max_state_staleness` seconds or
+            # so; hashing them and compiling for every version would cost more than it saves.
+            return None
+        version, state_hash = self._state_hash
+        if version != self.model_version:
+            # Modules compiled with the old weights are no use anymore
+            self.compiled_models.clear()
+            state_hash = CapacityCache.state_hash(self.model)
+            self._state_hash = (self.model_version, state_hash)
+        return self.compiled_models.get(self.replica(device_id), state_hash, input_shape,
+                                        self.devices[device_id],
+                                        compile=count >= self.COMPILE_AFTER)
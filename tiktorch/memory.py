@@ -0,0 +1,173 @@
+import os
+import weakref
+
+import numpy as np
+import torch
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+class _TensorSize(object):
+    """
+    Size (in bytes) of a tensor as a function of the number of blocks of the dynamic shape,
+    fitted from the tensor's shape at two block counts.
+    """
+    def __init__(self, shape0, shape1, element_size, num_spatial_dims):
+        self.element_size = element_size
+        self.numel = int(np.prod(shape0))
+        if len(shape0) >= num_spatial_dims and len(shape0) == len(shape1) and \
+                shape0[:-num_spatial_dims] == shape1[:-num_spatial_dims]:
+            # Spatial extents are affine in the number of blocks along that axis
+            self.prefix = int(np.prod(shape0[:-num_spatial_dims]))
+            self.intercepts = list(shape0[-num_spatial_dims:])
+            self.slopes = [e1 - e0 for e0, e1 in zip(shape0[-num_spatial_dims:],
+                                                     shape1[-num_spatial_dims:])]
+        else:
+            # E.g. flattened features; assume they scale with the input volume
+            self.prefix = None
+
+    def at(self, num_blocks, input_volume_ratio):
+        if self.prefix is None:
+            return int(self.numel * input_volume_ratio) * self.element_size
+        extents = [max(intercept + slope * n, 0)
+                   for intercept, slope, n in zip(self.intercepts, self.slopes, num_blocks)]
+        return self.prefix * int(np.prod(extents)) * self.element_size
+
+
+class ActivationMemoryModel(object):
+    """
+    Predicts how much memory the model needs for an input of a given number of blocks of the
+    dynamic shape, from the activation sizes recorded by forward hooks on the leaf modules.
+    """
+    def __init__(self, dynamic_shape, parameter_bytes, input_size, layers, live):
+        self.dynamic_shape = dynamic_shape
+        self.parameter_bytes = parameter_bytes
+        self.input_size = input_size
+        # List of (input sizes, output sizes) of every leaf module call, in order
+        self.layers = layers
+        # For every leaf module call, the activations alive right after it: outputs of this
+        # or earlier calls as (call, output) indices (e.g. encoder features kept for a skip
+        # connection), and the indices of its inputs that no leaf module produced (e.g. the
+        # result of a torch.cat in the forward).
+        self.live = live
+
+    @classmethod
+    def calibrate(cls, model, channels, dynamic_shape, device):
+        """
+        Runs the model (without gradients) on the two smallest inputs the dynamic shape allows,
+        and fits how each activation grows with the number of blocks.
+        """
+        num_spatial_dims = len(dynamic_shape)
+        records = []
+        # (weak reference, (call, output) index) of the outputs of the current run; an output
+        # is alive as long as the forward still holds on to it
+        outputs_seen = []
+        def find(tensor):
+            for ref, index in outputs_seen:
+                if ref() is tensor:
+                    return index
+            return None
+        def hook(module, inputs, outputs):
+            inputs, outputs = _tensors_in(inputs), _tensors_in(outputs)
+            call = len(records[-1])
+            for k, t in enumerate(outputs):
+                # In-place outputs are the same tensor as an earlier one
+                if find(t) is None:
+                    outputs_seen.append((weakref.ref(t), (call, k)))
+            live = [index for ref, index in outputs_seen if ref() is not None]
+            untracked = [m for m, t in enumerate(inputs)
+                         if t is not input_tensor and find(t) is None]
+            # Only the shapes, the activations themselves can go
+            records[-1].append(([(tuple(t.shape), t.element_size()) for t in inputs],
+                                [(tuple(t.shape), t.element_size()) for t in outputs],
+                                (live, untracked)))
+        leaves = [module for module in model.modules() if len(list(module.children())) == 0]
+        handles = [leaf.register_forward_hook(hook) for leaf in leaves]
+        input_shapes = []
+        try:
+            with torch.no_grad():
+                model.to(device)
+                for n in (0, 1):
+                    records.append([])
+                    outputs_seen.clear()
+                    input_tensor = torch.zeros(1, channels,
+                                               *dynamic_shape(*([n] * num_spatial_dims)),
+                                               device=device)
+                    input_shapes.append(tuple(input_tensor.shape))
+                    model(input_tensor)
+        finally:
+            for handle in handles:
+                handle.remove()
+        assert len(records[0]) == len(records[1]), "Model runs different layers for different " \
+                                                   "input shapes."
+        layers = []
+        live = []
+        for (inputs0, outputs0, live0), (inputs1, outputs1, live1) in zip(*records):
+            assert len(inputs0) == len(inputs1) and len(outputs0) == len(outputs1)
+            assert live0 == live1, "Model keeps different activations for different input shapes."
+            layers.append(([_TensorSize(shape0, shape1, element_size, num_spatial_dims)
+                            for (shape0, element_size), (shape1, _) in zip(inputs0, inputs1)],
+                           [_TensorSize(shape0, shape1, element_size, num_spatial_dims)
+                            for (shape0, element_size), (shape1, _) in zip(outputs0, outputs1)]))
+            live.append(live0)
+        parameter_bytes = sum(p.numel() * p.element_size() for p in model.parameters())
+        input_size = _TensorSize(input_shapes[0], input_shapes[1], 4, num_spatial_dims)
+        return cls(dynamic_shape, parameter_bytes, input_size, layers, live)
+
+    def predict(self, num_blocks, train=False):
+        """
+        Peak memory (in bytes, not counting the weights themselves) for one sample of
+        `num_blocks` blocks. Without gradients, that's the most activations that were alive at
+        the same time during the calibration run; for training, all activations are kept for
+        the backward pass, along with the gradients of the weights.
+        """
+        input_volume_ratio = np.prod(self.dynamic_shape(*num_blocks)) / \
+            np.prod(self.dynamic_shape.base_shape)
+        input_bytes = self.input_size.at(num_blocks, input_volume_ratio)
+        layer_bytes = [([size.at(num_blocks, input_volume_ratio) for size in inputs],
+                        [size.at(num_blocks, input_volume_ratio) for size in outputs])
+                       for inputs, outputs in self.layers]
+        if train:
+            return input_bytes + self.parameter_bytes + \
+                sum(sum(output_bytes) for _, output_bytes in layer_bytes)
+        live_bytes = [sum(layer_bytes[call][1][k] for call, k in outputs) +
+                      sum(layer_bytes[idx][0][m] for m in inputs)
+                      for idx, (outputs, inputs) in enumerate(self.live)]
+        return input_bytes + max(live_bytes, default=0)
+
+
+def _tensors_in(obj):
+    if isinstance(obj, torch.Tensor):
+        return [obj]
+    elif isinstance(obj, (list, tuple)):
+        return [tensor for item in obj for tensor in _tensors_in(item)]
+    elif isinstance(obj, dict):
+        return [tensor for item in obj.values() for tensor in _tensors_in(item)]
+    return []
+
+
+def available_memory(device):
+    """Bytes that can still be allocated on `device`, or None if we can't tell."""
+    device = torch.device(device)
+    if device.type == 'cuda':
+        free, _ = torch.cuda.mem_get_info(device)
+        # Memory torch has cached but isn't using is free for our purposes too
+        return free + torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+    if psutil is not None:
+        return psutil.virtual_memory().available
+    # Page cache the kernel can reclaim counts as available (unlike in MemFree)
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError):
+        # E.g. macOS, which has neither
+        return None
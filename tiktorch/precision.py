@@ -0,0 +1,98 @@
+import logging
+import warnings
+from copy import deepcopy
+
+import torch
+
+# Bytes per activation, relative to float32
+INFERENCE_MODES = {'float32': 1.,
+                   'bfloat16': 0.5,
+                   'channels_last': 1.,
+                   'int8': 0.25}
+# Largest error (relative to the float32 output) a mode may make on the sample tile
+TOLERANCES = {'bfloat16': 2e-2,
+              'channels_last': 1e-4,
+              'int8': 5e-2}
+
+
+def relative_error(output, expected):
+    expected = expected.float()
+    return ((output.float() - expected).norm() / expected.norm().clamp(min=1e-12)).item()
+
+
+def prepare_inference_mode(mode, model, sample):
+    """
+    Gets `model` ready to run in `mode`, calibrating it on `sample` where needed, and checks
+    its output on `sample` against float32.
+
+    Parameters
+    ----------
+    mode: str
+        One of `INFERENCE_MODES`.
+    model: torch.nn.Module
+    sample: torch.Tensor
+        Input tile on the device the model is on.
+
+    Returns
+    -------
+    callable
+        Runs a tensor through the model in `mode` and returns a float32 output, or None if the
+        mode isn't supported for this model or isn't accurate enough.
+    """
+    logger = logging.getLogger('prepare_inference_mode')
+    assert mode in INFERENCE_MODES, f"Unknown inference mode {mode}."
+    with torch.no_grad():
+        expected = model(sample)
+    if mode == 'float32':
+        return model
+    try:
+        run = _PREPARERS[mode](model, sample)
+        with torch.no_grad():
+            error = relative_error(run(sample), expected)
+    except Exception as e:
+        logger.warning(f"Could not run model in {mode}, falling back to float32: {e}")
+        return None
+    if error > TOLERANCES[mode]:
+        logger.warning(f"Output in {mode} is off by {error:.2g} relative to float32 (tolerance "
+                       f"{TOLERANCES[mode]:.2g}), falling back to float32.")
+        return None
+    logger.info(f"Running model in {mode}; relative error on the sample tile: {error:.2g}.")
+    return run
+
+
+def _prepare_bfloat16(model, sample):
+    def run(tensor):
+        with torch.autocast(tensor.device.type, dtype=torch.bfloat16):
+            return model(tensor).float()
+    return run
+
+
+def _prepare_channels_last(model, sample):
+    memory_format = {4: torch.channels_last, 5: torch.channels_last_3d}[sample.dim()]
+    # On a copy: converting in place would swap out the parameters the trainer shares with
+    # the model, and leave it in channels_last when the mode is switched back
+    model = deepcopy(model).to(memory_format=memory_format)
+    def run(tensor):
+        return model(tensor.contiguous(memory_format=memory_format)).contiguous()
+    return run
+
+
+def _prepare_int8(model, sample):
+    # Post-training static quantization, with observers calibrated on the sample
+    assert sample.device.type == 'cpu', "int8 inference is only supported on CPU."
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+        prepared = prepare_fx(deepcopy(model).eval(),
+                              get_default_qconfig_mapping(torch.backends.quantized.engine),
+                              example_inputs=(sample,))
+        with torch.no_grad():
+            prepared(sample)
+        quantized = convert_fx(prepared)
+    return quantized
+
+
+_PREPARERS = {'bfloat16': _prepare_bfloat16,
+              'channels_last': _prepare_channels_last,
+              'int8': _prepare_int8}
@@ -0,0 +1,163 @@
+import time
+import logging
+import threading as thr
+from collections import OrderedDict, deque
+
+logger = logging.getLogger('Scheduler')
+
+
+class Job(object):
+    """
+    A request waiting for compute. Jobs with the same (not None) `batch_key` can be coalesced
+    and run in one go; `batch_size` is the number of samples the job contributes to the batch.
+    Jobs with a higher `priority` are served first. If `cancellable`, the method is called with
+    a `cancelled` keyword: a callable that tells it whether it should give up.
+    """
+    def __init__(self, rid, method, args=(), batch_key=None, batch_size=1, priority=0,
+                 cancellable=False):
+        self.rid = rid
+        self.method = method
+        self.args = args
+        self.batch_key = batch_key
+        self.batch_size = batch_size
+        self.priority = priority
+        self.cancellable = cancellable
+        self.cancelled = thr.Event()
+
+    def __call__(self):
+        if self.cancellable:
+            return self.method(*self.args, cancelled=self.cancelled.is_set)
+        return self.method(*self.args)
+
+    def __repr__(self):
+        return f"Job(rid={self.rid}, method={self.method.__name__}, batch_key={self.batch_key}, " \
+               f"priority={self.priority})"
+
+
+class RequestScheduler(object):
+    """
+    Queues compute jobs per client and hands out the ones with the highest priority first, and
+    round-robin over clients among those, so that a client with a long backlog can't starve the
+    others. Jobs of one client with the same priority are served in order.
+    """
+    def __init__(self):
+        # Privates
+        self._queues = OrderedDict()
+        # Jobs that were handed out but aren't done yet, by (client, rid)
+        self._running = {}
+        self._condition = thr.Condition()
+        self._closed = False
+
+    def put(self, client, job):
+        with self._condition:
+            self._queues.setdefault(client, deque()).append(job)
+            self._condition.notify()
+        return self
+
+    def _pop(self):
+        best = None
+        for client, jobs in self._queues.items():
+            for job in jobs:
+                # Ties go to whoever is first in line
+                if best is None or job.priority > best[1].priority:
+                    best = client, job
+        if best is None:
+            return None
+        client, job = best
+        self._queues[client].remove(job)
+        # Send this client to the back of the line
+        self._queues.move_to_end(client)
+        self._running[client, job.rid] = job
+        return best
+
+    def get(self):
+        """
+        Blocks until a job is available and returns it as (client, job). Returns None once the
+        scheduler is closed and all jobs have been handed out.
+        """
+        with self._condition:
+            while True:
+                item = self._pop()
+                if item is not None:
+                    return item
+                if self._closed:
+                    return None
+                self._condition.wait()
+
+    def _take_matching(self, batch_key, max_batch_size):
+        taken = []
+        for client, jobs in self._queues.items():
+            for job in list(jobs):
+                if job.batch_key != batch_key:
+                    continue
+                if job.batch_size > max_batch_size:
+                    return taken
+                jobs.remove(job)
+                self._running[client, job.rid] = job
+                taken.append((client, job))
+                max_batch_size -= job.batch_size
+        return taken
+
+    def collect(self, batch_key, max_batch_size, max_delay=0.):
+        """
+        Takes pending jobs with the given `batch_key` (from any client) that fit in
+        `max_batch_size` samples. If there aren't enough, waits up to `max_delay` seconds for more
+        to come in. Returns a list of (client, job).
+        """
+        deadline = time.time() + max_delay
+        collected = []
+        with self._condition:
+            while True:
+                taken = self._take_matching(batch_key, max_batch_size)
+                collected.extend(taken)
+                max_batch_size -= sum(job.batch_size for _, job in taken)
+                remaining = deadline - time.time()
+                if max_batch_size <= 0 or remaining <= 0 or self._closed:
+                    break
+                self._condition.wait(remaining)
+        return collected
+
+    def done(self, client, job):
+        """Marks a job that was handed out as done."""
+        with self._condition:
+            self._running.pop((client, job.rid), None)
+        return self
+
+    def cancel(self, client, rid):
+        """
+        Cancels job `rid` of a client. A pending job is taken out of the queue and returned;
+        a running job is flagged (it's up to the job to notice) and None is returned.
+        """
+        with self._condition:
+            for job in self._queues.get(client, ()):
+                if job.rid == rid:
+                    self._queues[client].remove(job)
+                    return job
+            job = self._running.get((client, rid))
+            if job is not None:
+                job.cancelled.set()
+        return None
+
+    def drop(self, client):
+        """
+        Forgets a client along with its pending jobs, which are returned. Its running jobs
+        are cancelled.
+        """
+        with self._condition:
+            jobs = self._queues.pop(client, deque())
+            for (_client, _), job in self._running.items():
+                if _client == client:
+                    job.cancelled.set()
+        if jobs:
+            logger.info(f"Dropped {len(jobs)} pending jobs.")
+        return list(jobs)
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        return self
+
+    def __len__(self):
+        with self._condition:
+            return sum(len(jobs) for jobs in self._queues.values())
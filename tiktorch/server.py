@@ -1,19 +1,28 @@
+import inspect
 import logging
 import os
+import queue
+import threading as thr
+from argparse import Namespace
 from importlib import util as imputils
+from itertools import count
 import zmq
 
 import numpy as np
 import torch
-import torch.distributed as dist
 import yaml
 from datetime import datetime
 import socket
 
-from tiktorch.tio import TikIn, TikOut
+from tiktorch.tio import TikIn, TikOut, TikRef
+from tiktorch.transport import (make_transport, shm_probe_visible, encode_output,
+                                COMPRESSORS, OUTPUT_DTYPES)
 import tiktorch.utils as utils
 from tiktorch.device_handler import ModelHandler
-from tiktorch.models.dunet import DUNet
+from tiktorch.blockinator import Blockinator
+from tiktorch.cache import ResultCache, CapacityCache, CompiledModelCache
+from tiktorch.scheduler import Job, RequestScheduler
+from tiktorch.workers import available_cores
 
 
 if torch.cuda.is_available():
@@ -23,16 +32,45 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger('TikTorchServer')
 
 
-class TikTorchServer(object):
-    RANK = 1
-    SIZE = 2
+class ClientSession(object):
+    """State the server keeps per connected client."""
+    def __init__(self, identity, transport, ilp_directory=None, output_dtype='float32'):
+        self.identity = identity
+        self.transport = transport
+        self.ilp_directory = ilp_directory
+        # Precision the client wants its outputs in
+        self.output_dtype = output_dtype
+        # Training data being uploaded in chunks, by upload id
+        self.uploads = {}
+        # Handles of tensors sent to the client, by reply id, until the client acknowledges
+        # the reply. (Streaming requests get many replies, which are read one by one.)
+        self.reply_ids = count()
+        self.reply_handles = {}
+
+    def close(self):
+        self.transport.close()
+        return self
+
 
-    def __init__(self, address='127.0.0.1', port='29500',
-                 meta_port='29501', device=None):
+class TikTorchServer(object):
+    # Forward requests with the same input shape are run as one batch of up to this many samples
+    MAX_BATCH_SIZE = 8
+    # How long (in seconds) to hold a forward request back waiting for others to batch it with.
+    # By default, only requests that are already pending are batched.
+    MAX_BATCH_DELAY = 0.
+    # Bytes worth of outputs to keep around for repeated requests (0 to disable)
+    RESULT_CACHE_SIZE = 256 * 2 ** 20
+
+    def __init__(self, address='127.0.0.1', meta_port='29501', device=None,
+                 build_directory=None, persistent=False, max_batch_size=None,
+                 max_batch_delay=None, endpoint=None, result_cache_size=None, cpu_workers=None,
+                 compile_model=False):
         logger = logging.getLogger("TikTorchServer.__init__")
         # Privates
         self._build_directory = None
         self._handler: ModelHandler = None
+        # The model is loaded (once) by whichever thread needs it first, normally the compute one
+        self._handler_lock = thr.Lock()
         self._model = None
         self._config = {}
         self._log_directory = None
@@ -40,6 +78,12 @@ class TikTorchServer(object):
         self._zmq_context: zmq.Context = None
         self._zmq_socket: zmq.Socket = None
         self._zmq_pollin: zmq.Poller = None
+        # Clients, by their ZMQ identity
+        self._sessions = {}
+        # Requests that need compute are handled by a separate thread, round-robin over clients
+        self._scheduler = RequestScheduler()
+        self._outbox = queue.Queue()
+        self._worker: thr.Thread = None
         if device is None:
             # The default behaviour is to select a GPU if one is availabe.
             # This can be overriden by providing device in the constructor.
@@ -50,42 +94,106 @@ class TikTorchServer(object):
         # Publics
         self.ilp_directory = None
         self.addr = address
-        self.port = port
         self.meta_port = meta_port
+        # E.g. ipc:///tmp/tiktorch.ipc for clients on the same host. Overrides address and port.
+        self.endpoint = f'tcp://{address}:{meta_port}' if endpoint is None else endpoint
+        # If set, the server keeps running after the last client has left.
+        self.persistent = persistent
+        self.max_batch_size = self.MAX_BATCH_SIZE if max_batch_size is None else max_batch_size
+        self.max_batch_delay = self.MAX_BATCH_DELAY if max_batch_delay is None else max_batch_delay
+        self.result_cache_size = \
+            self.RESULT_CACHE_SIZE if result_cache_size is None else result_cache_size
+        # Number of worker processes to run inference in on CPU ('auto' to tune it, None or 0
+        # to run it in this process)
+        self.cpu_workers = cpu_workers
+        # Whether to run the model as TorchScript, compiled per (frequent) input shape
+        self.compile_model = compile_model
         self.init()
-        self.read_config()
+        if build_directory is not None:
+            self.build_directory = build_directory
+            self.read_config()
 
     def init(self):
         logger = logging.getLogger('TikTorchServer.init')
-        os.environ['MASTER_ADDR'] = self.addr
-        os.environ['MASTER_PORT'] = self.port
-        # Init torch distributed
-        logger.info("Initializing Process Group...")
-        dist.init_process_group(backend='tcp', rank=self.RANK, world_size=self.SIZE)
         # Init ZMQ
         logger.info("Setting up ZMQ Context...")
         self._zmq_context = zmq.Context()
         logger.info("Setting up ZMQ Socket...")
-        self._zmq_socket = self._zmq_context.socket(zmq.PAIR)
+        self._zmq_socket = self._zmq_context.socket(zmq.ROUTER)
         logger.info("Binding to socket...")
-        self._zmq_socket.connect(f'tcp://{self.addr}:{self.meta_port}')
+        self._zmq_socket.bind(self.endpoint)
         logger.info("Setting up Poller...")
         self._zmq_pollin = zmq.Poller()
         self._zmq_pollin.register(self._zmq_socket, zmq.POLLIN)
-        # Receive build directory
-        logger.info("Waiting for build directory...")
-        message = self.meta_recv()
+
+    def open_session(self, identity, message):
+        logger = logging.getLogger('TikTorchServer.open_session')
         assert message['id'] == 'INIT.PATHS'
-        self.build_directory = message['build_dir']
-        self.ilp_directory = message['ilp_dir']
-        logger.info("Build directory received.")
+        if self._build_directory is None:
+            # First client decides which model we serve
+            self.build_directory = message['build_dir']
+            try:
+                self.read_config()
+            except Exception:
+                # Not a directory we can serve; leave it to the next client
+                self._build_directory = None
+                raise
+            logger.info("Build directory received.")
+        elif os.path.realpath(message['build_dir']) != os.path.realpath(self.build_directory):
+            self.meta_send(identity, {'id': 'ERROR',
+                                      'message': f"Server is serving {self.build_directory}, "
+                                                 f"not {message['build_dir']}."})
+            return None
+        if self.ilp_directory is None and message.get('ilp_dir') is not None:
+            # Training logs go with the first client that has a project directory
+            self.ilp_directory = message['ilp_dir']
+            if self._handler is not None:
+                self._handler.trainer.log_directory = self.log_directory
+        # Negotiate transport: shared memory if the client asked for it and we're on the same host
+        # Otherwise, tensors go along with the messages.
+        if message.get('transport') == 'shm' and shm_probe_visible(message.get('shm_probe')):
+            transport = 'shm'
+        else:
+            transport = 'zmq'
+        # Compression only pays off over the wire, and only if we have the compressor
+        compression = message.get('compression')
+        if transport != 'zmq' or compression not in COMPRESSORS:
+            compression = None
+        output_dtype = message.get('output_dtype', 'float32')
+        if output_dtype not in OUTPUT_DTYPES:
+            output_dtype = 'float32'
+        logger.info(f"Using transport: {transport} (compression: {compression}, "
+                    f"output dtype: {output_dtype})")
+        self.meta_send(identity, {'id': 'INIT.TRANSPORT', 'transport': transport,
+                                  'compression': compression, 'output_dtype': output_dtype})
+        session = ClientSession(identity, make_transport(transport, compression=compression),
+                                ilp_directory=message['ilp_dir'], output_dtype=output_dtype)
+        self._sessions[identity] = session
+        logger.info(f"Opened session; {len(self._sessions)} client(s) connected.")
+        return session
+
+    def close_session(self, session):
+        logger = logging.getLogger('TikTorchServer.close_session')
+        for job in self._scheduler.drop(session.identity):
+            logger.info(f"Dropping request {job.rid} of the leaving client.")
+        session.close()
+        del self._sessions[session.identity]
+        logger.info(f"Closed session; {len(self._sessions)} client(s) connected.")
+        return self
 
-    def meta_send(self, info_dict):
-        self._zmq_socket.send_json(info_dict)
+    def meta_send(self, identity, info_dict, frames=()):
+        self._zmq_socket.send_multipart([identity, zmq.utils.jsonapi.dumps(info_dict)] +
+                                        list(frames), copy=False)
         return self
 
     def meta_recv(self):
-        return self._zmq_socket.recv_json()
+        identity, message, *frames = self._zmq_socket.recv_multipart(copy=False)
+        try:
+            request = zmq.utils.jsonapi.loads(message.bytes)
+        except ValueError:
+            request = None
+        # Anything but a JSON object is a bad request; `dispatch` turns it away.
+        return identity.bytes, request if isinstance(request, dict) else {'id': None}, frames
 
     @property
     def output_shape(self):
@@ -137,7 +245,10 @@ class TikTorchServer(object):
     @property
     def handler(self):
         if self._handler is None:
-            self.load_model()
+            with self._handler_lock:
+                # Someone else might have loaded it while we waited
+                if self._handler is None:
+                    self.load_model()
         return self._handler
 
     def dry_run(self, image_shape, train=False):
@@ -161,13 +272,32 @@ class TikTorchServer(object):
         return self
 
     def _set_handler(self, model):
+        self._handler = self._make_handler(model)
+
+    def _make_handler(self, model):
         assert self.get('input_shape') is not None
-        # Pass
-        self._handler = ModelHandler(model=model,
-                                     device_names=self._device,
-                                     channels=self.get('input_shape')[0],
-                                     dynamic_shape_code=self.get('dynamic_input_shape'),
-                                     log_directory=self.log_directory)
+        handler = ModelHandler(model=model,
+                               device_names=self._device,
+                               channels=self.get('input_shape')[0],
+                               dynamic_shape_code=self.get('dynamic_input_shape'),
+                               log_directory=self.log_directory)
+        if self.result_cache_size > 0:
+            handler.result_cache = ResultCache(self.result_cache_size)
+        handler.capacity_cache = CapacityCache(self.cache_directory)
+        # E.g. bfloat16 or int8, see tiktorch.precision
+        handler.inference_mode = self.get('inference_mode', 'float32')
+        if self.compile_model:
+            handler.compiled_models = \
+                CompiledModelCache(os.path.join(self.cache_directory, 'compiled_models'))
+        return handler
+
+    @property
+    def cache_directory(self):
+        # Dry run results, compiled models and the like go with the build directory if we may
+        # write there, and to the user cache otherwise.
+        if self._build_directory is not None and os.access(self._build_directory, os.W_OK):
+            return self._build_directory
+        return CapacityCache.default_directory()
 
     def get(self, tag, default=None, assert_exist=False):
         if assert_exist:
@@ -204,137 +334,423 @@ class TikTorchServer(object):
         except:
             logger.warning(f"state.nn file not found in {state_path}, not loading weights!")
             # raise FileNotFoundError(f"Model weights could not be found at location '{state_path}'!")
-        # Build handler
-        self._set_handler(model)
+        # Build handler; the other threads only get to see it once it's ready
+        handler = self._make_handler(model)
+        self._load_halo(handler, model)
+        if self.cpu_workers and self._device == 'cpu' and \
+                (handler.inference_mode != 'float32' or handler.compiled_models is not None):
+            logger.warning(f"Not starting CPU workers: they can't run the model in "
+                           f"{handler.inference_mode} or compiled, so it runs in this process.")
+        elif self.cpu_workers and self._device == 'cpu':
+            if self.cpu_workers == 'auto':
+                handler.start_cpu_workers()
+            else:
+                num_workers = int(self.cpu_workers)
+                handler.start_cpu_workers(num_workers,
+                                          max(len(available_cores()) // num_workers, 1))
+            logger.info(f"Running inference in {handler.num_parallel_jobs} CPU workers.")
+        self._handler = handler
+        return self
+
+    def _load_halo(self, handler, model):
+        logger = logging.getLogger('TikTorchServer._load_halo')
+        # The receptive field only depends on the architecture, so it's cached by model hash
+        model_hash = CapacityCache.model_hash(model)
+        receptive_field = handler.capacity_cache.get_receptive_field(model_hash)
+        if receptive_field is not None:
+            halo, output_offset = receptive_field
+            handler.halo = list(halo)
+            handler.output_offset = list(output_offset)
+            return self
+        logger.info("Probing receptive field...")
+        halo = handler.compute_halo()
+        handler.capacity_cache.put_receptive_field(model_hash, halo, handler.output_offset)
         return self
 
-    def forward(self):
+    @staticmethod
+    def _as_model_input(tensor):
+        # Clients send tensors in their native dtype (e.g. uint8 raw data) to save bandwidth;
+        # the model wants float32.
+        return tensor.float()
+
+    def forward(self, batches, cancelled=None):
         logger = logging.getLogger('TikTorchServer.forward')
-        logger.info("Receiving BatchSpec...")
-        batch_spec = self.meta_recv()
-        assert batch_spec['id'] == 'FORWARD.BATCHSPEC'
-        logger.info("Received BatchSpec.")
-        batches = [torch.zeros(*shape) for shape in batch_spec['shapes']]
-        for batch in batches:
-            logger.info("Receiving batch from chief.")
-            dist.recv(batch, src=0)
         # Forward
         logger.info("Feedforward.")
-        output_batches = self.handler.forward(*batches)
-        # Send output spec
+        output_batches = self.handler.forward(*[self._as_model_input(batch) for batch in batches],
+                                              cancelled=cancelled)
         logger.info("Sending OutSpec.")
-        self.meta_send({'id': 'FORWARD.OUTSPEC', 'shape': tuple(output_batches.shape)})
-        logger.info("Sending output.")
-        dist.send(output_batches, dst=0)
-        logger.info("Sent output.")
+        return {'id': 'FORWARD.OUTSPEC', 'shape': tuple(output_batches.shape)}, \
+               {'handle': output_batches}
+
+    def forward_reference(self, references, cancelled=None):
+        """
+        Forward pass over samples the server reads from files itself (`TikRef`s), instead of
+        having them sent over.
+        """
+        logger = logging.getLogger('TikTorchServer.forward_reference')
+        logger.info(f"Reading {len(references)} samples.")
+        batch = TikIn([reference.read() for reference in references]).batcher(
+            self.get('input_shape'))
+        return self.forward([batch], cancelled=cancelled)
 
-    def train(self):
+    def forward_batch(self, jobs):
+        """
+        Runs several forward jobs with the same input shape as a single batch, and splits the
+        output back up. Returns a reply per job.
+        """
+        logger = logging.getLogger('TikTorchServer.forward_batch')
+        inputs = [job.args[0][0] for job in jobs]
+        logger.info(f"Feedforward of {len(jobs)} requests ({sum(len(i) for i in inputs)} samples).")
+        # Only worth stopping if nobody wants the output anymore
+        output_batches = self.handler.forward(self._as_model_input(torch.cat(inputs, dim=0)),
+                                              cancelled=lambda: all(job.cancelled.is_set()
+                                                                    for job in jobs))
+        outputs = torch.split(output_batches, [len(i) for i in inputs], dim=0)
+        return [({'id': 'FORWARD.OUTSPEC', 'shape': tuple(output.shape)}, {'handle': output})
+                for output in outputs]
+
+    def forward_stream(self, batches, tile_shape=None):
+        """
+        Runs a forward pass tile by tile, yielding a FORWARD.TILE reply (with the tile's spatial
+        slices in the output) for each tile as soon as it's done, and finally a FORWARD.DONE.
+        """
+        logger = logging.getLogger('TikTorchServer.forward_stream')
+        utils.assert_(len(batches) == 1, f"Streaming forward takes a single input, "
+                                         f"got {len(batches)}.", ValueError)
+        logger.info("Feedforward (streaming).")
+        num_tiles = 0
+        for slices, tile in self.handler.forward_tiles(self._as_model_input(batches[0]),
+                                                       tile_shape=tile_shape):
+            num_tiles += 1
+            yield {'id': 'FORWARD.TILE',
+                   'slices': [[_slice.start, _slice.stop] for _slice in slices]}, \
+                  {'handle': tile}
+        logger.info(f"Sent {num_tiles} tiles.")
+        yield {'id': 'FORWARD.DONE', 'num_tiles': num_tiles}, {}
+
+    def train(self, data, labels):
         logger = logging.getLogger('TikTorchServer.train')
-        logger.info("Receiving BatchSpec")
-        batch_spec = self.meta_recv()
-        assert batch_spec['id'] == 'TRAIN.BATCHSPEC'
-        logger.info("Receiving data and labels from chief.")
-        data = [torch.zeros(*shape) for shape in batch_spec['data.shapes']]
-        labels = [torch.zeros(*shape) for shape in batch_spec['labels.shapes']]
-        # Receive tensors
-        for _data in data:
-            dist.recv(_data, src=0)
-        for _label in labels:
-            dist.recv(_label, src=0)
-        logger.info("Received data and labels from chief.")
         logger.info("Sending to handler.")
-        self.handler.train(data, labels)
+        self.handler.train([self._as_model_input(_data) for _data in data],
+                           [self._as_model_input(_label) for _label in labels])
         logger.info("Sent to handler.")
+        return {'id': 'TRAIN.RECEIVED'}, {}
 
-    def set_hparams(self):
+    def set_hparams(self, hparams):
         logger = logging.getLogger('TikTorchServer.set_hparams')
-        logger.info("Receiving new hyperparameters from client.")
-        hparams = self.meta_recv()
-        assert hparams['id'] == 'TRAIN.HYPERPARAMETERS'
         logger.info("Sending to handler.")
-        self.handler.set_hparams(hparams['parameters'])
+        self.handler.set_hparams(hparams)
         logger.info("Sent to handler.")
+        return {'id': 'DISPATCHING.HYPERPARAMETERS'}, {}
+
+    def reply(self, session, rid, info, tensors=None):
+        """
+        Sends a reply to request `rid` of a client. Tensors in `tensors` (dict) are sent through
+        the client's transport (in the precision the client asked for), with their handles under
+        the corresponding keys of `info`. If the transport reuses buffers, the reply gets an
+        `ack` id, and its handles stay reserved until the client acknowledges that id.
+        """
+        info = dict(info, rid=rid)
+        tensors = tensors or {}
+        frames = []
+        handles = []
+        for field, tensor in tensors.items():
+            tensor, encoding = encode_output(tensor, session.output_dtype)
+            info[field] = session.transport.describe(tensor, frames)
+            if encoding is not None:
+                info[field]['encoding'] = encoding
+            handles.append(info[field])
+        if handles and session.transport.reuses_buffers:
+            info['ack'] = next(session.reply_ids)
+            session.reply_handles[info['ack']] = handles
+        self.meta_send(session.identity, info, frames)
+        return self
 
+    def _work(self, outbox_address):
+        # This runs in the compute thread. It takes jobs from the scheduler and hands the replies
+        # back to the I/O loop, which is the only one allowed to talk to the clients.
+        logger = logging.getLogger('TikTorchServer._work')
+        wake_socket = self._zmq_context.socket(zmq.PUSH)
+        wake_socket.connect(outbox_address)
+        while True:
+            item = self._scheduler.get()
+            if item is None:
+                break
+            jobs = [item]
+            identity, job = item
+            if job.batch_key is not None and job.batch_size < self.max_batch_size:
+                jobs += self._scheduler.collect(job.batch_key,
+                                                self.max_batch_size - job.batch_size,
+                                                self.max_batch_delay)
+            try:
+                if len(jobs) == 1:
+                    result = job()
+                    if inspect.isgenerator(result):
+                        # Streaming job: each partial reply goes out as soon as it's ready.
+                        # Cancelling stops it between tiles.
+                        for info, tensors in result:
+                            if job.cancelled.is_set():
+                                result.close()
+                                raise Blockinator.Cancelled
+                            self._outbox.put((identity, job.rid, info, tensors))
+                            wake_socket.send(b'')
+                        replies = []
+                    else:
+                        replies = [result]
+                else:
+                    replies = self.forward_batch([job for _, job in jobs])
+            except Blockinator.Cancelled:
+                logger.info(f"Request(s) {[job.rid for _, job in jobs]} cancelled.")
+                replies = [({'id': 'CANCELLED'}, {})] * len(jobs)
+            except Exception as e:
+                logger.exception(f"Request(s) {[job.rid for _, job in jobs]} failed.")
+                replies = [({'id': 'ERROR', 'message': f"{type(e).__name__}: {e}"}, {})] * len(jobs)
+            for identity, job in jobs:
+                self._scheduler.done(identity, job)
+            for (identity, job), (info, tensors) in zip(jobs, replies):
+                if job.cancelled.is_set():
+                    # Part of a batch that ran anyway
+                    info, tensors = {'id': 'CANCELLED'}, {}
+                self._outbox.put((identity, job.rid, info, tensors))
+            wake_socket.send(b'')
+        wake_socket.close()
+        logger.info("Compute thread stopped.")
+
+    def _flush_outbox(self):
+        while True:
+            try:
+                identity, rid, info, tensors = self._outbox.get_nowait()
+            except queue.Empty:
+                break
+            session = self._sessions.get(identity)
+            if session is None:
+                # Client left in the mean time
+                continue
+            self.reply(session, rid, info, tensors)
+
+    def dispatch(self, identity, request, frames=()):
+        """
+        Handles a request from a client. Compute heavy requests go to the compute thread,
+        everything else is answered right away. Returns False if the server should shut down.
+        """
+        logger = logging.getLogger('TikTorchServer.dispatch')
+        session = self._sessions.get(identity)
+        if session is None:
+            if request['id'] == 'INIT.PATHS':
+                self.open_session(identity, request)
+            else:
+                logger.error(f"Got {request['id']} from a client without a session.")
+                self.meta_send(identity, {'id': 'ERROR', 'rid': request.get('rid'),
+                                          'message': "No session; send INIT.PATHS first."})
+            return True
+        rid = request.get('rid')
+        if request['id'] == 'FORWARD.BATCHSPEC':
+            logger.info("Received request to dispatch forward.")
+            batches = [session.transport.recv(handle, frames) for handle in request['handles']]
+            # Single input requests of the same shape can be batched together
+            if len(batches) == 1:
+                batch_key = (tuple(batches[0].shape[1:]), str(batches[0].dtype))
+                batch_size = len(batches[0])
+            else:
+                batch_key, batch_size = None, 1
+            self._scheduler.put(identity, Job(rid, self.forward, (batches,),
+                                              batch_key=batch_key, batch_size=batch_size,
+                                              priority=request.get('priority', 0),
+                                              cancellable=True))
+        elif request['id'] == 'FORWARD.REFERENCE':
+            logger.info("Received request to dispatch forward on referenced data.")
+            # Reading happens in the compute thread, so a slow disk doesn't hold up the others
+            references = [TikRef.from_dict(spec) for spec in request['references']]
+            self._scheduler.put(identity, Job(rid, self.forward_reference, (references,),
+                                              priority=request.get('priority', 0),
+                                              cancellable=True))
+        elif request['id'] == 'FORWARD.STREAM':
+            logger.info("Received request to dispatch streaming forward.")
+            batches = [session.transport.recv(handle, frames) for handle in request['handles']]
+            self._scheduler.put(identity, Job(rid, self.forward_stream,
+                                              (batches, request.get('tile_shape')),
+                                              priority=request.get('priority', 0)))
+        elif request['id'] == 'TRAIN.BATCHSPEC':
+            logger.info("Received request to dispatch train.")
+            # The trainer queues these up, so they can't alias the client's buffers
+            data = [session.transport.recv(handle, frames, copy=True)
+                    for handle in request['data.handles']]
+            labels = [session.transport.recv(handle, frames, copy=True)
+                      for handle in request['labels.handles']]
+            self._scheduler.put(identity, Job(rid, self.train, (data, labels),
+                                              priority=request.get('priority', 0)))
+        elif request['id'] == 'TRAIN.CHUNK':
+            # Large training uploads come in chunks, which we put together until the client
+            # commits the upload
+            upload = session.uploads.get(request['upload'])
+            if upload is None:
+                utils.assert_(isinstance(request['len'], int) and request['len'] >= 0,
+                              f"Bad number of samples in upload: {request['len']}.", ValueError)
+                upload = session.uploads[request['upload']] = \
+                    Namespace(data=[None] * request['len'], labels=[None] * request['len'],
+                              received=0)
+            utils.assert_(request['field'] in ('data', 'labels'),
+                          f"Unknown upload field: {request['field']}.", ValueError)
+            arrays = getattr(upload, request['field'])
+            index = request['index']
+            utils.assert_(isinstance(index, int) and 0 <= index < len(arrays),
+                          f"Sample {index} is out of range for an upload of {len(arrays)} "
+                          f"samples.", IndexError)
+            if arrays[index] is None:
+                arrays[index] = np.empty(request['shape'], dtype=request['dtype'])
+            utils.assert_(list(arrays[index].shape) == list(request['shape']) and
+                          arrays[index].dtype == np.dtype(request['dtype']),
+                          f"Chunk of sample {index} doesn't match the shape or dtype of its "
+                          f"earlier chunks.", ValueError)
+            flat = arrays[index].reshape(-1).view(np.uint8)
+            chunk = session.transport.recv(request['handles'][0], frames).numpy()
+            chunk = chunk.reshape(-1).view(np.uint8)
+            offset = request['offset']
+            utils.assert_(isinstance(offset, int) and 0 <= offset and
+                          offset + len(chunk) <= len(flat),
+                          f"Chunk of {len(chunk)} bytes at offset {offset} doesn't fit in "
+                          f"sample {index} ({len(flat)} bytes).", ValueError)
+            flat[offset:offset + len(chunk)] = chunk
+            upload.received += len(chunk)
+            self.reply(session, rid, {'id': 'TRAIN.CHUNK_RECEIVED'})
+        elif request['id'] == 'TRAIN.COMMIT':
+            logger.info("Received request to dispatch train.")
+            upload = session.uploads.pop(request['upload'], None)
+            arrays = [] if upload is None else upload.data + upload.labels
+            if not arrays or any(array is None for array in arrays) or \
+                    upload.received != sum(array.nbytes for array in arrays):
+                self.reply(session, rid, {'id': 'ERROR',
+                                          'message': f"Upload {request['upload']} is incomplete."})
+            else:
+                self._scheduler.put(identity, Job(rid, self.train,
+                                                  ([torch.from_numpy(_data)
+                                                    for _data in upload.data],
+                                                   [torch.from_numpy(_label)
+                                                    for _label in upload.labels]),
+                                                  priority=request.get('priority', 0)))
+        elif request['id'] == 'TRAIN.HYPERPARAMETERS':
+            logger.info("Received request to change hyperparameters.")
+            if self._handler is None:
+                # They're for the model, so they wait for it to be loaded (in the compute thread)
+                self._scheduler.put(identity, Job(rid, self.set_hparams,
+                                                  (request['parameters'],),
+                                                  priority=request.get('priority', 0)))
+            else:
+                self.reply(session, rid, *self.set_hparams(request['parameters']))
+        # The commands below are answered by the I/O loop, which never loads the model itself:
+        # without a model there's no training to control or report on.
+        elif request['id'] == 'DISPATCH.PAUSE':
+            logger.info("Received request to pause training.")
+            if self._handler is not None:
+                self._handler.pause_training()
+            self.reply(session, rid, {'id': 'DISPATCHING.PAUSE',
+                                      'loaded': self._handler is not None})
+        elif request['id'] == 'DISPATCH.RESUME':
+            logger.info("Received request to resume training.")
+            if self._handler is not None:
+                self._handler.resume_training()
+            self.reply(session, rid, {'id': 'DISPATCHING.RESUME',
+                                      'loaded': self._handler is not None})
+        elif request['id'] == 'DISPATCH.POLL_TRAIN':
+            logger.info("Received request to poll training process.")
+            self.reply(session, rid, self.poll_training_process())
+        elif request['id'] == 'DISPATCH.TRAINING_STATS':
+            logger.info("Received request for training stats.")
+            self.reply(session, rid, {'id': 'TRAINING_STATS.INFO',
+                                      'loaded': self._handler is not None,
+                                      'stats': None if self._handler is None else
+                                      self._handler.training_stats()})
+        elif request['id'] == 'DISPATCH.CANCEL':
+            # Pending requests are dropped right away, running ones stop at the next block/tile
+            # and reply themselves.
+            logger.info(f"Received request to cancel request {rid}.")
+            if self._scheduler.cancel(identity, rid) is not None:
+                self.reply(session, rid, {'id': 'CANCELLED'})
+        elif request['id'] == 'ACK':
+            # The client has copied out what we sent it in that one reply
+            for handle in session.reply_handles.pop(request.get('ack'), []):
+                session.transport.release(handle)
+        elif request['id'] == 'DISPATCH.SHUTDOWN':
+            logger.info("Received request to shutdown.")
+            # The client is leaving; its pending requests are dropped
+            self.close_session(session)
+            if not self._sessions and not self.persistent:
+                self.shutdown()
+                self.meta_send(identity, {'id': 'DISPATCHING.SHUTDOWN', 'rid': rid})
+                return False
+            self.meta_send(identity, {'id': 'DISPATCHING.SHUTDOWN', 'rid': rid})
+        else:
+            logger.error(f"Bad request id: {request['id']}")
+            self.reply(session, rid, {'id': 'ERROR', 'message': f"Bad request id: {request['id']}"})
+        return True
 
+    def _dispatch_isolated(self, identity, request, frames=()):
+        # A bad request fails on its own, and not the I/O loop every client depends on.
+        logger = logging.getLogger('TikTorchServer._dispatch_isolated')
+        try:
+            return self.dispatch(identity, request, frames)
+        except Exception as e:
+            logger.exception(f"Request {request.get('id')} ({request.get('rid')}) failed.")
+            self.meta_send(identity, {'id': 'ERROR', 'rid': request.get('rid'),
+                                      'message': f"{type(e).__name__}: {e}"})
+            return True
 
     def listen(self):
         logger = logging.getLogger('TikTorchServer.listen')
+        # Spool the compute thread
+        outbox_address = f'inproc://tiktorch-server-{id(self)}'
+        outbox_socket = self._zmq_context.socket(zmq.PULL)
+        outbox_socket.bind(outbox_address)
+        self._zmq_pollin.register(outbox_socket, zmq.POLLIN)
+        self._worker = thr.Thread(target=self._work, args=(outbox_address,), daemon=True)
+        self._worker.start()
         logger.info('Waiting...')
         # Listen for requests
         while True:
-            socks = dict(self._zmq_pollin.poll(50))
-            if socks:
-                # Yay, a message!
-                if socks.get(self._zmq_socket) == zmq.POLLIN:
-                    logger.info("Request Polled.")
-                    request = self.meta_recv()
-                    logger.info("Request Received.")
-                    if request['id'] == 'DISPATCH.FORWARD':
-                        logger.info("Received request to dispatch forward.")
-                        # Confirm dispatch
-                        self.meta_send({'id': 'DISPATCHING.FORWARD'})
-                        logger.info("Dispatch confirmed.")
-                        self.forward()
-                        logger.info("Forward successful; waiting...")
-                    elif request['id'] == 'DISPATCH.TRAIN':
-                        logger.info("Received request to dispatch train.")
-                        # Confirm dispatch
-                        self.meta_send({'id': 'DISPATCHING.TRAIN'})
-                        logger.info('Dispatch confirmed.')
-                        self.train()
-                        logger.info("Train successful; waiting...")
-                    elif request['id'] == 'DISPATCH.SHUTDOWN':
-                        logger.info("Received request to shutdown.")
-                        self.meta_send({'id': 'DISPATCHING.SHUTDOWN'})
-                        logger.info("Dispatch confirmed.")
-                        self.shutdown()
-                        break
-                    elif request['id'] == 'DISPATCH.PAUSE':
-                        logger.info("Received request to pause training.")
-                        self.meta_send({'id': 'DISPATCHING.PAUSE'})
-                        logger.info("Dispatch confirmed, pausing training...")
-                        self.handler.pause_training()
-                    elif request['id'] == 'DISPATCH.RESUME':
-                        logger.info("Received request to resume training.")
-                        self.meta_send({'id': 'DISPATCHING.RESUME'})
-                        logger.info("Dispatch confirmed, resuming...")
-                        self.handler.resume_training()
-                    elif request['id'] == 'DISPATCH.POLL_TRAIN':
-                        logger.info("Received request to poll training process.")
-                        self.meta_send({'id': 'DISPATCHING.POLL_TRAIN'})
-                        logger.info("Dispatch confirmed, polling...")
-                        self.poll_training_process()
-                    elif request['id'] == 'DISPATCH.HYPERPARAMETERS':
-                        logger.info("Received request to dispatch hyperparameters.")
-                        self.meta_send({'id': 'DISPATCHING.HYPERPARAMETERS'})
-                        logger.info("Dispatch confirmed, changing hyperparameters...")
-                        self.set_hparams()
-                    else:
-                        # Bad id
-                        raise RuntimeError
+            socks = dict(self._zmq_pollin.poll())
+            if socks.get(outbox_socket) == zmq.POLLIN:
+                outbox_socket.recv()
+                self._flush_outbox()
+            if socks.get(self._zmq_socket) == zmq.POLLIN:
+                logger.info("Request Received.")
+                if not self._dispatch_isolated(*self.meta_recv()):
+                    break
+        self._zmq_pollin.unregister(outbox_socket)
+        outbox_socket.close()
 
     def poll_training_process(self):
         logger = logging.getLogger('TikTorchServer.poll_training_process')
         logger.info("Polling...")
         # Check if training process is running, and send info back
-        it_lives = self.handler.training_process_is_alive()
+        if self._handler is None:
+            logger.info("Model not loaded, so no training process either.")
+            return {'id': 'POLL_TRAIN.INFO', 'is_alive': False, 'loaded': False}
+        it_lives = self._handler.training_process_is_alive()
         logger.info("Poll successful. Sending response...")
-        info = {'id': 'POLL_TRAIN.INFO',
-                'is_alive': it_lives}
-        self.meta_send(info)
-        logger.info("Poll response sent.")
+        return {'id': 'POLL_TRAIN.INFO',
+                'is_alive': it_lives,
+                'loaded': True}
 
     def shutdown(self):
         logger = logging.getLogger('TikTorchServer.shutdown')
-        logger.info("Stopping training...")
-        self.handler.stop_training()
-        logger.info("Training stop.")
+        if self._worker is not None:
+            logger.info("Waiting for pending requests...")
+            self._scheduler.close()
+            self._worker.join()
+            self._flush_outbox()
+        for session in list(self._sessions.values()):
+            self.close_session(session)
+        if self._handler is not None:
+            logger.info("Stopping training...")
+            self.handler.stop_training()
+            logger.info("Training stop.")
+            self.handler.stop_cpu_workers()
 
 
 def debug_server():
     TikTorchServer.read_config = lambda self: self
-    server = TikTorchServer(address='127.0.0.1', port='29500',
-                            meta_port='29501')
+    server = TikTorchServer(address='127.0.0.1', meta_port='29501')
     server._model = torch.nn.Conv2d(1, 1, 1)
     server._config = {'input_shape': [1, 512, 512],
                       'dynamic_input_shape': '(32 * (nH + 1), 32 * (nW + 1))'}
@@ -345,16 +761,31 @@ def debug_server():
 if __name__ == '__main__':
     import argparse
     parsey = argparse.ArgumentParser()
+    parsey.add_argument('build_directory', type=str, nargs='?', default=None)
     parsey.add_argument('--addr', type=str, default='127.0.0.1')
-    parsey.add_argument('--port', type=str, default='29500')
     parsey.add_argument('--meta_port', type=str, default='29501')
+    parsey.add_argument('--endpoint', type=str, default=None)
     parsey.add_argument('--debug', type=bool, default=False)
+    parsey.add_argument('--persistent', action='store_true')
+    parsey.add_argument('--max_batch_size', type=int, default=None)
+    parsey.add_argument('--max_batch_delay', type=float, default=None)
+    parsey.add_argument('--result_cache_size', type=int, default=None)
+    parsey.add_argument('--cpu_workers', type=str, default=None)
+    parsey.add_argument('--compile_model', action='store_true')
     args = parsey.parse_args()
 
     # Go!
     if args.debug:
         server = debug_server()
     else:
-        server = TikTorchServer(address=args.addr, port=args.port, meta_port=args.meta_port)
+        server = TikTorchServer(address=args.addr, meta_port=args.meta_port,
+                                endpoint=args.endpoint,
+                                build_directory=args.build_directory,
+                                persistent=args.persistent,
+                                max_batch_size=args.max_batch_size,
+                                max_batch_delay=args.max_batch_delay,
+                                result_cache_size=args.result_cache_size,
+                                cpu_workers=args.cpu_workers,
+                                compile_model=args.compile_model)
     server.listen()
 
@@ -0,0 +1,83 @@
+import torch
+import torch.multiprocessing as mp
+
+# Slots of `SharedState._flags`
+SEQUENCE, VERSION, LATEST, IN_USE = range(4)
+
+
+class SharedState(object):
+    def __init__(self, state_dict):
+        """
+        Two copies of a model's state dict in shared memory, one process (the training
+        process) publishes weights to and another (the handler) runs on, without copying
+        them around.
+
+        The writer always writes to the copy the reader isn't using, and marks it as the latest
+        when done. The sequence number is odd while a copy is being written; the lock is only
+        held to flip between copies, never while copying.
+
+        Parameters
+        ----------
+        state_dict: dict
+            Initial state, published as version 0.
+        """
+        self._buffers = [{key: value.detach().cpu().clone().share_memory_()
+                          for key, value in state_dict.items()}
+                         for _ in range(2)]
+        # Both copies start out with version 0, and the reader is considered to be on the first
+        self._flags = mp.Array('q', 4)
+
+    @property
+    def version(self):
+        return self._flags[VERSION]
+
+    def publish(self, state_dict, version):
+        """Copies `state_dict` to the copy the reader isn't on and makes it the latest."""
+        with self._flags.get_lock():
+            target = 1 - self._flags[IN_USE]
+            self._flags[SEQUENCE] += 1
+        with torch.no_grad():
+            for key, value in state_dict.items():
+                self._buffers[target][key].copy_(value)
+        with self._flags.get_lock():
+            self._flags[LATEST] = target
+            self._flags[VERSION] = version
+            self._flags[SEQUENCE] += 1
+        return self
+
+    def claim(self, version=-1):
+        """
+        Returns `(version, state_dict)` of the latest copy if it's newer than `version`, else
+        None. The copy is the reader's (and won't be written to) until the next claim.
+        """
+        # Checking doesn't need the lock; only flipping does
+        if self._flags[SEQUENCE] % 2 == 1 or self._flags[VERSION] <= version:
+            return None
+        with self._flags.get_lock():
+            if self._flags[SEQUENCE] % 2 == 1:
+                return None
+            self._flags[IN_USE] = self._flags[LATEST]
+            return self._flags[VERSION], self._buffers[self._flags[IN_USE]]
+
+
+def bind_state(model, state_dict):
+    """
+    Points the parameters and buffers of `model` to the tensors in `state_dict`, which
+    makes loading it a matter of swapping pointers. Tensors on another device than the model
+    are copied over instead.
+    """
+    with torch.no_grad():
+        for key, value in state_dict.items():
+            module_name, _, name = key.rpartition('.')
+            module = model.get_submodule(module_name)
+            if name in module._parameters:
+                current = module._parameters[name]
+            else:
+                current = module._buffers[name]
+            if current.device != value.device:
+                current.copy_(value)
+            elif name in module._parameters:
+                current.data = value
+            else:
+                module._buffers[name] = value
+    return model
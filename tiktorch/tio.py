@@ -1,8 +1,20 @@
+import os
+
 import numpy as np
 import torch
 
 import tiktorch.utils as utils
 
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
 
 class TikIO(object):
 
@@ -156,6 +168,74 @@ class TikOut(TikIO):
                       TikIO.ShapeError)
         return list(batch)
 
+
+class TikRef(object):
+    HDF5_EXTENSIONS = ('.h5', '.hdf5', '.hdf')
+    ZARR_EXTENSIONS = ('.zarr', '.n5')
+
+    def __init__(self, path, roi=None, dataset=None):
+        """
+        Reference to (a region of) an array in a file that the server can read itself, so the
+        data doesn't have to be sent over.
+
+        Parameters
+        ----------
+        path: str
+            Path to a .npy file (memory-mapped), an HDF5 file or a zarr container.
+        roi: list
+            Region to read along the leading axes, as slices, (start, stop) pairs or indices
+            (which drop the axis). Defaults to the whole array.
+        dataset: str
+            Path to the dataset within an HDF5 file or zarr container.
+        """
+        self.path = path
+        self.roi = None if roi is None else [self._to_json(_roi) for _roi in roi]
+        self.dataset = dataset
+
+    @staticmethod
+    def _to_json(roi):
+        if isinstance(roi, slice):
+            return [roi.start, roi.stop]
+        elif isinstance(roi, (int, np.integer)):
+            return int(roi)
+        else:
+            return list(roi)
+
+    @property
+    def slices(self):
+        if self.roi is None:
+            return ()
+        return tuple(_roi if isinstance(_roi, int) else slice(*_roi) for _roi in self.roi)
+
+    def to_dict(self):
+        return {'path': self.path, 'roi': self.roi, 'dataset': self.dataset}
+
+    @classmethod
+    def from_dict(cls, spec):
+        return cls(spec['path'], roi=spec.get('roi'), dataset=spec.get('dataset'))
+
+    def read(self):
+        """Reads the region and returns it as a numpy.ndarray."""
+        extension = os.path.splitext(self.path.rstrip('/'))[1].lower()
+        if extension == '.npy':
+            # Only the region is read from disk
+            return np.array(np.load(self.path, mmap_mode='r')[self.slices])
+        elif extension in self.HDF5_EXTENSIONS:
+            utils.assert_(h5py is not None, "h5py is required to read HDF5 files.", ImportError)
+            with h5py.File(self.path, 'r') as f:
+                return f[self.dataset][self.slices]
+        elif extension in self.ZARR_EXTENSIONS:
+            utils.assert_(zarr is not None, "zarr is required to read zarr containers.",
+                          ImportError)
+            container = zarr.open(self.path, mode='r')
+            return (container if self.dataset is None else container[self.dataset])[self.slices]
+        else:
+            raise ValueError(f"Don't know how to read {self.path}.")
+
+    def __repr__(self):
+        return f"TikRef({self.path}, roi={self.roi}, dataset={self.dataset})"
+
+
 def test_tikin():
     tikin = TikIn([np.random.randn(1, 100, 100) for _ in range(3)])
     assert tikin.shape == torch.Size([1, 100, 100])
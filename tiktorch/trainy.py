@@ -7,7 +7,6 @@ from collections import deque
 from argparse import Namespace
 import torch
 import torch.multiprocessing as mp
-import threading as thr
 
 if torch.cuda.is_available():
     mp.set_start_method('spawn', force=True)
@@ -19,22 +18,25 @@ from inferno.io.transform.image import ElasticTransform, RandomFlip, RandomRotat
 
 import tiktorch.utils as utils
 import tiktorch.fast_augment as aug
+from tiktorch.shared_state import SharedState, bind_state
+from tiktorch.cache import SampleStore
 import tensorboardX as tX
 
 logger = logging.getLogger('Trainy')
 
 
-# Globals
-STATE_QUEUE_GET_TIMEOUT = 5
-
-
 class Trainer(object):
-    # Setting this to true might help training, but can amount to a lot of compute.
-    USE_CACHE_KEEPING = False
+    # Don't train on a sample right away if it was pushed before with the same labels.
+    USE_CACHE_KEEPING = True
     # Cache size to use. Large cache size ==> more CPU RAM.
     CACHE_SIZE = 200
     # FIXME This is a hack to invert the labels. Make sure the labels are binary to begin with, or else...
     INVERT_BINARY_LABELS = True
+    # Seconds the weights the handler runs may lag behind the training process (give or take
+    # an iteration). Publishing the weights costs a copy of them, so don't go overboard.
+    MAX_STATE_STALENESS = 1.
+    # Seconds to give the training process to stop before it's terminated
+    SHUTDOWN_TIMEOUT = 60
 
     def __init__(self, handler, hyperparameters=None, log_directory=None):
         # Privates
@@ -45,15 +47,19 @@ class Trainer(object):
         self._raw_preprocessor = None
         self._joint_preprocessor = None
         # Training
-        self._data_queue: mp.Queue = None
-        self._state_queue: mp.Queue = None
-        self._hparams_queue: mp.Queue = None
-        self._change_hparams_event: mp.Event = None
-        self._abort_event: mp.Event = None
-        self._pause_event: mp.Event = None
-        self._state_request_event = None
+        # Samples and commands for the training process, as (kind, payload)
+        self._inbox: mp.Queue = None
+        self._shared_state: SharedState = None
+        # [iteration, published version, loss, update norm by parameter...,
+        #  drift since the published version by parameter...], written by the training process
+        self._training_stats: torch.Tensor = None
+        self._parameter_names = []
         self._training_process: mp.Process = None
         self._ignited = False
+        # Whether we've asked the training process to pause
+        self._paused = False
+        # Version (training iteration) of the weights the handler's model has
+        self._state_version = 0
         # Publics
         # Sane default hparams
         if hyperparameters is None:
@@ -68,6 +74,7 @@ class Trainer(object):
         else:
             self.hparams: Namespace = hyperparameters
         self.log_directory = log_directory
+        self.max_state_staleness = self.MAX_STATE_STALENESS
 
     @property
     def model(self):
@@ -91,15 +98,13 @@ class Trainer(object):
     def _train_process(model_state: dict,
                        model_config: tuple,
                        device: torch.device,
-                       data_queue: mp.Queue,
+                       inbox: mp.Queue,
                        augmentor: aug.AugmentationSuite,
-                       state_queue: mp.Queue,
-                       abort: mp.Event,
-                       pause: mp.Event,
-                       change_hparams: mp.Event,
-                       state_request: mp.Event,
+                       shared_state: SharedState,
+                       training_stats: torch.Tensor,
+                       max_state_staleness: float,
                        use_cache_keeping: bool,
-                       hparams_queue: mp.Queue,
+                       hparams: Namespace,
                        log_directory: str):
         logger = logging.getLogger('Trainer._train_process')
         # Build the model
@@ -115,293 +120,228 @@ class Trainer(object):
             tensorboard = None
             logger.warning("Not writing tensorboard logs.")
 
-        _state_lock = thr.Lock()
-        _stop_server = thr.Event()
-
-        # This guy listens if state request has been set; if it is, it serves the state_dict in
-        # the queue.
-        def _state_server():
-            while True:
-                if _stop_server.is_set():
-                    logger.info("Stopping state server...")
-                    break
-                if state_request.is_set():
-                    try:
-                        logger.info("Obtained request for new state. Waiting for lock...")
-                        with _state_lock:
-                            state_queue.put_nowait(model.state_dict())
-                            logger.info("Put most recent state in queue.")
-                    except queue.Full:
-                        logger.info("State queue is full.")
-                        pass
-                    state_request.clear()
-                    logger.info("State request cleared.")
-                time.sleep(0.01)
-
-        # Set up server to listen for state requests
-        logger.info("Spooling state server thread...")
-        server_thread = thr.Thread(target=_state_server, args=())
-        server_thread.start()
-
-        def _kill_state_server(num_kill_attempts=5):
-            logger.info("Killing state server thread...")
-            _stop_server.set()
-            kill_attempts = 0
-            while server_thread.is_alive():
-                time.sleep(1)
-                kill_attempts += 1
-                logger.info(f"Attempt {kill_attempts} of {num_kill_attempts}.")
-                if kill_attempts > num_kill_attempts:
-                    break
-            if server_thread.is_alive():
-                logger.warning(f"Failed to kill state server after {num_kill_attempts} attempts.")
-            else:
-                logger.info("State server killed.")
+        # The weights are published to shared_state, versioned by the training iteration
+        published_version = 0
+        last_publish_time = time.time()
+
+        # For the telemetry: weights before the last step, and how far (summed over steps) each
+        # parameter moved since the last published version
+        parameters = list(model.parameters())
+        previous_parameters = [p.detach().clone() for p in parameters]
+        drift = torch.zeros(len(parameters), dtype=torch.float64, device=device)
+
+        def _publish_state():
+            nonlocal published_version, last_publish_time
+            shared_state.publish(model.state_dict(), iter_count)
+            published_version, last_publish_time = iter_count, time.time()
+            drift.zero_()
+            training_stats[1] = published_version
+            training_stats[3 + len(parameters):] = 0.
+            logger.info(f"Published state at iteration {iter_count}.")
+
+        def _maybe_publish_state(idle=False):
+            # When idle, there's no reason to hold back the last few iterations
+            if iter_count > published_version and \
+                    (idle or time.time() - last_publish_time >= max_state_staleness):
+                _publish_state()
+
+        def _init_optimization(hparams):
+            criterion = getattr(torch.nn, hparams.criterion_name)(**hparams.criterion_kwargs)
+            optim = getattr(torch.optim, hparams.optimizer_name)(model.parameters(), **hparams.optimizer_kwargs)
+            return criterion, optim
 
         logger.info(f"Initializing Loss and Optimizer.")
         # Set up what's needed for training
-        hparams = hparams_queue.get()
-        criterion = getattr(torch.nn, hparams.criterion_name)(**hparams.criterion_kwargs)
-        optim = getattr(torch.optim, hparams.optimizer_name)(model.parameters(), **hparams.optimizer_kwargs)
-        # Init a cache. In case there are not enough batches in data_queue,
+        criterion, optim = _init_optimization(hparams)
+        # Init a cache. In case there are not enough fresh samples,
         # we'll use it to top up the batch with what's in this cache.
-        data_cache = deque(maxlen=hparams.cache_size)
-
-        # If this returns true, the sample will be added to batch later downstream.
-        def _cache_keeping(sample):
-            global data_cache
-            dirty_indices = []
-            update_batch = True
-            for idx, cache_sample in enumerate(data_cache):
-                cache_data, cache_labels = cache_sample
-                data, labels = sample
-                # Compare data
-                data_diff = data.sub(cache_data).abs_().sum().item()
-                if data_diff > 1e-5:
-                    # Not a match
-                    continue
-                else:
-                    # A match - data exists in cache. But still, the labels could have
-                    # been updated...
-                    labels_diff = labels.sub(cache_labels).abs_().sum().item()
-                    if labels_diff < 1e-5:
-                        # Labels match - the sample exists 1-to-1 in the cache, so there's no
-                        # need to update the batch.
-                        update_batch = False
-                    else:
-                        # The data matches, but the labels don't match - the cache is dirty
-                        # and needs updating.
-                        dirty_indices.append(idx)
-            # Clean out the dirties yeet
-            if dirty_indices:
-                # Make a new, clean cache
-                data_cache = deque([_sample for _idx, _sample in enumerate(data_cache)
-                                    if _idx not in dirty_indices], maxlen=hparams.cache_size)
-            # So if we're still updating the batch, we should also update the cache
-            data_cache.append(sample)
-            # Done-o
-            return update_batch
+        data_cache = SampleStore(hparams.cache_size)
+
+        # Samples that came in but weren't trained on yet; they go before the ones in the cache
+        fresh_samples = deque()
+        paused = False
 
         # Global Training Iteration Counter
         iter_count = 0
         while True:
-            if change_hparams.is_set():
-                change_hparams.clear()
+            # Everything (samples and commands) comes in through the inbox. With nothing to
+            # train on, we sleep until something does; else we only take what's there.
+            messages = []
+            if paused or (len(fresh_samples) == 0 and len(data_cache) == 0):
+                _maybe_publish_state(idle=True)
+                logger.info(f"Waiting for messages...")
+                messages.append(inbox.get())
+            while True:
                 try:
-                    hparams = hparams_queue.get_nowait()
+                    messages.append(inbox.get_nowait())
                 except queue.Empty:
-                    logger.info(f"Hyperparameter queue is empty.")
-                    pass
-                logger.info(f"Changing hyperparameters: initializing loss and optimizer.")
-                criterion = getattr(torch.nn, hparams.criterion_name)(**hparams.criterion_kwargs)
-                optim = getattr(torch.optim, hparams.optimizer_name)(model.parameters(), **hparams.optimizer_kwargs)
-                    
-            # Check if a new state is requested
-            if state_request.is_set():
-                # First things first,
-                state_request.clear()
-                try:
-                    state_queue.put_nowait(model.state_dict())
-                except queue.Full:
-                    # Welp, no new parameters
-                    pass
-            # Init a batch
-            batch = []
-            # Check if abort event is set
-            if abort.is_set():
+                    break
+            abort = False
+            for kind, payload in messages:
+                if kind == 'sample':
+                    fresh_samples.append(payload)
+                elif kind == 'hparams':
+                    hparams = payload
+                    logger.info(f"Changing hyperparameters: initializing loss and optimizer.")
+                    criterion, optim = _init_optimization(hparams)
+                elif kind == 'pause':
+                    logger.info(f"Pausing...")
+                    paused = True
+                elif kind == 'resume':
+                    logger.info(f"Resuming...")
+                    paused = False
+                elif kind == 'abort':
+                    abort = True
+            if abort:
                 logger.info(f"Aborting...")
-                _kill_state_server()
                 break
-            if pause.is_set():
-                logger.info(f"Waiting for resume...")
-                time.sleep(1)
+            if paused:
+                continue
+            # Init a batch
+            batch = []
+            logger.info(f"Currently {len(fresh_samples)} fresh samples.")
+            while fresh_samples and len(batch) < hparams.batch_size:
+                sample = fresh_samples.popleft()
+                # Samples with new data or new labels replace what's in the cache and go
+                # in the batch
+                if data_cache.add(*sample) or not use_cache_keeping:
+                    batch.append(sample)
+            if len(batch) < hparams.batch_size:
+                # Batch not full, try to top it up from the cache
+                logger.info(f"Topping up batch, currently with {len(batch)} elements...")
+                while len(data_cache) > 0 and len(batch) < hparams.batch_size:
+                    batch.append(data_cache.next_sample())
+            if len(batch) == 0:
                 continue
-            try:
-                try:
-                    logger.info(f"Currently {data_queue.qsize()} elements in data_queue.")
-                except NotImplementedError:
-                    # This raises a Not Implemented Error on OSX
-                    pass
-                sample = 0
-                while len(batch) < hparams.batch_size:
-                    logger.info(f"Trying to Fetch sample {sample} of {hparams.batch_size}...")
-                    # Try to fetch from data queue
-                    data, labels = data_queue.get(block=False)
-                    try:
-                        _q_size_now = data_queue.qsize()
-                    except NotImplementedError:
-                        _q_size_now = None
-                    logger.info(f"Fetched sample {sample} of {hparams.batch_size}. "
-                                f"Remaining items in queue: {_q_size_now}...")
-                    if use_cache_keeping:
-                        if _cache_keeping((data, labels)):
-                            batch.append((data, labels))
-                            sample += 1
-                    else:
-                        # Add to batch
-                        batch.append((data, labels))
-                        # Add to cache
-                        data_cache.append((data, labels))
-                        sample += 1
-            except queue.Empty:
-                logger.info(f"Queue Exhausted.")
-                if len(batch) == 0 and len(data_cache) == 0:
-                    # Both batch and cache empty, try again
-                    logger.info(f"Trying to fetch again...")
-                    time.sleep(0.1)
-                    continue
-                elif len(batch) == hparams.batch_size:
-                    # Nothing to do here
-                    pass
-                elif len(batch) < hparams.batch_size:
-                    # Batch not full, try to top it up from the cache
-                    logger.info(f"Topping up batch, currently with {len(batch)} elements...")
-                    while len(data_cache) > 0 and len(batch) < hparams.batch_size:
-                        data_sample = data_cache.popleft()
-                        batch.append(data_sample)
-                        data_cache.append(data_sample)
-                else:
-                    logger.error(f"LOLWTF: len(batch) = {len(batch)}, "
-                                 f"len(data_cache) = {len(data_cache)}")
-                    # Stop state server before throwing up error
-                    _kill_state_server()
-                    raise RuntimeError
 
             logger.info(f"Updating with {len(batch)} samples...")
             # Make a batch
             logger.info("Augmenting...")
-            try:
-                augmented_batch = [augmentor(*sample) for sample in batch]
-                data, labels, weights = zip(*augmented_batch)
-                logger.debug(f"data.shapes = {[list(t.shape) for t in data]}, "
-                             f"label.shapes = {[list(t.shape) for t in labels]}, "
-                             f"weights.shapes = {[list(t.shape) for t in weights]}")
-                data, labels, weights = (torch.stack(data, dim=0),
-                                         torch.stack(labels, dim=0),
-                                         torch.stack(weights, dim=0))
-                # Ship tensors to device
-                data, labels, weights = data.to(device), labels.to(device), weights.to(device)
-                logger.info(f"Transferred to device.")
-                # Train the model
-                prediction = model(data)
-                logger.info(f"Fed forward.")
-                loss = criterion(prediction, labels).mul(weights).mean()
-                logger.info(f"Loss Evaluated. Waiting for state lock...")
-                with _state_lock:
-                    optim.zero_grad()
-                    loss.backward()
-                    logger.info(f"Backproped.")
-                    optim.step()
-                    logger.info(f"Stepped.")
-                    iter_count += 1
-                # Logging
-                if tensorboard is not None:
-                    tensorboard.add_scalar('loss', loss.item(), global_step=(iter_count - 1))
-                    logger.info(f"Logged iteration {iter_count}.")
-            except Exception:
-                _kill_state_server()
-                raise
+            augmented_batch = [augmentor(*sample) for sample in batch]
+            data, labels, weights = zip(*augmented_batch)
+            logger.debug(f"data.shapes = {[list(t.shape) for t in data]}, "
+                         f"label.shapes = {[list(t.shape) for t in labels]}, "
+                         f"weights.shapes = {[list(t.shape) for t in weights]}")
+            data, labels, weights = (torch.stack(data, dim=0),
+                                     torch.stack(labels, dim=0),
+                                     torch.stack(weights, dim=0))
+            # Ship tensors to device
+            data, labels, weights = data.to(device), labels.to(device), weights.to(device)
+            logger.info(f"Transferred to device.")
+            # Train the model
+            prediction = model(data)
+            logger.info(f"Fed forward.")
+            loss = criterion(prediction, labels).mul(weights).mean()
+            logger.info(f"Loss Evaluated.")
+            optim.zero_grad()
+            loss.backward()
+            logger.info(f"Backproped.")
+            optim.step()
+            logger.info(f"Stepped.")
+            iter_count += 1
+            with torch.no_grad():
+                update_norms = torch.stack([(p - p_previous).norm()
+                                            for p, p_previous in zip(parameters,
+                                                                     previous_parameters)])
+                for p, p_previous in zip(parameters, previous_parameters):
+                    p_previous.copy_(p)
+                drift.add_(update_norms.double())
+            # Readers may catch this half-written, which is fine for telemetry
+            training_stats[0] = iter_count
+            training_stats[2] = loss.item()
+            training_stats[3:] = torch.cat([update_norms.double(), drift]).cpu()
+            _maybe_publish_state()
+            # Logging
+            if tensorboard is not None:
+                tensorboard.add_scalar('loss', loss.item(), global_step=(iter_count - 1))
+                logger.info(f"Logged iteration {iter_count}.")
 
     def ignition(self):
         # Done in this method:
-        #   1. Init data queue
-        #   2. Init abort event
+        #   1. Init inbox
+        #   2. Init shared state
         #   3. Start the training process
         logger = logging.getLogger("Trainer.ignition")
-        logger.info("Prepping Queue and Event...")
-        self._data_queue = mp.Queue()
-        self._state_queue = mp.Queue()
-        self._hparams_queue = mp.Queue()
-        self._hparams_queue.put(self.hparams)
-        self._abort_event = mp.Event()
-        self._pause_event = mp.Event()
-        self._state_request_event = mp.Event()
-        self._change_hparams_event = mp.Event()
+        logger.info("Prepping Queue...")
+        self._inbox = mp.Queue()
         logger.info("Sharing Memory...")
         # self.share_memory()
         model_state = self.model.state_dict()
+        self._shared_state = SharedState(model_state)
+        self._parameter_names = [name for name, _ in self.model.named_parameters()]
+        self._training_stats = torch.zeros(3 + 2 * len(self._parameter_names),
+                                           dtype=torch.float64).share_memory_()
         model_config = (self.model._model_file_name,
                         self.model._model_class_name,
                         self.model._model_init_kwargs)
         self._training_process = mp.Process(target=self._train_process,
                                             args=(model_state, model_config, self.device,
-                                                  self._data_queue, self.augmentor,
-                                                  self._state_queue,
-                                                  self._abort_event, self._pause_event,
-                                                  self._change_hparams_event,
-                                                  self._state_request_event,
+                                                  self._inbox, self.augmentor,
+                                                  self._shared_state,
+                                                  self._training_stats,
+                                                  self.max_state_staleness,
                                                   self.USE_CACHE_KEEPING,
-                                                  self._hparams_queue,
+                                                  self.hparams,
                                                   self.log_directory))
         logger.info("3, 2, 1...")
+        self._state_version = 0
+        self._paused = False
         self._training_process.start()
         logger.info("We have lift off.")
         self._ignited = True
 
-    def _drain_state_queue(self):
-        logger = logging.getLogger('Trainer._drain_state_queue')
-        state = None
-        while True:
-            try:
-                state = self._state_queue.get_nowait()
-                logger.info("Found residual state in state_queue.")
-            except queue.Empty:
-                break
-        return state
-
     def update_handler_model_state(self):
+        """Points the handler's model to the most recent state the training process published,
+        if it's newer than what the model has. Never waits for the training process.
+        Returns True if the weights of the handler's model changed."""
         logger = logging.getLogger('Trainer.update_handler_model_state')
         assert self._ignited, "Training process not ignited."
-        logger.info("Requesting new state.")
-        # Flush queue for residual states (e.g. from previously timed-out queue-get's)
-        state = self._drain_state_queue()
-        # Send request for parameters
-        self._state_request_event.set()
-        # Try to get parameters from queue
-        try:
-            logger.info("Waiting for new state...")
-            state = self._state_queue.get(timeout=STATE_QUEUE_GET_TIMEOUT)
-            logger.info("Acquired new state.")
-        except queue.Empty:
-            logger.info("Failed to acquire new state...")
-            pass
-        if state is not None:
-            self.model.load_state_dict(state)
-            logger.info("Loaded state.")
+        published = self._shared_state.claim(self._state_version)
+        if published is None:
+            return False
+        version, state = published
+        bind_state(self.model, state)
+        self._state_version = version
+        logger.info(f"Loaded state at version {version}.")
+        return True
+
+    @property
+    def state_version(self):
+        return self._state_version
+
+    def training_stats(self):
+        """
+        Returns
+        -------
+        dict
+            `iteration`, `loss`, `published_version` (the latest the training process published),
+            `state_version` (the one the handler has), and by parameter name: `update_norms`
+            (of the last step) and `drift` (summed update norms since the published version).
+            None if the training process wasn't started.
+        """
+        if not self._ignited:
+            return None
+        num_parameters = len(self._parameter_names)
+        stats = self._training_stats.tolist()
+        return {'iteration': int(stats[0]),
+                'published_version': int(stats[1]),
+                'state_version': self._state_version,
+                'loss': stats[2],
+                'update_norms': dict(zip(self._parameter_names, stats[3:3 + num_parameters])),
+                'drift': dict(zip(self._parameter_names, stats[3 + num_parameters:]))}
 
     def shut_down_training_process(self):
         if self._training_process is not None:
             # Shut down the training process
-            logger.info("Setting Abort Event...")
-            self._abort_event.set()
-            for trial in range(6):
-                logger.info(f"Try {trial} of 5:")
-                # Give training process some time to die
-                if self._training_process.is_alive():
-                    logger.info(f"Process Alive.")
-                    time.sleep(10)
-                else:
-                    break
+            if self._training_process.is_alive():
+                logger.info("Sending abort...")
+                self._inbox.put(('abort', None))
+            # It finishes the iteration it's on first
+            self._training_process.join(timeout=self.SHUTDOWN_TIMEOUT)
+            if self._training_process.is_alive():
+                logger.warning(f"Training process didn't stop within {self.SHUTDOWN_TIMEOUT} "
+                               f"seconds, terminating it.")
+                self._training_process.terminate()
             logger.info(f"Process Dead.")
 
     def __del__(self):
@@ -451,52 +391,42 @@ class Trainer(object):
         logger.info(f"Feeding {len(data)} samples to queue...")
         # Augment
         for _data, _labels in zip(data, labels):
-            self._data_queue.put((_data, _labels))
+            self._inbox.put(('sample', (_data, _labels)))
         logger.info(f"Fed {len(data)} samples to queue...")
 
     def push_hparams(self, hparams: dict):
         logger = logging.getLogger("Trainer.push_hparams")
         # Done in this method:
-        # If training process is running, push hparams into queue, else set as default
-        
-        def _drain_hparams_queue():
-            deprecated_hparams = None
-            while True:
-                try:
-                    deprecated_hparams = self._hparams_queue.get_nowait()
-                    logger.info("Found deprecated hyperparameters in hparams_queue")
-                except queue.Empty:
-                    break
-            return deprecated_hparams
-        
+        # If training process is running, send hparams to it, else set as default
         hparams = Namespace(**hparams)
         if not self.is_ignited:
             logger.info("Setting new default hyperparameters")
             self.hparams = hparams
         else:
             self.hparams = hparams
-            logger.info("Feeding parameters to hyperparameter queue")
-            with thr.Lock():
-                _drain_hparams_queue()
-                self._hparams_queue.put(hparams)
-                time.sleep(1)
-            self._change_hparams_event.set()
-
+            logger.info("Sending hyperparameters to training process")
+            self._inbox.put(('hparams', hparams))
 
     def pause(self):
         if self._ignited:
             logger.info("Pausing training...")
-            self._pause_event.set()
+            self._inbox.put(('pause', None))
+            self._paused = True
         else:
             logger.warning("Not ignited, nothing to pause.")
 
     def resume(self):
         if self._ignited:
             logger.info("Resuming training...")
-            self._pause_event.clear()
+            self._inbox.put(('resume', None))
+            self._paused = False
         else:
             logger.warning("Not ignited, nothing to resume.")
 
+    @property
+    def is_paused(self):
+        return self._paused
+
     def is_alive(self):
         if self._training_process is None:
             return False
@@ -0,0 +1,285 @@
+import os
+import mmap
+import uuid
+import logging
+import tempfile
+import warnings
+import zlib
+
+import numpy as np
+import torch
+
+import tiktorch.utils as utils
+
+try:
+    import lz4.frame as lz4
+except ImportError:
+    lz4 = None
+
+logger = logging.getLogger('Transport')
+
+# Compressors by name, as (compress, decompress)
+COMPRESSORS = {'zlib': (lambda buffer: zlib.compress(buffer, 1), zlib.decompress)}
+if lz4 is not None:
+    COMPRESSORS['lz4'] = (lz4.compress, lz4.decompress)
+# Frames smaller than this (in bytes) aren't worth compressing
+MIN_COMPRESSION_SIZE = 4096
+# Precisions outputs can be sent back in
+OUTPUT_DTYPES = ('float32', 'float16', 'uint8')
+
+
+def _default_shm_directory():
+    # /dev/shm is tmpfs-backed on linux; elsewhere we fall back to the temp directory.
+    return '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+
+def _wrap_buffer(buffer, handle, copy=False):
+    dtype = np.dtype(handle['dtype'])
+    array = np.frombuffer(buffer, dtype=dtype, count=int(np.prod(handle['shape'])))
+    array = array.reshape(handle['shape'])
+    if copy:
+        return torch.from_numpy(array.copy())
+    with warnings.catch_warnings():
+        # Received frames are read-only; the tensors are only ever read from.
+        warnings.simplefilter('ignore', UserWarning)
+        return torch.from_numpy(array)
+
+
+class SharedMemoryRing(object):
+    """
+    A set of reusable shared memory slots (files in /dev/shm) for tensors. The writer owns the
+    ring and hands out slots with `put`; a reader in another process maps the slot files with
+    `get` and wraps them as tensors without copying.
+    """
+    def __init__(self, num_slots=4, directory=None, prefix=None):
+        # Privates
+        self._slots = []
+        self._maps = {}
+        # Publics
+        self.directory = _default_shm_directory() if directory is None else directory
+        self.prefix = f'tiktorch-{os.getpid()}-{uuid.uuid4().hex[:8]}' if prefix is None else prefix
+        self.num_slots = num_slots
+
+    def _make_slot(self):
+        path = os.path.join(self.directory, f'{self.prefix}-{len(self._slots)}')
+        # Touch the file; it's sized on first use.
+        with open(path, 'wb'):
+            pass
+        slot = {'path': path, 'nbytes': 0, 'free': True}
+        self._slots.append(slot)
+        return slot
+
+    def _acquire_slot(self):
+        for slot in self._slots:
+            if slot['free']:
+                break
+        else:
+            if len(self._slots) >= self.num_slots:
+                logger.debug(f"All {len(self._slots)} shared memory slots are in use, "
+                             f"adding another one.")
+            slot = self._make_slot()
+        slot['free'] = False
+        return slot
+
+    def _map(self, path, nbytes):
+        # Map the file, or remap it if it has grown since we last saw it.
+        # Tensors over a previous (smaller) map keep it alive, so we don't close it here.
+        mapped = self._maps.get(path)
+        if mapped is None or len(mapped) < nbytes:
+            with open(path, 'r+b') as f:
+                mapped = mmap.mmap(f.fileno(), nbytes)
+            self._maps[path] = mapped
+        return mapped
+
+    def put(self, tensor):
+        """
+        Copies `tensor` to a free slot and returns a (JSON serializable) handle to it.
+        The slot remains reserved until `release` is called with the handle.
+        """
+        array = tensor.detach().cpu().contiguous().numpy()
+        slot = self._acquire_slot()
+        if slot['nbytes'] < array.nbytes:
+            with open(slot['path'], 'r+b') as f:
+                f.truncate(array.nbytes)
+            slot['nbytes'] = array.nbytes
+        if array.nbytes > 0:
+            mapped = self._map(slot['path'], array.nbytes)
+            np.frombuffer(mapped, dtype=array.dtype, count=array.size)[:] = array.ravel()
+        return {'path': slot['path'],
+                'shape': list(array.shape),
+                'dtype': array.dtype.name}
+
+    def get(self, handle, copy=False):
+        """
+        Wraps the slot described by `handle` as a tensor. Unless `copy` is set, the tensor aliases
+        the shared memory and is only valid until the writer reuses the slot.
+        """
+        dtype = np.dtype(handle['dtype'])
+        count = int(np.prod(handle['shape']))
+        if count == 0:
+            return torch.from_numpy(np.zeros(handle['shape'], dtype=dtype))
+        return _wrap_buffer(self._map(handle['path'], count * dtype.itemsize), handle, copy=copy)
+
+    def release(self, handle):
+        for slot in self._slots:
+            if slot['path'] == handle['path']:
+                slot['free'] = True
+                break
+        return self
+
+    def release_all(self):
+        for slot in self._slots:
+            slot['free'] = True
+        return self
+
+    def close(self):
+        for mapped in self._maps.values():
+            try:
+                mapped.close()
+            except BufferError:
+                # Someone still holds a tensor over this map; it'll be freed with the tensor.
+                pass
+        self._maps.clear()
+        # Only the owner unlinks the slots
+        for slot in self._slots:
+            if os.path.exists(slot['path']):
+                os.remove(slot['path'])
+        self._slots.clear()
+        return self
+
+
+class FrameTransport(object):
+    """
+    Sends tensors as extra frames of the (multipart) ZMQ message that describes them. Frames
+    are sent and received without copying (unless compressed), so received tensors wrap the
+    message buffers.
+    """
+    name = 'zmq'
+    # Every message brings its own buffers
+    reuses_buffers = False
+
+    def __init__(self, compression=None):
+        utils.assert_(compression is None or compression in COMPRESSORS,
+                      f"Compression {compression} is not available.", ValueError)
+        self.compression = compression
+
+    def describe(self, tensor, frames):
+        array = tensor.detach().cpu().contiguous().numpy()
+        handle = {'frame': len(frames),
+                  'shape': list(array.shape),
+                  'dtype': array.dtype.name}
+        if self.compression is not None and array.nbytes >= MIN_COMPRESSION_SIZE:
+            compress, _ = COMPRESSORS[self.compression]
+            frames.append(compress(array))
+            handle['compression'] = self.compression
+        else:
+            frames.append(array)
+        return handle
+
+    def recv(self, handle, frames, copy=False):
+        frame = frames[handle['frame']]
+        buffer = getattr(frame, 'buffer', frame)
+        if 'compression' in handle:
+            _, decompress = COMPRESSORS[handle['compression']]
+            buffer = decompress(buffer)
+        return _wrap_buffer(buffer, handle, copy=copy)
+
+    def release(self, handle):
+        return self
+
+    def release_all(self):
+        return self
+
+    def close(self):
+        return self
+
+
+class SharedMemoryTransport(object):
+    """
+    Moves tensors through shared memory; only the handles need to travel over the socket.
+    Each side writes to its own ring and reads from the peer's ring. Only works if both
+    processes are on the same host.
+    """
+    name = 'shm'
+    # Slots are reused once released, so the reader has to say when it's done with them
+    reuses_buffers = True
+
+    def __init__(self, num_slots=4, directory=None):
+        self.ring = SharedMemoryRing(num_slots=num_slots, directory=directory)
+
+    def describe(self, tensor, frames):
+        # Nothing goes in the message but the handle
+        return self.ring.put(tensor)
+
+    def recv(self, handle, frames, copy=False):
+        return self.ring.get(handle, copy=copy)
+
+    def release(self, handle):
+        self.ring.release(handle)
+        return self
+
+    def release_all(self):
+        self.ring.release_all()
+        return self
+
+    def close(self):
+        self.ring.close()
+        return self
+
+
+def shm_probe(directory=None):
+    """
+    Creates a file in shared memory that the peer can look for; if it can see it, the two
+    processes are on the same host and can use `SharedMemoryTransport`.
+    """
+    directory = _default_shm_directory() if directory is None else directory
+    path = os.path.join(directory, f'tiktorch-probe-{uuid.uuid4().hex}')
+    with open(path, 'w') as f:
+        f.write(path)
+    return path
+
+
+def shm_probe_visible(path):
+    if path is None or not os.path.exists(path):
+        return False
+    with open(path, 'r') as f:
+        return f.read() == path
+
+
+def make_transport(name, compression=None, **kwargs):
+    if name == 'shm':
+        # Nothing to gain from compressing shared memory
+        return SharedMemoryTransport(**kwargs)
+    elif name == 'zmq':
+        return FrameTransport(compression=compression)
+    else:
+        raise ValueError(f"Unknown transport: {name}")
+
+
+def encode_output(tensor, dtype='float32'):
+    """
+    Reduces the precision of a (float) output tensor before it's sent. `dtype` can be
+    'float32' (no change), 'float16', or 'uint8', in which case the tensor is quantized
+    to 256 levels between its min and max. Returns the tensor and what it takes to decode it.
+    """
+    utils.assert_(dtype in OUTPUT_DTYPES, f"Output dtype must be one of {OUTPUT_DTYPES}, "
+                                          f"got {dtype}.", ValueError)
+    if dtype == 'float32' or tensor.numel() == 0:
+        return tensor, None
+    elif dtype == 'float16':
+        return tensor.half(), {'dtype': 'float16'}
+    else:
+        low, high = tensor.min().item(), tensor.max().item()
+        scale = (high - low) / 255 if high > low else 1.
+        quantized = tensor.sub(low).div_(scale).round_().clamp_(0, 255).to(torch.uint8)
+        return quantized, {'dtype': 'uint8', 'scale': scale, 'offset': low}
+
+
+def decode_output(tensor, encoding):
+    """Inverse of `encode_output`; returns a float32 tensor."""
+    if encoding is None:
+        return tensor
+    tensor = tensor.float()
+    if 'scale' in encoding:
+        tensor = tensor.mul_(encoding['scale']).add_(encoding['offset'])
+    return tensor
@@ -0,0 +1,174 @@
+import logging
+import os
+import queue
+import time
+
+import torch
+import torch.multiprocessing as mp
+
+import tiktorch.utils as utils
+
+logger = logging.getLogger('Workers')
+
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def autotune_cpu_workers(model, input_shape, cores=None, num_repeats=3):
+    """
+    Picks the number of workers and threads per worker that gets the most tiles of shape
+    `input_shape` (NC + spatial) through `model` per second, on `cores`.
+
+    Every candidate number of threads is timed on a single tile in this process; workers are
+    pinned to disjoint cores, so N of them get through N times as many tiles.
+
+    Returns
+    -------
+    tuple
+        (num_workers, threads_per_worker)
+    """
+    logger = logging.getLogger('autotune_cpu_workers')
+    num_cores = len(available_cores() if cores is None else cores)
+    candidates = sorted({num_threads for num_threads in
+                         [2 ** power for power in range(num_cores.bit_length())] + [num_cores]
+                         if num_threads <= num_cores})
+    previous_num_threads = torch.get_num_threads()
+    input_tensor = torch.zeros(*input_shape)
+    timings = {}
+    try:
+        with torch.no_grad():
+            for num_threads in candidates:
+                torch.set_num_threads(num_threads)
+                # Warm up
+                model(input_tensor)
+                start = time.perf_counter()
+                for _ in range(num_repeats):
+                    model(input_tensor)
+                timings[num_threads] = (time.perf_counter() - start) / num_repeats
+    finally:
+        torch.set_num_threads(previous_num_threads)
+    threads_per_worker = max(candidates,
+                             key=lambda num_threads: (num_cores // num_threads) / timings[num_threads])
+    logger.info(f"Seconds per tile by number of threads: {timings}; "
+                f"going with {num_cores // threads_per_worker} x {threads_per_worker}.")
+    return num_cores // threads_per_worker, threads_per_worker
+
+
+class CPUWorkerPool(object):
+    class WorkerDied(RuntimeError):
+        pass
+
+    # Seconds to wait for a reply before checking that the worker is still alive
+    POLL_INTERVAL = 1.
+
+    def __init__(self, model, num_workers, threads_per_worker=1, cores=None):
+        """
+        Replicas of the model in worker processes, each with its own budget of intra-op threads
+        and pinned to its own cores.
+
+        Parameters
+        ----------
+        model: torch.nn.Module
+            Models built by `utils.define_patched_model` are rebuilt in the workers (like the
+            training process does), others are pickled.
+        num_workers: int
+        threads_per_worker: int
+        cores: list
+            Cores to spread the workers over. Defaults to the ones this process may run on.
+        """
+        cores = available_cores() if cores is None else list(cores)
+        utils.assert_(num_workers * threads_per_worker <= len(cores),
+                      f"Can't fit {num_workers} workers with {threads_per_worker} threads each "
+                      f"on {len(cores)} cores.", ValueError)
+        self.num_workers = num_workers
+        self.threads_per_worker = threads_per_worker
+        # Privates
+        self._requests = [mp.Queue() for _ in range(num_workers)]
+        self._replies = [mp.Queue() for _ in range(num_workers)]
+        self._processes = []
+        if hasattr(model, '_model_file_name'):
+            model_spec = ((model._model_file_name, model._model_class_name,
+                           model._model_init_kwargs), None)
+        else:
+            model_spec = (None, model)
+        state_dict = {key: value.cpu() for key, value in model.state_dict().items()}
+        for worker_id in range(num_workers):
+            worker_cores = cores[worker_id * threads_per_worker:
+                                 (worker_id + 1) * threads_per_worker]
+            process = mp.Process(target=self._work,
+                                 args=(model_spec, state_dict, worker_cores, threads_per_worker,
+                                       self._requests[worker_id], self._replies[worker_id]),
+                                 daemon=True)
+            process.start()
+            self._processes.append(process)
+
+    @staticmethod
+    def _work(model_spec, state_dict, cores, num_threads, requests, replies):
+        logger = logging.getLogger('CPUWorkerPool._work')
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cores)
+        torch.set_num_threads(num_threads)
+        model_config, model = model_spec
+        if model is None:
+            model = utils.define_patched_model(*model_config)
+        model.load_state_dict(state_dict)
+        model.eval()
+        logger.debug(f"Worker running on cores {cores} with {num_threads} threads.")
+        while True:
+            request = requests.get()
+            if request is None:
+                break
+            kind, payload = request
+            if kind == 'state':
+                model.load_state_dict(payload)
+                continue
+            try:
+                with torch.no_grad():
+                    replies.put(('output', model(payload)))
+            except Exception as e:
+                replies.put(('error', f"{type(e).__name__}: {e}"))
+
+    def process_tensor(self, tensor, worker_id=0):
+        """
+        Runs `tensor` through the replica in worker `worker_id` and waits for the output.
+        Raises `CPUWorkerPool.WorkerDied` if the worker is gone (e.g. killed for running out of
+        memory, or it couldn't build the model).
+        """
+        if worker_id >= len(self._processes):
+            # Closed (possibly by another thread after a worker died)
+            raise self.WorkerDied(f"Worker {worker_id} was stopped.")
+        process = self._processes[worker_id]
+        self._requests[worker_id].put(('tensor', tensor.cpu()))
+        while True:
+            try:
+                kind, payload = self._replies[worker_id].get(timeout=self.POLL_INTERVAL)
+                break
+            except queue.Empty:
+                if not process.is_alive():
+                    raise self.WorkerDied(f"Worker {worker_id} died (exit code "
+                                          f"{process.exitcode}).")
+        if kind == 'error':
+            raise RuntimeError(f"Worker {worker_id} failed: {payload}")
+        return payload
+
+    def update_state(self, state_dict):
+        state_dict = {key: value.cpu() for key, value in state_dict.items()}
+        for requests in self._requests:
+            requests.put(('state', state_dict))
+        return self
+
+    def close(self):
+        for requests in self._requests:
+            requests.put(None)
+        for process in self._processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        self._processes = []
+        return self
+
+    def __repr__(self):
+        return f"CPUWorkerPool({self.num_workers} x {self.threads_per_worker} threads)"